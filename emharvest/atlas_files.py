@@ -1,6 +1,13 @@
 import os
+import logging
 import xmltodict
 import fnmatch
+from xml.parsers.expat import ExpatError
+
+from emharvest.failures import failures
+from emharvest.sources import find_inputs, is_local_input, open_input
+
+logger = logging.getLogger(__name__)
 
 def findpattern(pattern, path):
     """
@@ -8,12 +15,15 @@ def findpattern(pattern, path):
 
          Args:
              pattern (str): The file pattern to search for (e.g., "*.xml").
-             path (str): The directory path to search in.
+             path (str): The directory path to search in, an object store folder or a directory inside an archive
+                 (<archive>::<dir>).
 
          Returns:
              list: A list of file paths that match the specified pattern.
     """
-    print("Searching for pattern:", pattern, "in", path)
+    logger.debug("Searching for pattern: %s in %s", pattern, path)
+    if not is_local_input(path):
+        return find_inputs(pattern, path)
     result = []
     path = os.path.abspath(path)
     for root, _, files in os.walk(path):
@@ -22,6 +32,50 @@ def findpattern(pattern, path):
                 result.append(os.path.relpath(os.path.join(root, name), start=path))
     return result
 
+def first_match(pattern, path, exclude=None):
+    """
+        Returns the first file findpattern would list for pattern, skipping paths containing exclude.
+
+        A local walk stops at the first match instead of listing the whole session.
+
+        Returns:
+            str: The path joined to path, or None when no file matches.
+    """
+    if is_local_input(path):
+        root_path = os.path.abspath(path)
+        for root, _, files in os.walk(root_path):
+            for name in files:
+                if fnmatch.fnmatch(name, pattern):
+                    relpath = os.path.relpath(os.path.join(root, name), start=root_path)
+                    if not exclude or exclude not in relpath:
+                        return relpath if relpath.startswith(path) else os.path.join(path, relpath)
+        return None
+    file_list = findpattern(pattern, path)
+    if exclude:
+        file_list = [x for x in file_list if exclude not in x]
+    # Avoid duplicating 'path'
+    file_list = [x if x.startswith(path) else os.path.join(path, x) for x in file_list]
+    return file_list[0] if file_list else None
+
+# The files searchSupervisorData parses for the session metadata, as (pattern, exclude)
+DATA_XML_PATTERNS = [("GridSquare*.xml", None), ("FoilHole*.xml", "Data"), ("FoilHole*Data*.xml", None)]
+ATLAS_XML_PATTERNS = ["Atlas*.xml", "Tile*.xml"]
+
+def representative_xmls(session_dir=None, atlas_dir=None):
+    """
+        Lists the representative xmls searchSupervisorData and searchSupervisorAtlas read the session
+        metadata from, so the result cache can stamp them.
+
+        Returns:
+            list: The paths found, atlas first.
+    """
+    paths = []
+    if atlas_dir:
+        paths += [first_match(pattern, atlas_dir) for pattern in ATLAS_XML_PATTERNS]
+    if session_dir:
+        paths += [first_match(pattern, session_dir, exclude) for pattern, exclude in DATA_XML_PATTERNS]
+    return [path for path in paths if path]
+
 def searchSupervisorAtlas(path):
     """
         Searches for Supervisor Atlas XML files and returns metadata.
@@ -32,7 +86,7 @@ def searchSupervisorAtlas(path):
         Returns:
             dict: A dictionary containing metadata about the found Atlas XML files.
     """
-    print("Searching Supervisor Atlas directory for XMLs, MRC, and JPG")
+    logger.info("Searching Supervisor Atlas directory for XMLs, MRC, and JPG")
 
     xmlAtlasList = findpattern("Atlas*.xml", path)
     xmlAtlas = xmlAtlasList[0] if xmlAtlasList else None
@@ -41,19 +95,19 @@ def searchSupervisorAtlas(path):
     xmlAtlasTile = xmlAtlasTileList[0] if xmlAtlasTileList else None
 
     if xmlAtlas:
-        with open(os.path.join(path, xmlAtlas), "r") as xml:
+        with open_input(os.path.join(path, xmlAtlas)) as xml:
             xmlAtlasDict = xmltodict.parse(xml.read())
     else:
         xmlAtlasDict = None
 
     if xmlAtlasTile:
-        with open(os.path.join(path, xmlAtlasTile), "r") as xml:
+        with open_input(os.path.join(path, xmlAtlasTile)) as xml:
             xmlAtlasTileDict = xmltodict.parse(xml.read())
     else:
         xmlAtlasTileDict = None
 
-    print(f"Found Atlas: {xmlAtlas}")
-    print(f"Found Atlas tile: {xmlAtlasTile}\n")
+    logger.info("Found Atlas: %s", xmlAtlas)
+    logger.info("Found Atlas tile: %s", xmlAtlasTile)
 
     return {
         "xmlAtlasList": xmlAtlasList,
@@ -74,49 +128,39 @@ def searchSupervisorData(path):
         Returns:
             dict: A dictionary containing extracted data from the found Supervisor Data files.
     """
-    print('Searching Supervisor Data directory for xmls, mrc, and jpg')
-    print()
+    logger.info('Searching Supervisor Data directory for xmls, mrc, and jpg')
 
     def find_and_get_first(pattern, path, exclude=None):
-        file_list = findpattern(pattern, path)
-        if exclude:
-            file_list = [x for x in file_list if exclude not in x]
-        # Avoid duplicating 'path'
-        file_list = [x if x.startswith(path) else os.path.join(path, x) for x in file_list]
-        return file_list[0] if file_list else 'None'
-
-    print('Finding GridSquare xml')
+        return first_match(pattern, path, exclude) or 'None'
+
     xmlSquare = find_and_get_first('GridSquare*.xml', path)
-    print('Done' if xmlSquare != 'None' else 'None found')
+    logger.debug('Finding GridSquare xml: %s', 'Done' if xmlSquare != 'None' else 'None found')
 
-    print('Finding FoilHole xml')
     xmlHole = find_and_get_first('FoilHole*.xml', path, exclude="Data")
-    print('Done' if xmlHole != 'None' else 'None found')
+    logger.debug('Finding FoilHole xml: %s', 'Done' if xmlHole != 'None' else 'None found')
 
-    print('Finding AcquisitionData xml')
     xmlData = find_and_get_first('FoilHole*Data*.xml', path)
-    print('Done' if xmlData != 'None' else 'None found')
+    logger.debug('Finding AcquisitionData xml: %s', 'Done' if xmlData != 'None' else 'None found')
 
-    print('Finding AcquisitionData mrc')
     mrc = find_and_get_first('FoilHole*Data*.mrc', path)
-    print('Done' if mrc != 'None' else 'None found')
+    logger.debug('Finding AcquisitionData mrc: %s', 'Done' if mrc != 'None' else 'None found')
 
-    print('Finding AcquisitionData jpg')
     jpg = find_and_get_first('FoilHole*Data*.jp*g', path)
-    print('Done' if jpg != 'None' else 'None found')
+    logger.debug('Finding AcquisitionData jpg: %s', 'Done' if jpg != 'None' else 'None found')
 
-    print('Found representative xml file for pulling metadata about EPU session')
-    print(f'Square: {xmlSquare}')
-    print(f'Hole: {xmlHole}')
-    print(f'Acquisition: {xmlData}')
-    print()
+    logger.info('Found representative xml file for pulling metadata about EPU session')
+    logger.info('Square: %s', xmlSquare)
+    logger.info('Hole: %s', xmlHole)
+    logger.info('Acquisition: %s', xmlData)
 
     def parse_xml_to_dict(file_path):
         try:
-            with open(file_path, "r") as xml:
+            with open_input(file_path) as xml:
                 return xmltodict.parse(xml.read())
-        except:
-            print(f'Error parsing {file_path}')
+        except (OSError, ExpatError) as e:
+            if failures.fail_fast:
+                raise
+            failures.record("file", file_path, e)
             return {}
 
     result = {
@@ -0,0 +1,183 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from contextlib import redirect_stdout
+
+from rich.console import Console
+from rich.table import Table
+
+from emharvest.object_store import MemoryObjectStore, register_store
+from emharvest.profiling import profiler
+from emharvest.synthetic_session import generate_epu_session, generate_atlas, generate_tomo_mdocs
+
+DEFAULT_SCALES = "2x4x2,10x10x4,40x20x4"
+
+
+def parse_scale(scale):
+    """
+        Parses an NxMxK scale (GridSquares x FoilHoles x acquisitions) into a tuple of ints.
+    """
+    try:
+        n, m, k = (int(part) for part in scale.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Scale '{scale}' is not of the form NxMxK, e.g. 10x20x4")
+    return n, m, k
+
+
+def run_harvest(argv):
+    """
+        Runs one harvest in this process with --profile and returns its stage summary and wall time.
+
+        Args:
+            argv (list): The emharvest command line options, without the program name.
+
+        Returns:
+            tuple: (stages, wall_s), stages as returned by StageProfiler.summary().
+    """
+    from emharvest import emharvest_main
+
+    saved_argv = sys.argv
+    sys.argv = ["emharvest"] + argv + ["--profile", "--quiet"]
+    profiler.reset()
+    start_time = time.perf_counter()
+    try:
+        # Only the measurements are of interest here, not the profile table
+        with redirect_stdout(io.StringIO()):
+            emharvest_main.main()
+    finally:
+        sys.argv = saved_argv
+    wall_s = time.perf_counter() - start_time
+    return profiler.summary(), wall_s
+
+
+def benchmark_scale(workdir, scale, samples=1, tilts=0, repeat=1, seed=0, object_store_latency_s=None):
+    """
+        Generates a synthetic session at one scale and times its harvest.
+
+        Args:
+            workdir (str): Directory to generate the session and write the outputs in.
+            scale (tuple): (GridSquares, FoilHoles per GridSquare, acquisitions per FoilHole).
+            samples (int, optional): Atlas samples.
+            tilts (int, optional): Also harvest a SerialEM tilt series mdoc with this many tilts when > 0.
+            repeat (int, optional): Number of harvests, the fastest run is reported.
+            seed (int, optional): Random seed of the synthetic session.
+            object_store_latency_s (float, optional): Also harvest the session from an in-process object store
+                (memory://) whose requests take this long, and count its requests.
+
+        Returns:
+            dict: The scale, file counts and per run stage summaries.
+    """
+    n, m, k = scale
+    name = f"{n}x{m}x{k}"
+    scale_dir = os.path.join(workdir, name)
+    generate_start = time.perf_counter()
+    session = generate_epu_session(os.path.join(scale_dir, "epu"), n, m, k, seed=seed)
+    atlas = generate_atlas(os.path.join(scale_dir, "atlas"), samples=samples)
+    result = {"scale": name, "grid_squares": n, "foil_holes": m, "acquisitions": k, "files": session["files"],
+              "generate_s": time.perf_counter() - generate_start, "runs": {}}
+
+    harvests = {"epu": ["-m", "SPA", "-c", "epu", "-e", session["epu"], "-a", atlas["atlas"],
+                        "-o", os.path.join(scale_dir, "output_epu")]}
+    if tilts:
+        mdoc = generate_tomo_mdocs(os.path.join(scale_dir, "tomo"), tilts=tilts, seed=seed)[0]
+        harvests["serialEM"] = ["-m", "TOMO", "-c", "serialEM", "-d", mdoc,
+                                "-o", os.path.join(scale_dir, "output_serialEM")]
+    if object_store_latency_s is not None:
+        store = MemoryObjectStore.from_directory(scale_dir, name, latency_s=object_store_latency_s)
+        harvests["object_store"] = ["-m", "SPA", "-c", "epu", "-e", f"memory://{name}/epu/",
+                                    "-a", f"memory://{name}/atlas/", "-o", os.path.join(scale_dir, "output_object_store")]
+
+    for category, argv in harvests.items():
+        best = None
+        for _ in range(repeat):
+            if category == "object_store":
+                # A new filesystem per run, so every run starts with empty caches
+                register_store("memory", store)
+                store.requests = {"list": 0, "get": 0}
+            stages, wall_s = run_harvest(argv)
+            if best is None or wall_s < best["wall_s"]:
+                best = {"wall_s": wall_s, "stages": stages}
+        if category == "object_store":
+            best["requests"] = dict(store.requests)
+        result["runs"][category] = best
+    return result
+
+
+def print_scaling_table(results, category="epu"):
+    """
+        Prints one row per stage and one wall time column per scale.
+    """
+    results = [r for r in results if category in r["runs"]]
+    table = Table(title=f"EMharvest scaling ({category})")
+    table.add_column("Stage")
+    for result in results:
+        table.add_column(f"{result['scale']}\n({result['files']['Data']} mics)", justify="right")
+
+    stage_names = {}
+    for result in results:
+        for row in result["runs"][category]["stages"]:
+            stage_names.setdefault(row["stage"], row.get("depth", 0))
+    for name, depth in stage_names.items():
+        cells = ["  " * depth + name]
+        for result in results:
+            row = next((r for r in result["runs"][category]["stages"] if r["stage"] == name), None)
+            cells.append(f"{row['wall_s']:.3f}" if row else "-")
+        table.add_row(*cells)
+    table.add_row("total", *[f"{r['runs'][category]['wall_s']:.3f}" for r in results], style="bold")
+    Console().print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time EMharvest stages on synthetic sessions of increasing size.")
+    parser.add_argument("--scales", default=DEFAULT_SCALES,
+                        help=f"Comma separated NxMxK scales (GridSquares x FoilHoles x acquisitions), default {DEFAULT_SCALES}")
+    parser.add_argument("--samples", type=int, default=1, help="Atlas samples per session")
+    parser.add_argument("--tilts", type=int, default=0, help="Also benchmark a SerialEM mdoc with this many tilts")
+    parser.add_argument("--repeat", type=int, default=1, help="Harvests per scale, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic sessions")
+    parser.add_argument("--object_store_latency_ms", type=float,
+                        help="Also harvest each session from an in-process object store with this request latency")
+    parser.add_argument("--workdir", help="Directory for the synthetic sessions (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic sessions and harvest outputs")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    scales = [parse_scale(scale) for scale in args.scales.split(",") if scale]
+    workdir = args.workdir or tempfile.mkdtemp(prefix="emharvest_benchmark_")
+    results = []
+    try:
+        for scale in scales:
+            result = benchmark_scale(workdir, scale, samples=args.samples, tilts=args.tilts,
+                                     repeat=args.repeat, seed=args.seed,
+                                     object_store_latency_s=None if args.object_store_latency_ms is None
+                                     else args.object_store_latency_ms / 1000)
+            print(f"{result['scale']}: {result['files']['Data']} micrographs, "
+                  f"harvested in {result['runs']['epu']['wall_s']:.3f} s")
+            results.append(result)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"Synthetic sessions kept in {workdir}")
+
+    print_scaling_table(results, "epu")
+    if args.tilts:
+        print_scaling_table(results, "serialEM")
+    if args.object_store_latency_ms is not None:
+        print_scaling_table(results, "object_store")
+        for result in results:
+            requests = result["runs"]["object_store"]["requests"]
+            print(f"{result['scale']}: {requests['list']} list and {requests['get']} get requests to the object store")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"scales": results}, f, indent=4)
+        print(f"Benchmark results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+import json
+import time
+import sqlite3
+import logging
+import argparse
+
+from rich.console import Console
+from rich.table import Table
+
+from emharvest.logs import configure_logging
+
+# Indexed columns of the catalogue, filled from the deposition table rows of save_deposition_file
+CATALOGUE_COLUMNS = {
+    "microscope": "Microscope",
+    "detector": "detector_name",
+    "detector_mode": "detector_mode",
+    "magnification": "mag",
+    "pixel_size": "apix",
+    "defocus_min": "nominal_defocus_min_microns",
+    "defocus_max": "nominal_defocus_max_microns",
+    "collection": "collection",
+    "number_of_images": "number_of_images",
+    "software": "software_name",
+}
+NUMERIC_COLUMNS = ["voltage_kv", "magnification", "pixel_size", "defocus_min", "defocus_max", "number_of_images"]
+# Equality filters are indexed together with the date, so "a detector in a year" is one index range
+INDEXES = {
+    "session_name": ["session_name"],
+    "microscope": ["microscope", "date"],
+    "detector": ["detector", "date"],
+    "mode": ["mode", "date"],
+    "voltage_kv": ["voltage_kv", "date"],
+    "collection": ["collection", "date"],
+    "date": ["date"],
+    "pixel_size": ["pixel_size"],
+    "defocus_min": ["defocus_min"],
+    "defocus_max": ["defocus_max"],
+}
+# Query filters mapped to the column and comparison they apply, year is a date range
+QUERY_FILTERS = {
+    "microscope": ("microscope", "="),
+    "detector": ("detector", "="),
+    "detector_mode": ("detector_mode", "="),
+    "mode": ("mode", "="),
+    "category": ("category", "="),
+    "collection": ("collection", "="),
+    "voltage_kv": ("voltage_kv", "="),
+    "year": ("date", None),
+    "date_from": ("date", ">="),
+    "date_to": ("date", "<="),
+    # The nominal defocus range lies within [defocus_from, defocus_to], defocus_max is the furthest from focus
+    "defocus_from": ("defocus_max", ">="),
+    "defocus_to": ("defocus_min", "<="),
+    "pixel_size_min": ("pixel_size", ">="),
+    "pixel_size_max": ("pixel_size", "<="),
+}
+GROUP_COLUMNS = ["microscope", "detector", "detector_mode", "mode", "category", "collection", "voltage_kv", "year",
+                 "month"]
+# Aggregates reported per group, or for all the matching sessions
+AGGREGATES = ("COUNT(*) AS sessions, SUM(number_of_images) AS images, AVG(pixel_size) AS mean_pixel_size, "
+              "MIN(defocus_max) AS defocus_far, MAX(defocus_min) AS defocus_near, MIN(date) AS first_date, "
+              "MAX(date) AS last_date")
+
+# Sessions are keyed by their absolute directory, SerialEM sessions all share one session name
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_path TEXT PRIMARY KEY,
+    session_name TEXT NOT NULL,
+    harvested_at TEXT NOT NULL,
+    mode TEXT,
+    category TEXT,
+    microscope TEXT,
+    microscope_serial_number TEXT,
+    detector TEXT,
+    detector_mode TEXT,
+    voltage_kv REAL,
+    date TEXT,
+    collection TEXT,
+    magnification REAL,
+    pixel_size REAL,
+    defocus_min REAL,
+    defocus_max REAL,
+    number_of_images INTEGER,
+    software TEXT,
+    output_dir TEXT,
+    record TEXT,
+    presets TEXT
+);
+""" + "".join(f"CREATE INDEX IF NOT EXISTS sessions_{name} ON sessions ({', '.join(columns)});\n"
+              for name, columns in INDEXES.items())
+
+logger = logging.getLogger("emharvest.catalogue")
+
+
+def connect(catalogue_path):
+    """Opens the catalogue, creating its table and indexes on first use."""
+    connection = sqlite3.connect(catalogue_path, timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _number(value):
+    """Numeric value of a deposition field, None for '?' and unparsable values."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def catalogue_row(tables, record, args):
+    """
+        Builds the catalogue row of a harvested session.
+
+        Args:
+            tables (dict): The deposition tables of the session (deposition_tables).
+            record (dict): The complete data dictionary of the session, its "presets" are stored when present.
+            args (argparse.Namespace): The parsed command line arguments.
+
+        Returns:
+            dict: The catalogue columns.
+    """
+    values = tables["values"]
+    row = {column: values.get(key) for column, key in CATALOGUE_COLUMNS.items()}
+    row.update(session_name=tables["session"], session_path=tables["session_path"], mode=args.mode, category=args.category,
+               microscope_serial_number=values.get("microscope_serial_number"),
+               harvested_at=time.strftime("%Y-%m-%dT%H:%M:%S"), output_dir=args.output_dir)
+    for column in NUMERIC_COLUMNS:
+        if column in row:
+            row[column] = _number(row[column])
+    voltage = _number(values.get("eV"))
+    # EPU records the voltage in V, SerialEM in kV
+    row["voltage_kv"] = voltage / 1000 if voltage is not None and voltage > 1000 else voltage
+    # Dates are stored as YYYY-MM-DD so that ranges use the index
+    date = str(values.get("date") or "")
+    row["date"] = date[:10] if len(date) >= 10 else None
+    row["record"] = json.dumps(tables["nested_dict"], default=str)
+    row["presets"] = json.dumps(record["presets"], default=str) if record.get("presets") else None
+    for column, value in row.items():
+        if value == "?" or value == "":
+            row[column] = None
+    return row
+
+
+def _refresh_statistics(connection):
+    """
+        Analyzes the catalogue each time it doubles in size, so the planner picks the most selective index
+        (e.g. the detector rather than the collection) without analyzing on every insert.
+    """
+    sessions = connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    analyzed = 0
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        stat = connection.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = 'sessions' LIMIT 1").fetchone()
+        analyzed = int(stat[0].split()[0]) if stat else 0
+    if sessions >= 2 * max(analyzed, 8):
+        connection.execute("ANALYZE sessions")
+
+
+def upsert_session(catalogue_path, tables, record, args):
+    """
+        Adds the deposition record of a session to the catalogue, replacing an earlier harvest of the session
+        directory. Sessions sharing a name, e.g. SerialEM sessions, keep a row each.
+
+        Presets are kept from the earlier harvest when this one has none, e.g. an incremental re-harvest.
+    """
+    row = catalogue_row(tables, record, args)
+    columns = list(row)
+    updates = ", ".join(f"{column} = excluded.{column}" for column in columns
+                        if column not in ("session_path", "presets"))
+    connection = connect(catalogue_path)
+    try:
+        connection.execute(f"INSERT INTO sessions ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                           f"ON CONFLICT (session_path) DO UPDATE SET {updates}, "
+                           f"presets = COALESCE(excluded.presets, sessions.presets)",
+                           [row[column] for column in columns])
+        _refresh_statistics(connection)
+    finally:
+        connection.close()
+    logger.info("Catalogued session %s (%s) in %s", row["session_name"], row["session_path"], catalogue_path)
+
+
+def build_query(filters, group_by=None):
+    """
+        Translates query filters into an SQL statement on the catalogue.
+
+        Args:
+            filters (dict): Names of QUERY_FILTERS mapped to their values, None values are ignored.
+            group_by (list, optional): Columns of GROUP_COLUMNS to aggregate by. Without it, sessions are listed.
+
+        Returns:
+            tuple: (SQL statement, parameters).
+    """
+    where = []
+    parameters = []
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if name == "year":
+            # A range rather than LIKE, so the date index is used
+            where.append("date BETWEEN ? AND ?")
+            parameters += [f"{value}-01-01", f"{value}-12-31"]
+            continue
+        column, operator = QUERY_FILTERS[name]
+        where.append(f"{column} {operator} ?")
+        parameters.append(value)
+
+    clause = f" WHERE {' AND '.join(where)}" if where else ""
+    if not group_by:
+        return (f"SELECT session_name, session_path, date, microscope, detector, voltage_kv, mode, collection, "
+                f"pixel_size, defocus_min, defocus_max, number_of_images FROM sessions{clause} "
+                f"ORDER BY date, session_name, session_path",
+                parameters)
+    keys = [{"year": "substr(date, 1, 4)", "month": "substr(date, 1, 7)"}.get(column, column) + f" AS {column}"
+            for column in group_by]
+    names = ", ".join(group_by)
+    return f"SELECT {', '.join(keys)}, {AGGREGATES} FROM sessions{clause} GROUP BY {names} ORDER BY {names}", parameters
+
+
+def query(catalogue_path, filters, group_by=None, limit=None):
+    """
+        Queries the catalogue.
+
+        Returns:
+            list: One dict per matching session, or per group with the session count and aggregates.
+    """
+    sql, parameters = build_query(filters, group_by)
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    connection = connect(catalogue_path)
+    try:
+        return [dict(row) for row in connection.execute(sql, parameters)]
+    finally:
+        connection.close()
+
+
+def _format(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:g}"
+    return str(value)
+
+
+def print_rows(rows, title):
+    table = Table(title=title)
+    columns = list(rows[0]) if rows else []
+    for column in columns:
+        table.add_column(column, justify="right" if rows and isinstance(rows[0][column], (int, float)) else "left")
+    for row in rows:
+        table.add_row(*[_format(row[column]) for column in columns])
+    Console().print(table)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="emharvest query",
+                                     description="Filter and aggregate harvested sessions in a catalogue.")
+    parser.add_argument("catalogue", help="Catalogue database written with --catalogue")
+    parser.add_argument("--microscope", help="Microscope model, e.g. 'TFS KRIOS'")
+    parser.add_argument("--detector", help="Detector model, e.g. 'TFS FALCON 4i (4k x 4k)'")
+    parser.add_argument("--detector_mode", help="COUNTING or SUPER-RESOLUTION")
+    parser.add_argument("--mode", choices=["SPA", "TOMO"], help="Microscopy mode")
+    parser.add_argument("--category", choices=["epu", "epu_no_dm", "serialEM"], help="Data category")
+    parser.add_argument("--collection", help="AFIS or Accrt (EPU sessions)")
+    parser.add_argument("--voltage_kv", type=float, help="Accelerating voltage in kV, e.g. 300")
+    parser.add_argument("--year", help="Sessions collected in this year")
+    parser.add_argument("--date_from", help="Sessions collected on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--date_to", help="Sessions collected on or before this date (YYYY-MM-DD)")
+    parser.add_argument("--defocus_from", type=float,
+                        help="Sessions whose nominal defocus range starts at or above this value (microns, e.g. -3)")
+    parser.add_argument("--defocus_to", type=float,
+                        help="Sessions whose nominal defocus range ends at or below this value (microns, e.g. -0.5)")
+    parser.add_argument("--pixel_size_min", type=float, help="Smallest pixel size (Angstrom)")
+    parser.add_argument("--pixel_size_max", type=float, help="Largest pixel size (Angstrom)")
+    parser.add_argument("-g", "--group_by", type=lambda value: value.split(","),
+                        help=f"Aggregate by comma separated columns: {', '.join(GROUP_COLUMNS)}")
+    parser.add_argument("-n", "--limit", type=int, help="Return at most this many rows")
+    parser.add_argument("--json", action="store_true", help="Print the rows as JSON")
+    args = parser.parse_args(argv)
+    configure_logging(level="INFO")
+
+    unknown = [column for column in args.group_by or [] if column not in GROUP_COLUMNS]
+    if unknown:
+        parser.error(f"can not group by {', '.join(unknown)}, expected any of {', '.join(GROUP_COLUMNS)}")
+    filters = {name: getattr(args, name) for name in QUERY_FILTERS}
+
+    start = time.perf_counter()
+    rows = query(args.catalogue, filters, group_by=args.group_by, limit=args.limit)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if args.json:
+        print(json.dumps(rows, indent=4))
+    else:
+        print_rows(rows, title=f"{len(rows)} rows ({elapsed_ms:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import os
+import re
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from emharvest.failures import failures
+
+# Large reads keep hashing bound by storage bandwidth rather than per-call overhead,
+# hashlib releases the GIL while digesting so worker threads overlap I/O and hashing
+READ_BUFFER_SIZE = 8 * 1024 * 1024
+MANIFEST_HEADER = ["sha256", "size", "mtime_ns", "path"]
+# Characters that would break the tab separated lines, escaped in paths as sha256sum does
+PATH_ESCAPES = {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"}
+_UNESCAPE = re.compile(r"\\(.)")
+
+logger = logging.getLogger(__name__)
+
+
+def sha256_file(path, buffer_size=READ_BUFFER_SIZE):
+    """
+        Calculates the SHA-256 checksum of a file using large reads into a reusable buffer.
+
+        Args:
+            path (str): The path to the file to hash.
+            buffer_size (int, optional): The read buffer size in bytes. Defaults to 8 MiB.
+
+        Returns:
+            str: The hexadecimal SHA-256 digest.
+    """
+    sha256_hash = hashlib.sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            sha256_hash.update(view[:n])
+    return sha256_hash.hexdigest()
+
+
+def list_session_files(path, exclude=None):
+    """
+        Lists every regular file below a session directory.
+
+        Args:
+            path (str): The session directory to walk.
+            exclude (list, optional): Absolute file paths to leave out, e.g. the manifest itself.
+
+        Returns:
+            list: Paths relative to the session directory, sorted for a stable manifest.
+    """
+    path = os.path.abspath(path)
+    exclude = {os.path.abspath(x) for x in (exclude or [])}
+    result = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            full_path = os.path.join(root, name)
+            if full_path in exclude or not os.path.isfile(full_path):
+                continue
+            result.append(os.path.relpath(full_path, start=path))
+    return sorted(result)
+
+
+def escape_path(rel_path):
+    """
+        Escapes a path holding a tab, newline or carriage return for its manifest line.
+
+        Like sha256sum, such a line starts with a backslash, and the backslashes and control characters of its
+        path are escaped. Other paths, including Windows paths, are written as they are.
+
+        Returns:
+            tuple: (line prefix, path to write).
+    """
+    if not any(c in rel_path for c in "\t\n\r"):
+        return "", rel_path
+    return "\\", "".join(PATH_ESCAPES.get(c, c) for c in rel_path)
+
+
+def unescape_path(path):
+    """Reverses escape_path for the path of a line starting with a backslash."""
+    characters = {"t": "\t", "n": "\n", "r": "\r"}
+    return _UNESCAPE.sub(lambda match: characters.get(match.group(1), match.group(1)), path)
+
+
+def read_manifest(manifest_path):
+    """
+        Reads an existing checksum manifest.
+
+        Args:
+            manifest_path (str): The path to the manifest file.
+
+        Returns:
+            dict: Relative path mapped to a (sha256, size, mtime_ns) tuple, empty if there is no manifest.
+    """
+    entries = {}
+    if not os.path.isfile(manifest_path):
+        return entries
+    with open(manifest_path, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            escaped = line.startswith("\\")
+            parts = line[escaped:].split("\t", 3)
+            if len(parts) != 4:
+                continue
+            digest, size, mtime_ns, rel_path = parts
+            if escaped:
+                rel_path = unescape_path(rel_path)
+            try:
+                entries[rel_path] = (digest, int(size), int(mtime_ns))
+            except ValueError:
+                continue
+    return entries
+
+
+def write_manifest(manifest_path, entries):
+    """
+        Writes a checksum manifest, one tab separated line per file, with the paths escaped by escape_path.
+
+        Args:
+            manifest_path (str): The path to the manifest file.
+            entries (dict): Relative path mapped to a (sha256, size, mtime_ns) tuple.
+
+        Returns:
+            None
+    """
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("#" + "\t".join(MANIFEST_HEADER) + "\n")
+        for rel_path in sorted(entries):
+            digest, size, mtime_ns = entries[rel_path]
+            prefix, path = escape_path(rel_path)
+            f.write(f"{prefix}{digest}\t{size}\t{mtime_ns}\t{path}\n")
+    os.replace(tmp_path, manifest_path)
+
+
+def _skip(rel_path, error):
+    """Records a file that could not be added to the manifest, raising with --fail_fast."""
+    if failures.fail_fast:
+        raise error
+    failures.record("file", rel_path, error, message=f"left out of the checksum manifest: {error}")
+
+
+def build_checksum_manifest(session_dir, manifest_path, workers=None):
+    """
+        Builds a SHA-256 manifest of every file in a session directory, hashing files on a thread pool.
+        Entries from a previous manifest are reused when the file size and mtime are unchanged. Files that
+        disappear or can not be read while the manifest is built, as in a session still being written, are
+        recorded as failures and left out.
+
+        Args:
+            session_dir (str): The session directory to hash (movies, gain references, XML, JPG...).
+            manifest_path (str): The path where the manifest will be written.
+            workers (int, optional): Number of hashing threads. Defaults to min(32, cpu count + 4).
+
+        Returns:
+            dict: Counts of hashed, reused and total files.
+    """
+    session_dir = os.path.abspath(session_dir)
+    previous = read_manifest(manifest_path)
+    files = list_session_files(session_dir, exclude=[manifest_path, manifest_path + ".tmp"])
+
+    entries = {}
+    to_hash = []
+    for rel_path in files:
+        try:
+            st = os.stat(os.path.join(session_dir, rel_path))
+        except OSError as e:
+            _skip(rel_path, e)
+            continue
+        old = previous.get(rel_path)
+        if old and old[1] == st.st_size and old[2] == st.st_mtime_ns:
+            entries[rel_path] = old
+        else:
+            to_hash.append((rel_path, st.st_size, st.st_mtime_ns))
+
+    def hash_entry(item):
+        rel_path, size, mtime_ns = item
+        try:
+            return rel_path, (sha256_file(os.path.join(session_dir, rel_path)), size, mtime_ns)
+        except OSError as e:
+            _skip(rel_path, e)
+            return rel_path, None
+
+    hashed = 0
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for rel_path, entry in pool.map(hash_entry, to_hash):
+                if entry is not None:
+                    entries[rel_path] = entry
+                    hashed += 1
+
+    write_manifest(manifest_path, entries)
+
+    stats = {"total": len(entries), "hashed": hashed, "reused": len(entries) - hashed,
+             "skipped": len(files) - len(entries)}
+    logger.info("Created checksum manifest %s: %d files, %d hashed, %d reused, %d skipped",
+                manifest_path, stats['total'], stats['hashed'], stats['reused'], stats['skipped'])
+    return stats
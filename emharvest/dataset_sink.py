@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import sqlite3
+import logging
+import datetime
+
+DATASET_FORMATS = ["ndjson", "parquet"]
+# One part file per date/microscope partition
+PART_NAME = "part-0"
+# The part file of each session, ignored by dataset readers as its name starts with an underscore
+INDEX_FILENAME = "_sessions.db"
+
+logger = logging.getLogger(__name__)
+
+
+def dataset_columns(*item_maps):
+    """
+        Returns the stable, ordered list of dataset columns from mmCIF item mappings.
+
+        Args:
+            *item_maps (dict): Deposition row name to "category.attribute" mappings (e.g. MMCIF_ITEMS).
+
+        Returns:
+            list: session_name, session_path and harvested_at, then every mapped JSON key as
+            "category.attribute".
+    """
+    columns = ["session_name", "session_path", "harvested_at"]
+    for item_map in item_maps:
+        for item in item_map.values():
+            if '?' not in item and item not in columns:
+                columns.append(item)
+    return columns
+
+
+def _partition_value(value):
+    """Makes a value safe to use as a hive style partition directory name."""
+    value = str(value).strip() if value not in (None, "") else "unknown"
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', value)
+
+
+def _cell(value):
+    """Stores every value as a string, or None for missing values, so the schema never changes between rows."""
+    if value is None or value == "?":
+        return None
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return str(value)
+
+
+def deposition_row(nested_dict, session_name, columns, session_path=None):
+    """
+        Flattens a deposition record ({category: {attribute: value}}) into one dataset row.
+
+        Args:
+            nested_dict (dict): The record written to _dep.json.
+            session_name (str): The EPU/SerialEM session name.
+            columns (list): The dataset columns from dataset_columns.
+            session_path (str, optional): The absolute session directory, unique where names are not.
+
+        Returns:
+            dict: One value per column, in column order.
+    """
+    flat = {f"{category}.{attribute}": value
+            for category, attributes in nested_dict.items() for attribute, value in attributes.items()}
+    row = {column: _cell(flat.get(column)) for column in columns}
+    row["session_name"] = session_name
+    row["session_path"] = session_path
+    row["harvested_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+    return row
+
+
+def partition_dir(dataset_dir, row):
+    """
+        Returns the date/microscope partition directory of a row.
+    """
+    date = (row.get("em_imaging.date") or "unknown").split(" ")[0]
+    microscope = row.get("em_imaging.microscope_model")
+    return os.path.join(dataset_dir, f"date={_partition_value(date)}", f"microscope={_partition_value(microscope)}")
+
+
+def _row_key(row):
+    # Sessions are told apart by their directory, their names are not unique (SerialEM_microscopy_data)
+    return row.get("session_path") or row.get("session_name")
+
+
+def _read_rows(path):
+    """The rows of a part file, empty when it does not exist."""
+    if not os.path.exists(path):
+        return []
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        return pq.read_table(path).to_pylist()
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _write_rows(path, rows, columns):
+    """Rewrites a part file through a temporary file renamed into place, removing it when no row is left."""
+    if not rows:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    rows = [{column: row.get(column) for column in columns} for row in rows]
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    if path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([(column, pa.string()) for column in columns])
+        pq.write_table(pa.Table.from_pylist(rows, schema=schema), tmp_path)
+    else:
+        with open(tmp_path, "w") as f:
+            f.writelines(json.dumps(row) + "\n" for row in rows)
+    os.replace(tmp_path, path)
+
+
+def _open_index(dataset_dir):
+    """
+        Opens the index of the part file holding each session's row. Its transactions also serialize the
+        writers of the dataset, on one node or several sharing a filesystem, like the work queue.
+    """
+    connection = sqlite3.connect(os.path.join(dataset_dir, INDEX_FILENAME), timeout=60, isolation_level=None)
+    connection.execute("CREATE TABLE IF NOT EXISTS sessions (session_path TEXT PRIMARY KEY, part TEXT NOT NULL)")
+    return connection
+
+
+def append_deposition_record(nested_dict, session_name, dataset_dir, columns, dataset_format="ndjson",
+                             session_path=None):
+    """
+        Adds one harvested deposition record as a row of a partitioned dataset.
+
+        Each date/microscope partition is one part file in either format, so a year of sessions is a few
+        hundred files for one columnar scan. The part file is rewritten with the session's row replaced, or
+        added, and renamed into place. A re-harvested session whose date or microscope changed is also removed
+        from its previous partition, so every session is one row of the dataset. Parquet requires pyarrow.
+
+        Args:
+            nested_dict (dict): The record written to _dep.json.
+            session_name (str): The EPU/SerialEM session name.
+            dataset_dir (str): Root directory of the dataset.
+            columns (list): The dataset columns from dataset_columns.
+            dataset_format (str, optional): "ndjson" (default) or "parquet".
+            session_path (str, optional): The absolute session directory, identifying the session's row.
+
+        Returns:
+            str: The part file the row was written to.
+    """
+    if dataset_format not in DATASET_FORMATS:
+        raise ValueError(f"Unknown dataset format '{dataset_format}', expected one of {DATASET_FORMATS}")
+    if dataset_format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow (pip install pyarrow), or use --dataset_format ndjson")
+    row = deposition_row(nested_dict, session_name, columns, session_path)
+    key = _row_key(row)
+    directory = partition_dir(dataset_dir, row)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{PART_NAME}.{dataset_format}")
+    part = os.path.relpath(path, dataset_dir)
+
+    connection = _open_index(dataset_dir)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        previous = connection.execute("SELECT part FROM sessions WHERE session_path = ?", (key,)).fetchone()
+        if previous and previous[0] != part:
+            previous_path = os.path.join(dataset_dir, previous[0])
+            _write_rows(previous_path, [old for old in _read_rows(previous_path) if _row_key(old) != key], columns)
+            logger.info("Removed the previous row of %s from %s", session_name, previous_path)
+        rows = [old for old in _read_rows(path) if _row_key(old) != key]
+        _write_rows(path, rows + [row], columns)
+        connection.execute("INSERT INTO sessions (session_path, part) VALUES (?, ?) "
+                           "ON CONFLICT (session_path) DO UPDATE SET part = excluded.part", (key, part))
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+    logger.info("Wrote deposition record to dataset %s (%d rows)", path, len(rows) + 1)
+    return path
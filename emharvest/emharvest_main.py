@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import fnmatch
 import math
+import logging
 import argparse
 import datetime
+import time
 
 import dateutil.parser
 import glob
@@ -12,16 +15,51 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import json
 from rich.pretty import pprint
 from typing import Any, Dict
 import xmltodict
+from xml.parsers.expat import ExpatError
 
 from emharvest.harvestor import perform_tomogram_harvest, perform_spa_harvest_nonepu, perform_serialEM_harvest
-from emharvest.atlas_files import findpattern, searchSupervisorAtlas, searchSupervisorData
+from emharvest.atlas_files import findpattern, representative_xmls, searchSupervisorAtlas, searchSupervisorData
+from emharvest.catalogue import main as query_catalogue, upsert_session
+from emharvest.checksum_manifest import build_checksum_manifest
+from emharvest.dataset_sink import DATASET_FORMATS, append_deposition_record, dataset_columns
+from emharvest.failures import (DEFAULT_BACKOFF_S, DEFAULT_FILE_TIMEOUT_S, DEFAULT_RETRIES, TRANSIENT_REASONS, failures,
+                                xml_value)
+from emharvest.logs import LOG_LEVELS, configure_logging, log_session_summary
+from emharvest.optics_groups import AMPLITUDE_CONTRAST, DEFAULT_CS_MM, session_optics_groups
+from emharvest.prefetch import DEFAULT_DEPTH
+from emharvest.profiling import BUDGET_ACTIONS, parse_memory_budgets, profiler, stage
 from emharvest.foilHole_data import FoilHoleData
-from emharvest.save_deposition_file import save_deposition_file
+from emharvest.movie_headers import MOVIE_READ_WORKERS, inspect_session_movies, movie_record, write_movie_summary
+from emharvest.mrc_headers import MRC_READ_WORKERS, check_pixel_size, inspect_session_mrcs, write_mrc_summary
+from emharvest.result_cache import detach_outputs, harvest_fingerprint, load_cached_result, restore_cached_result, store_result
+from emharvest.sampling import session_statistics, write_session_statistics
+from emharvest.save_deposition_file import (MMCIF_ITEMS, MOVIE_MMCIF_ITEMS, TOMO_MMCIF_ITEMS, deposition_outputs, deposition_tables,
+                                            save_deposition_file, sink_inputs, validate_deposition_cif,
+                                            write_deposition_checksum, write_deposition_cif, write_deposition_csv,
+                                            write_deposition_json)
+from emharvest.session_state import file_cache, input_stamps, load_session_state, save_session_state, scan_images
+from emharvest.object_store import BLOCK_SIZE, configure as configure_object_stores, log_filesystem_stats
+from emharvest.sources import DATA_FOLDERS, glob_inputs, input_abspath, input_dirname, is_local_input, open_input, resolve_input
+from emharvest.spatial import session_spatial_summary, write_spatial_summary
+from emharvest.stage_graph import StageGraph
+from emharvest.timeline import epu_timeline, mdoc_timeline, write_timeline
+
+# Columns of the preset table returned by xml_presets
+PRESET_COLUMNS = ["name", "mag", "apix", "probe", "spot", "C2", "beamD", "defocus", "time", "epuBin"]
+PRESET_READ_WORKERS = 4
+# Options reading every movie, MRC or file of a session, or the session directories, which archives and object
+# stores do not have
+LOCAL_ONLY_OPTIONS = ["mrc_headers", "movie_headers", "checksum_manifest", "incremental"]
+# Timestamps formatEPUDate reads without guessing their format, e.g. 2023-09-19T14:01:41.4531234+01:00
+EPU_DATE = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}")
+
+logger = logging.getLogger(__name__)
 
 def parse_arguments():
     prog = "EM HARVEST"
@@ -44,31 +82,147 @@ def parse_arguments():
     parser.add_argument("-t", "--tomogram_file", help="Tomogram file for TOMO mode")
     parser.add_argument("-d", "--mdoc_file", help="MDOC metadata file")
     parser.add_argument("-l", "--download_dict", help="Download the latest mmCIF dictionary")
+    parser.add_argument("--full_validation", action="store_true",
+                        help="Validate against the full mmCIF dictionary instead of the cached em_* subset")
+    parser.add_argument("--dict_path", help="mmCIF dictionary used for validation (default: $EMHARVEST_MMCIF_DICT or ./mmcif_dictionary/mmcif_pdbx_v50.dic)")
     parser.add_argument("-o", "--output_dir", help="Output directory for generated files")
+    parser.add_argument("--dataset_dir", help="Append the deposition record to a date/microscope partitioned dataset in this directory")
+    parser.add_argument("--dataset_format", default="ndjson", choices=DATASET_FORMATS,
+                        help="Format of the --dataset_dir rows (default: ndjson, parquet requires pyarrow)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time each harvest stage and report a summary table and <session>_profile.json")
+    parser.add_argument("--profile_dump", help="With --profile, also save a cProfile .pstats file per stage in this directory")
+    parser.add_argument("--profile_memory", action="store_true",
+                        help="With --profile, also track the peak heap (tracemalloc), top allocation sites and RSS per stage")
+    parser.add_argument("--memory_budget", type=parse_memory_budgets,
+                        help="Peak heap budget per stage, e.g. 1GB or xml_session=200MB,*=1GB (implies --profile_memory)")
+    parser.add_argument("--memory_budget_action", default="warn", choices=BUDGET_ACTIONS,
+                        help="Warn (default) or fail when a stage exceeds its memory budget")
     parser.add_argument("-p", "--print", action="store_true", help="Print parsed XML")
+    parser.add_argument("-k", "--checksum_manifest", action="store_true",
+                        help="Write a SHA-256 manifest of every file in the session directory")
+    parser.add_argument("--hash_workers", type=int, default=None, help="Number of threads used for the checksum manifest")
+    parser.add_argument("--cache_dir", help="Reuse the outputs of unchanged sessions from this result cache, and cache new results")
+    parser.add_argument("--cache_hash", action="store_true",
+                        help="Fingerprint the input files by content instead of size and modification time")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of threads running independent harvest stages concurrently (EPU sessions)")
+    parser.add_argument("--stages", type=lambda value: [name.strip() for name in value.split(",") if name.strip()],
+                        help="Only run these comma separated EPU harvest stages, e.g. validation, reusing --artifact_dir")
+    parser.add_argument("--artifact_dir", help="Save the intermediate artifacts of the EPU harvest stages in this directory")
+    parser.add_argument("--catalogue", help="Add the deposition record and presets to this SQLite catalogue, queried with emharvest query")
+    parser.add_argument("--mrc_headers", action="store_true",
+                        help="Read the header of every acquisition MRC (EPU sessions) and write <session>_mrc_headers.json")
+    parser.add_argument("--movie_headers", action="store_true",
+                        help="Read the frame count, dimensions and compression of every TIFF/EER movie (EPU sessions) into the deposition record")
+    parser.add_argument("--timeline", action="store_true",
+                        help="Compute the acquisition throughput, pauses and GridSquare dwell times and write <session>_timeline.json")
+    parser.add_argument("--spatial", action="store_true",
+                        help="Index the stage positions of every target and write hole spacing, density and AFIS cluster sizes to <session>_spatial.json")
+    parser.add_argument("--optics_groups", type=int, nargs="?", const=0,
+                        help="Cluster the beam shifts of an AFIS session into N optics groups (default: one per beam shift target) and write <session>_optics.star")
+    parser.add_argument("--optics_cs", type=float, default=DEFAULT_CS_MM,
+                        help=f"Spherical aberration (mm) of the optics groups, not recorded by EPU (default: {DEFAULT_CS_MM})")
+    parser.add_argument("--optics_amplitude_contrast", type=float, default=AMPLITUDE_CONTRAST,
+                        help=f"Amplitude contrast of the optics groups (default: {AMPLITUDE_CONTRAST})")
+    parser.add_argument("--sample", type=int,
+                        help="Estimate the per-image statistics of the session from a stratified sample of N acquisition xmls and write <session>_statistics.json")
+    parser.add_argument("--time_budget", type=float,
+                        help="Stop reading acquisition xmls for the session statistics after S seconds, estimating them from the xmls read so far")
+    parser.add_argument("--prefetch_depth", type=int, default=DEFAULT_DEPTH,
+                        help=f"Acquisition xmls read ahead of the one being processed (default: {DEFAULT_DEPTH})")
+    parser.add_argument("--fs_cache_dir", help="Keep the objects read from object stores (s3://...) in this directory for later harvests")
+    parser.add_argument("--fs_block_size", type=int, default=BLOCK_SIZE,
+                        help=f"Bytes per object store read request (default: {BLOCK_SIZE})")
+    parser.add_argument("--file_timeout", type=float, default=DEFAULT_FILE_TIMEOUT_S,
+                        help=f"Give up a file read after this many seconds, 0 to wait forever (default: {DEFAULT_FILE_TIMEOUT_S})")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help=f"Retries of a file read failing with an I/O error, with exponential backoff (default: {DEFAULT_RETRIES})")
+    parser.add_argument("--fail_fast", action="store_true",
+                        help="Stop at the first file or optional stage that fails, instead of recording it in <session>_errors.json and carrying on")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Keep a session state in the output directory and, on re-harvests of a growing EPU session, only process new images")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only log warnings and errors")
+    parser.add_argument("--log_level", type=str.upper, choices=LOG_LEVELS,
+                        help="Logging level (default: INFO in a terminal, a one line summary per session otherwise)")
+    parser.add_argument("--log_json", action="store_true", help="Log one JSON object per line")
     return parser.parse_args()
 
 def main():
     global args
+    # emharvest query <catalogue> searches the catalogue instead of harvesting
+    if sys.argv[1:2] == ["query"]:
+        return query_catalogue(sys.argv[2:])
     args = parse_arguments()
+    configure_logging(level=args.log_level, quiet=args.quiet, json_format=args.log_json)
+    if args.profile or args.profile_memory or args.memory_budget:
+        profiler.enable(dump_dir=args.profile_dump, memory=args.profile_memory, budgets=args.memory_budget,
+                        budget_action=args.memory_budget_action)
+    start_time = time.perf_counter()
+    main.mic_count = None
+    main.cached = False
+    main.timeline = None
+    configure_object_stores(cache_dir=args.fs_cache_dir, block_size=args.fs_block_size)
+    failures.configure(file_timeout_s=args.file_timeout, retries=args.retries, backoff_s=DEFAULT_BACKOFF_S,
+                       fail_fast=args.fail_fast)
+    failures.clear()
+    resolve_session_inputs(args)
+    if args.stages and not (args.mode == "SPA" and args.category == "epu"):
+        logger.warning("--stages only applies to EPU sessions, running the full harvest")
+    if args.incremental and not (args.mode == "SPA" and args.category == "epu"):
+        logger.warning("--incremental only applies to EPU sessions, running the full harvest")
+    if args.cache_dir and args.time_budget:
+        # What a time budget reads depends on the wall clock, so its results are never reused
+        logger.info("Not using the result cache, --time_budget is set")
+    if args.cache_dir and not args.print and not args.stages and not args.time_budget:
+        validation = cached_harvest(args)
+    else:
+        if args.cache_dir:
+            # Outputs restored from the cache earlier must not be rewritten in place
+            detach_outputs(args.output_dir)
+        validation = harvest_session(args)
+
+    if args.checksum_manifest:
+        session_dir = session_directory(args)
+        if session_dir:
+            manifest_path = os.path.join(args.output_dir, os.path.basename(os.path.abspath(session_dir)) + '_manifest.checksum')
+            with stage("checksum_manifest"):
+                build_checksum_manifest(session_dir, manifest_path, workers=args.hash_workers)
+
+    total_wall_s = time.perf_counter() - start_time
+    log_filesystem_stats()
+    if len(failures):
+        report_failures(args)
+    if profiler.enabled:
+        report_profile(args, total_wall_s)
+    report_session(args, validation, total_wall_s)
+
+def harvest_session(args):
+    """
+        Runs the harvest for the selected mode and category.
+
+        Returns:
+            dict: The structured mmCIF validation result, None when nothing was harvested.
+    """
+    validation = None
     if args.mode == "SPA" and args.category == "epu":
         if not args.epu or not args.atlas:
             args.error("SPA mode requires both --epu and --atlas files.")
 
         main.epu_xml = args.epu
-        main.epu_directory = os.path.dirname(args.epu)
+        main.epu_directory = input_dirname(args.epu)
 
         if args.print:
             print_epu_xml(main.epu_xml)
             exit(1)
 
         main.atlas_xml = args.atlas
-        main.atlas_directory = os.path.dirname(args.atlas)
+        main.atlas_directory = input_dirname(args.atlas)
 
         if not os.path.exists(args.output_dir):
             os.makedirs(args.output_dir)
 
-        perform_minimal_harvest_epu(main.epu_xml, args.output_dir)
+        validation = perform_minimal_harvest_epu(main.epu_xml, args.output_dir)
 
     if args.mode == "SPA" and args.category == "epu_no_dm":
         main.input_xml = args.input_file
@@ -81,7 +235,7 @@ def main():
         if not os.path.exists(args.output_dir):
             os.makedirs(args.output_dir)
 
-        perform_spa_harvest_nonepu(main.input_xml, args.output_dir)
+        validation = perform_spa_harvest_nonepu(main.input_xml, args.output_dir)
 
     elif args.mode == "TOMO" and args.category != "serialEM":
         tomogram_file = args.tomogram_file
@@ -92,7 +246,7 @@ def main():
         if not os.path.exists(args.output_dir):
             os.makedirs(args.output_dir)
 
-        perform_tomogram_harvest(tomogram_file, mdoc_file,args.output_dir)
+        validation = perform_tomogram_harvest(tomogram_file, mdoc_file,args.output_dir)
 
     elif args.mode == "SPA" or args.mode == "TOMO":
         if args.category == "serialEM":
@@ -102,7 +256,183 @@ def main():
 
             if not os.path.exists(args.output_dir):
                 os.makedirs(args.output_dir)
-            perform_serialEM_harvest(mdoc_file, args.output_dir)
+            validation = perform_serialEM_harvest(mdoc_file, args.output_dir)
+
+    if args.timeline and args.mdoc_file and not (args.mode == "SPA" and args.category in ("epu", "epu_no_dm")):
+        # SerialEM and tomography sessions are timed from the DateTime of each mdoc section
+        try:
+            with stage("timeline"):
+                main.timeline = mdoc_timeline(args.mdoc_file)
+        except Exception as e:
+            if failures.fail_fast:
+                raise
+            failures.record("stage", "timeline", e)
+        session = getattr(save_deposition_file, "session", None)
+        if main.timeline and session:
+            timeline_path = write_timeline(main.timeline, args.output_dir, session)
+            if getattr(save_deposition_file, "outputs", None):
+                save_deposition_file.outputs.append(timeline_path)
+
+    return validation
+
+def cached_harvest(args):
+    """
+        Reuses the outputs of an earlier harvest with the same fingerprint, or harvests and caches the outputs.
+
+        Returns:
+            dict: The structured mmCIF validation result of the harvest, cached or new.
+    """
+    session_dir = session_directory(args)
+    with stage("cache_lookup"):
+        fingerprint, components = harvest_fingerprint(args, session_dir, [MMCIF_ITEMS, TOMO_MMCIF_ITEMS, MOVIE_MMCIF_ITEMS],
+                                                      content=args.cache_hash,
+                                                      representatives=cache_representatives(args, session_dir))
+        entry = load_cached_result(args.cache_dir, fingerprint)
+    if entry:
+        restore_cached_result(entry, args.output_dir)
+        main.cached = True
+        main.mic_count = entry["result"]["micrographs"]
+        main.timeline = entry["result"].get("timeline")
+        cached_sinks(args, entry)
+        return entry["result"]["validation"]
+
+    # Outputs still linked to an older cache entry must not be rewritten in place
+    detach_outputs(args.output_dir)
+    save_deposition_file.outputs = []
+    save_deposition_file.sinks = None
+    validation = harvest_session(args)
+    transient = failures.count(reasons=TRANSIENT_REASONS)
+    if transient:
+        # A read that timed out or failed may succeed next time, so partial results are not reused
+        logger.info("Not caching the harvest, %d reads timed out or failed", transient)
+    elif save_deposition_file.outputs:
+        with stage("cache_store"):
+            store_result(args.cache_dir, fingerprint, components, save_deposition_file.outputs,
+                         save_deposition_file.session, {"validation": validation, "micrographs": main.mic_count,
+                          "timeline": main.timeline, "sinks": save_deposition_file.sinks})
+    return validation
+
+def cache_representatives(args, session_dir):
+    """
+        Returns the representative xmls of a local EPU session and its atlas. Object store listings and
+        archives already carry the version of every member in the fingerprint.
+    """
+    if not (args.mode == "SPA" and args.category == "epu" and session_dir and is_local_input(session_dir)):
+        return []
+    atlas_dir = input_dirname(args.atlas) if args.atlas and is_local_input(args.atlas) else None
+    return representative_xmls(session_dir, atlas_dir)
+
+def cached_sinks(args, entry):
+    """
+        Adds a cached session to the dataset and catalogue, which live outside the output directory, from the
+        deposition values kept in its cache entry. Like the dataset and catalogue stages, a failure is recorded
+        and the harvest carries on.
+    """
+    sinks = entry["result"].get("sinks")
+    if not sinks or not (args.dataset_dir or args.catalogue):
+        return
+    tables = {"session": entry["session"], "session_path": session_path(args), "values": sinks["values"],
+              "nested_dict": sinks["nested_dict"]}
+    stages = []
+    if args.dataset_dir:
+        stages.append(("dataset", lambda: append_deposition_record(
+            tables["nested_dict"], tables["session"], args.dataset_dir,
+            dataset_columns(MMCIF_ITEMS, TOMO_MMCIF_ITEMS, MOVIE_MMCIF_ITEMS), args.dataset_format,
+            tables["session_path"])))
+    if args.catalogue:
+        stages.append(("catalogue", lambda: upsert_session(args.catalogue, tables, {"presets": sinks["presets"]},
+                                                           args)))
+    for name, run in stages:
+        try:
+            with stage(name):
+                run()
+        except Exception as e:
+            if failures.fail_fast:
+                raise
+            failures.record("stage", name, e)
+
+def report_session(args, validation, total_wall_s):
+    """
+        Logs the one line summary of the harvested session.
+    """
+    session_dir = session_directory(args)
+    validation = validation or {}
+    # Throughput of the session, with --timeline
+    throughput = {}
+    if main.timeline:
+        throughput = dict(images_per_hour=main.timeline["images_per_hour"], pauses=main.timeline["pauses"],
+                          paused_h=main.timeline["paused_h"])
+    log_session_summary(session=os.path.basename(os.path.abspath(session_dir)) if session_dir else '?',
+                        mode=args.mode, category=args.category,
+                        micrographs=main.mic_count if main.mic_count is not None else '?',
+                        valid=validation.get("valid", '?'), errors=len(validation.get("errors", [])),
+                        warnings=len(validation.get("warnings", [])), cached=main.cached, failures=len(failures),
+                        **throughput,
+                        wall_s=round(total_wall_s, 3), output_dir=args.output_dir)
+
+def report_failures(args):
+    """
+        Writes the files, fields and stages that failed during the harvest to <session>_errors.json.
+    """
+    session = getattr(save_deposition_file, "session", None)
+    if not session:
+        session_dir = session_directory(args)
+        session = os.path.basename(os.path.abspath(session_dir)) if session_dir else 'emharvest'
+    os.makedirs(args.output_dir, exist_ok=True)
+    report_path = failures.write_report(args.output_dir, session)
+    counts = failures.report()["counts"]
+    # Missing fields are common, failed files and stages are worth a warning
+    level = logging.WARNING if failures.count(scopes=("file", "stage")) else logging.INFO
+    logger.log(level, "Harvest completed with %d failed items (%s), see %s", len(failures),
+               ", ".join(f"{count} {scope} {reason}" for scope, reasons in counts.items()
+                         for reason, count in reasons.items()), report_path)
+
+def report_profile(args, total_wall_s):
+    """
+        Prints the stage summary table and writes it as JSON next to the harvested files.
+    """
+    session_dir = session_directory(args)
+    name = os.path.basename(os.path.abspath(session_dir)) if session_dir else 'emharvest'
+    profiler.print_summary(title=f"Harvest profile: {name} ({total_wall_s:.3f} s)")
+    profile_path = profiler.write_json(os.path.join(args.output_dir, name + '_profile.json'),
+                                       extra={"session": name, "mode": args.mode, "category": args.category,
+                                              "total_wall_s": total_wall_s})
+    logger.info("Profile saved to %s", profile_path)
+
+def resolve_session_inputs(args):
+    """
+        Resolves EPU session and atlas files given as tar/zip archives or object store folders to their
+        EpuSession.dm and ScreeningSession.dm, and turns off the options that need the session on disk.
+    """
+    if not (args.mode == "SPA" and args.category == "epu" and args.epu and args.atlas):
+        return
+    args.epu = resolve_input(args.epu, "EpuSession.dm")
+    args.atlas = resolve_input(args.atlas, "ScreeningSession.dm")
+    if is_local_input(args.epu):
+        return
+    for option in LOCAL_ONLY_OPTIONS:
+        if getattr(args, option):
+            logger.warning("--%s needs the session on disk, skipped for %s", option, args.epu)
+            setattr(args, option, False)
+
+def session_directory(args):
+    """
+        Returns the directory holding the raw session data for the selected mode and category.
+    """
+    if args.mode == "SPA" and args.category == "epu":
+        return input_dirname(args.epu)
+    if args.mode == "SPA" and args.category == "epu_no_dm":
+        return input_dirname(args.input_file)
+    if args.mdoc_file:
+        return input_dirname(args.mdoc_file)
+    return None
+
+def session_path(args):
+    """
+        Returns the absolute session directory, which tells sessions sharing a name apart.
+    """
+    session_dir = session_directory(args)
+    return input_abspath(session_dir) if session_dir else None
 
 def get_output_folder_name(path):
     parts = path.lstrip(os.sep).split(os.sep)  # Split path into parts
@@ -125,7 +455,7 @@ def roundup(n, decimals=0):
 
 def print_epu_xml(xml_path: Path) -> Dict[str, Any]:
     # Use this function for troubleshooting/viewing the raw xml to find data structure
-    with open(xml_path, "r") as xml:
+    with open_input(xml_path) as xml:
         for_parsing = xml.read()
         data = xmltodict.parse(for_parsing)
     data = data["EpuSessionXml"]
@@ -136,11 +466,15 @@ def print_epu_xml(xml_path: Path) -> Dict[str, Any]:
 
 def getXmlMag(xml_path: Path) -> Dict[str, Any]:
     try:
-        with open(xml_path, "r") as xml:
+        with open_input(xml_path) as xml:
             for_parsing = xml.read()
             data = xmltodict.parse(for_parsing)
         data = data["MicroscopeImage"]
-    except:
+    except (OSError, ExpatError, KeyError) as e:
+        if failures.fail_fast:
+            raise
+        failures.record("field", f"{xml_path}:NominalMagnification", e,
+                        message=f"{type(e).__name__}: {e}, using magnification 0")
         xmlMag = 0
         xmlAPix = 0
     else:
@@ -153,12 +487,58 @@ def getXmlMag(xml_path: Path) -> Dict[str, Any]:
     return xmlMag, str(xmlAPix)
 
 
+def preset_image_files(atlas_data: Dict[str, Any], tile_data: Dict[str, Any]) -> Dict[str, Any]:
+    # Magnifications are not stored in the epu session file, they are read from an image xml of each preset
+    return {
+        'Atlas': atlas_data["xmlAtlas"],
+        'GridSquare': tile_data["xmlSquare"],
+        'Hole': tile_data["xmlHole"],
+        'Acquisition': tile_data["xmlData"],
+    }
+
+
+def read_preset_images(files: Dict[str, Any]) -> Dict[str, Any]:
+    """
+        Reads the magnification and pixel size of each preset image xml, concurrently.
+
+        Args:
+            files (dict): Preset name mapped to its image xml, as returned by preset_image_files.
+
+        Returns:
+            dict: Image xml path mapped to the (magnification, pixel size) read by getXmlMag.
+    """
+    paths = sorted({path for path in files.values() if path})
+    if not paths:
+        return {}
+    # Each read mostly waits on storage, so the images are opened at the same time
+    with ThreadPoolExecutor(max_workers=min(len(paths), PRESET_READ_WORKERS)) as executor:
+        return dict(zip(paths, executor.map(getXmlMag, paths)))
+
+
 # def xml_presets(xml_path: Path) -> Dict[str, Any]:
-def xml_presets(xml_path: Path, atlas_data: Dict[str, Any], tile_data: Dict[str, Any]) -> Dict[str, Any]:
-    with open(xml_path, "r") as xml:
-        for_parsing = xml.read()
-        data = xmltodict.parse(for_parsing)
-    data = data["EpuSessionXml"]
+def xml_presets(xml_path: Path, atlas_data: Dict[str, Any], tile_data: Dict[str, Any]) -> pd.DataFrame:
+    """
+        Gathers the microscope presets of an EPU session.
+
+        Args:
+            xml_path (Path): The EPU session xml.
+            atlas_data (dict): The atlas search result (searchSupervisorAtlas).
+            tile_data (dict): The data search result (searchSupervisorData).
+
+        Returns:
+            pd.DataFrame: One row per preset, indexed by preset name. The Acquisition preset values are also
+            kept as attributes of xml_presets (e.g. xml_presets.spot).
+    """
+    # Resolve the preset image xml files and start reading them before the session xml is parsed
+    image_files = preset_image_files(atlas_data, tile_data)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        images = executor.submit(read_preset_images, image_files)
+
+        with open_input(xml_path) as xml:
+            for_parsing = xml.read()
+            data = xmltodict.parse(for_parsing)
+        data = data["EpuSessionXml"]
+        image_mags = images.result()
 
     ## Presets
     # Loop through the presets in the Microscope Settings list
@@ -170,44 +550,16 @@ def xml_presets(xml_path: Path, atlas_data: Dict[str, Any], tile_data: Dict[str,
         "c:CameraSpecificInput"]["KeyValuePairs"]["KeyValuePairOfstringanyType"]
     lengthCam = len(camera)
 
-    # Create list for gathering preset conditions for reporting
-    # DEV DEV DEV might be more flexible to have these going into dataframe
-    namePresetList = []
-    probePresetList = []
-    magPresetList = []
-    apixPresetList = []
-    spotPresetList = []
-    c2PresetList = []
-    beamDPresetList = []
-    defocusPresetList = []
-    timePresetList = []
-    binPresetList = []
+    # Gather the preset conditions for reporting, one row per preset
+    rows = []
 
     # Loop to gather all microscope presets used for session
     for x in range(0, length):
         name = data["Samples"]["_items"]["SampleXml"][0]["MicroscopeSettings"]["KeyValuePairs"][
             "KeyValuePairOfExperimentSettingsIdMicroscopeSettingsCG2rZ1D8"][x]["key"]
 
-        # Get magnifications from image xml, they are not stored in the epu session file
-        if name == 'Atlas':
-            if atlas_data["xmlAtlas"]:
-                mag = getXmlMag(atlas_data["xmlAtlas"])[0]
-                apix = getXmlMag(atlas_data["xmlAtlas"])[1]
-        elif name == 'GridSquare':
-            if tile_data["xmlSquare"]:
-                mag = getXmlMag(tile_data["xmlSquare"])[0]
-                apix = getXmlMag(tile_data["xmlSquare"])[1]
-        elif name == 'Hole':
-            if tile_data["xmlHole"]:
-                mag = getXmlMag(tile_data["xmlHole"])[0]
-                apix = getXmlMag(tile_data["xmlHole"])[1]
-        elif name == 'Acquisition':
-            if tile_data["xmlData"]:
-                mag = getXmlMag(tile_data["xmlData"])[0]
-                apix = getXmlMag(tile_data["xmlData"])[1]
-        else:
-            mag = 0
-            apix = 0
+        # Presets without an image xml have no magnification
+        mag, apix = image_mags.get(image_files.get(name), (0, 0))
 
         probeMode = data["Samples"]["_items"]["SampleXml"][0]["MicroscopeSettings"]["KeyValuePairs"][
             "KeyValuePairOfExperimentSettingsIdMicroscopeSettingsCG2rZ1D8"][x]["value"]["b:Optics"]["c:ProbeMode"]
@@ -253,28 +605,12 @@ def xml_presets(xml_path: Path, atlas_data: Dict[str, Any], tile_data: Dict[str,
         apix = roundup(float(apix), 3)
 
         # Report presets or continue silentily
-        print(name)
-        print('Nominal magnification: ' + str(mag) + ' X')
-        print('Pixel size: ' + str(apix) + ' apix')
-        print('Probe mode: ' + str(probeMode))
-        print('Spot: ' + str(spot))
-        print('C2 apeture: ' + str(c2) + ' microns')
-        print('Beam diameter: ' + str(beamDmicron) + ' microns')
-        print('Defocus: ' + str(DFmicron) + ' microns')
-        print('Exposure time: ' + str(time) + ' seconds')
-        print('')
-
-        # Append presets to the preset lists for reporting
-        namePresetList.append(name)
-        magPresetList.append(mag)
-        apixPresetList.append(apix)
-        probePresetList.append(probeMode)
-        spotPresetList.append(spot)
-        c2PresetList.append(c2)
-        beamDPresetList.append(beamDmicron)
-        defocusPresetList.append(DFmicron)
-        timePresetList.append(time)
-        binPresetList.append(epuBin)
+        logger.debug("%s: nominal magnification %s X, pixel size %s apix, probe mode %s, spot %s, "
+                     "C2 aperture %s microns, beam diameter %s microns, defocus %s microns, exposure time %s seconds",
+                     name, mag, apix, probeMode, spot, c2, beamDmicron, DFmicron, time)
+
+        rows.append(dict(name=name, mag=mag, apix=apix, probe=probeMode, spot=spot, C2=c2, beamD=beamDmicron,
+                         defocus=DFmicron, time=time, epuBin=epuBin))
 
         # Gather main params for reporting
         if name == 'Acquisition':
@@ -291,25 +627,17 @@ def xml_presets(xml_path: Path, atlas_data: Dict[str, Any], tile_data: Dict[str,
         if name == 'AutoFocus':
             xml_presets.beamDAutoFocus = beamDmicron
 
-        # Gather all presets for mass reporting
-        xml_presets.namePresetList = namePresetList
-        xml_presets.magPresetList = magPresetList
-        xml_presets.apixPresetList = apixPresetList
-        xml_presets.probePresetList = probePresetList
-        xml_presets.spotPresetList = spotPresetList
-        xml_presets.c2PresetList = c2PresetList
-        xml_presets.beamDPresetList = beamDPresetList
-        xml_presets.defocusPresetList = defocusPresetList
-        xml_presets.timePresetList = timePresetList
-        xml_presets.binPresetList = binPresetList
+    # Gather all presets for mass reporting
+    xml_presets.presets = pd.DataFrame(rows, columns=PRESET_COLUMNS).set_index('name')
 
     # report complete
-    print('Finished gathering all microscope presets')
+    logger.info('Finished gathering all microscope presets')
+    return xml_presets.presets
 
 
 def xml_presets_data(micpath: Path) -> Dict[str, Any]:
     # This will fetch the first micrograph xml data
-    with open(micpath, "r") as xml:
+    with open_input(micpath) as xml:
         for_parsing = xml.read()
         data = xmltodict.parse(for_parsing)
     data = data["MicroscopeImage"]
@@ -320,6 +648,7 @@ def xml_presets_data(micpath: Path) -> Dict[str, Any]:
 
     # Loop through the list to find the SuperResolutionFactor list position
     i = 0
+    j = None
     for value in keyValueList:
         key = data["microscopeData"]["acquisition"]["camera"]["CameraSpecificInput"]["a:KeyValueOfstringanyType"][i][
             "a:Key"]
@@ -331,26 +660,21 @@ def xml_presets_data(micpath: Path) -> Dict[str, Any]:
         superResBin = \
         data["microscopeData"]["acquisition"]["camera"]["CameraSpecificInput"]["a:KeyValueOfstringanyType"][j][
             "a:Value"]["#text"]
-    except:
+    except (KeyError, IndexError, TypeError):
+        failures.record("field", f"{micpath}:SuperResolutionFactor", reason="missing_key",
+                        message="no SuperResolutionFactor in the xml, using 'Unknown'")
         superResBin = 'Unknown'
 
     ## Energy filter
     # Known error in nt29493-49 - glacios
-    try:
-        filterSlit = data["microscopeData"]["optics"]["EnergyFilter"]["EnergySelectionSlitInserted"]
-    except:
-        filterSlit = 'None'
-    else:
-        filterSlit = data["microscopeData"]["optics"]["EnergyFilter"]["EnergySelectionSlitInserted"]
-    try:
-        filterSlitWidth = data["microscopeData"]["optics"]["EnergyFilter"]["EnergySelectionSlitWidth"]
-    except:
-        filterSlitWidth = 'None'
-    else:
-        filterSlitWidth = data["microscopeData"]["optics"]["EnergyFilter"]["EnergySelectionSlitWidth"]
+    filterSlit = xml_value(data, "microscopeData", "optics", "EnergyFilter", "EnergySelectionSlitInserted",
+                           default='None', source=micpath)
+    filterSlitWidth = xml_value(data, "microscopeData", "optics", "EnergyFilter", "EnergySelectionSlitWidth",
+                                default='None', source=micpath)
 
     # Aperture(s)
     # Loop through the list to find the Objective aperture list position
+    objectiveAperture = '?'
     i = 0
     for value in keyValueList:
         key = data["CustomData"]["a:KeyValueOfstringanyType"][i]["a:Key"]
@@ -378,7 +702,7 @@ def xml_presets_data(micpath: Path) -> Dict[str, Any]:
 
 def getStageTilt(micpath: Path) -> Dict[str, Any]:
     # This will fetch the first micrograph xml data
-    with open(micpath, "r") as xml:
+    with open_input(micpath) as xml:
         for_parsing = xml.read()
         data = xmltodict.parse(for_parsing)
     data = data["MicroscopeImage"]
@@ -390,9 +714,20 @@ def getStageTilt(micpath: Path) -> Dict[str, Any]:
     return [stageAlpha, stageBeta]
 
 
+# Labels of the xml_session values reported at debug level
+SESSION_REPORT = [('EPU version', 'epuVersion'), ('Dose fraction output', 'doseFractionOutputFormat'),
+                  ('EPU Session', 'sessionName'), ('EPU Session date', 'sessionDate'),
+                  ('EPU Session path', 'realPath'), ('Clustering mode', 'clustering'),
+                  ('Clustering radius', 'clusteringRadius'), ('Focus mode', 'focusWith'),
+                  ('Focus recurrance', 'focusRecurrence'), ('Autoloader slot', 'autoSlot'),
+                  ('Atlas directory', 'atlasDir'), ('Defocus max', 'defocusMax'), ('Defocus min', 'defocusMin'),
+                  ('Image shift delay', 'delayImageShift'), ('Stage shift delay', 'delayStageShift'),
+                  ('Grid type', 'gridType'), ('I0 set', 'I0set'), ('I0 max', 'I0MaxInt'), ('I0 min', 'I0MinInt')]
+
+
 def xml_session(xml_path: Path) -> pd.DataFrame:
     data_dict = {}
-    with open(xml_path, "r") as xml:
+    with open_input(xml_path) as xml:
         first_line = xml.readline().strip()  # Read only the first line to extract version
         xml.seek(0) # Reset file pointer to read full content
         for_parsing = xml.read()
@@ -400,7 +735,7 @@ def xml_session(xml_path: Path) -> pd.DataFrame:
     data = data["EpuSessionXml"]
 
     # Location of EPU session directory on which this script was ran
-    data_dict['realPath'] = os.path.realpath(xml_path)
+    data_dict['realPath'] = os.path.realpath(xml_path) if is_local_input(xml_path) else xml_path
 
     # EPU version (old way of harvesting EPU Version, did not work well when harvested from Epusession.dm files)
     # epuId = data["Version"]["@z:Id"]
@@ -440,28 +775,18 @@ def xml_session(xml_path: Path) -> pd.DataFrame:
     data_dict['sessionDate'] = sessionDateFormat
 
     # Grid type - lacey or holeycarbon or holeygold
-    try:
-        data_dict['gridType'] = data["Samples"]["_items"]["SampleXml"][0]["GridType"]
-    except:
-        data_dict['gridType'] = 'Unknown'
+    sample = data["Samples"]["_items"]["SampleXml"][0]
+    data_dict['gridType'] = xml_value(sample, "GridType", default='Unknown', source=xml_path)
 
     # The I0 filter settings may hint at what grid type is being used
-    try:
-        data_dict['I0set'] = data["Samples"]["_items"]["SampleXml"][0]["FilterHolesSettings"]["IsCalibrated"]
-    except:
-        data_dict['I0set'] = 'Unknown'
-
-    try:
-        data_dict['I0MaxInt'] = round(
-            float(data["Samples"]["_items"]["SampleXml"][0]["FilterHolesSettings"]["MaximumIntensity"]))
-    except:
-        data_dict['I0MaxInt'] = 'Unknown'
+    data_dict['I0set'] = xml_value(sample, "FilterHolesSettings", "IsCalibrated", default='Unknown', source=xml_path)
 
-    try:
-        data_dict['I0MinInt'] = round(
-            float(data["Samples"]["_items"]["SampleXml"][0]["FilterHolesSettings"]["MinimumIntensity"]))
-    except:
-        data_dict['I0MinInt'] = 'Unknown'
+    for key, setting in [('I0MaxInt', "MaximumIntensity"), ('I0MinInt', "MinimumIntensity")]:
+        intensity = xml_value(sample, "FilterHolesSettings", setting, default='Unknown', source=xml_path)
+        try:
+            data_dict[key] = round(float(intensity))
+        except (TypeError, ValueError):
+            data_dict[key] = 'Unknown'
 
     # Clustering method
     data_dict['clustering'] = data["ClusteringMode"]
@@ -504,41 +829,18 @@ def xml_session(xml_path: Path) -> pd.DataFrame:
 
     df = pd.DataFrame(data_dict, index=[0])
 
-    # Print to terminal
-    print('EPU version:', data_dict['epuVersion'])
-    print('Dose fraction output:', data_dict['doseFractionOutputFormat'])
-    print('EPU Session:', data_dict['sessionName'])
-    print('EPU Session date:', data_dict['sessionDate'])
-    print('EPU Session path:', data_dict['realPath'])
-    print()
-    print('Clustering mode:', data_dict['clustering'])
-    print('Clustering radius:', data_dict['clusteringRadius'])
-    print('Focus mode:', data_dict['focusWith'])
-    print('Focus recurrance:', data_dict['focusRecurrence'])
-    print()
-    print('Autoloader slot:', data_dict['autoSlot'])
-    print('Atlas directory:', data_dict['atlasDir'])
-    print()
-    # print('Defocus list:', data_dict['defocus'])
-    print('Defocus max:', data_dict['defocusMax'])
-    print('Defocus min:', data_dict['defocusMin'])
-    print()
-    print('Image shift delay:', data_dict['delayImageShift'])
-    print('Stage shift delay:', data_dict['delayStageShift'])
-    print('Grid type:', data_dict['gridType'])
-    print('I0 set:', data_dict['I0set'])
-    print('I0 max:', data_dict['I0MaxInt'])
-    print('I0 min:', data_dict['I0MinInt'])
-    print()
-    print('\033[1m' + 'Finished gathering metadata from main EPU session file' + '\033[0m')
-    print()
+    # Report the session parameters, only formatted when debug logging is on
+    if logger.isEnabledFor(logging.DEBUG):
+        for label, key in SESSION_REPORT:
+            logger.debug('%s: %s', label, data_dict[key])
+    logger.info('Finished gathering metadata from main EPU session file')
 
     return df
 
 
 def xml_sessionName(xml_path):
     # It is necessary to have a function for getting xml session name elsewhere in script
-    with open(xml_path, "r") as xml:
+    with open_input(xml_path) as xml:
         for_parsing = xml.read()
         data = xmltodict.parse(for_parsing)
     data = data["EpuSessionXml"]
@@ -551,6 +853,10 @@ def xml_sessionName(xml_path):
 def formatEPUDate(d):
     # Returns formatted in datetime, needs to be string for printing
 
+    # EPU writes ISO 8601 timestamps, the wall clock time of which is their first 19 characters
+    if EPU_DATE.match(d):
+        return datetime.datetime.strptime(d[:19], "%Y-%m-%dT%H:%M:%S")
+
     # https://stackoverflow.com/questions/17594298/date-time-formats-in-python
     # https://www.w3schools.com/python/python_datetime.asp
     # https://www.tutorialexample.com/python-detect-datetime-string-format-and-convert-to-different-string-format-python-datetime-tutorial/amp/
@@ -579,8 +885,8 @@ def getDefocusRange(data):
                     "ImageAcquisitionSettingXml"]["Defocus"]["a:double"]
                 # Sometimes the values contain unicode en-dash and not ASCII hyphen
                 # df.replace('\U00002013', '-')
-            except:
-                print('Warning, could not find defocus range in xml file')
+            except (KeyError, IndexError, TypeError):
+                logger.warning('Could not find defocus range in xml file')
                 df = ['xml read error']
         else:
             try:
@@ -589,8 +895,8 @@ def getDefocusRange(data):
                     "ImageAcquisitionSettingXml"]["Defocus"]["a:_items"]["a:double"]
                 # Sometimes the values contain unicode en-dash and not ASCII hyphen
             # df.replace('\U00002013', '-')
-            except:
-                print('Warning, could not find defocus range in xml file')
+            except (KeyError, IndexError, TypeError):
+                logger.warning('Could not find defocus range in xml file')
                 df = ['xml read error']
     else:
         shotType = 'Single'
@@ -605,8 +911,8 @@ def getDefocusRange(data):
                     "ImageAcquisitionSettingXml"]["Defocus"]["a:double"]
                 # Sometimes the values contain unicode en-dash and not ASCII hyphen
                 # df.replace('\U00002013', '-')
-            except:
-                print('Warning, could not find defocus range in xml file')
+            except (KeyError, IndexError, TypeError):
+                logger.warning('Could not find defocus range in xml file')
                 df = ['xml read error']
         else:
             try:
@@ -615,8 +921,8 @@ def getDefocusRange(data):
                     "ImageAcquisitionSettingXml"]["Defocus"]["a:_items"]["a:double"]
                 # Sometimes the values contain unicode en-dash and not ASCII hyphen
                 # df.replace('\U00002013', '-')
-            except:
-                print('Warning, could not find defocus range in xml file')
+            except (KeyError, IndexError, TypeError):
+                logger.warning('Could not find defocus range in xml file')
                 df = ['xml read error']
 
     getDefocusRange.shotType = shotType
@@ -641,37 +947,45 @@ def find_mics(path, search):
     # Need to have an independent function to find the mics, then move into search_mics to sort them out
     # So find mics can be used independently
 
-    print('Looking for micrograph data in EPU directory using extension: ' + search)
+    logger.info('Looking for micrograph data in EPU directory using extension: %s', search)
 
     # Old method of finding xml files
-    searchedFiles = glob.glob(path + "/**/GridSquare*/Data/*" + search + '*')
+    searchedFiles = glob_inputs(path + DATA_FOLDERS + "/*" + search + '*')
     # searchedFiles = glob.iglob(main.epu+"/Images-Disc1/GridSquare*/Data/*"+search)
     if searchedFiles:
-        print('Found micrograph data: ' + str(len(searchedFiles)))
+        logger.info('Found micrograph data: %d', len(searchedFiles))
     else:
-        print('No micrographs found with search term: ' + search)
+        logger.warning('No micrographs found with search term: %s', search)
         searchedFiles = 'exit'
 
     return searchedFiles
 
 
-def deposition_file(xml):
-    tile_data = searchSupervisorData(os.path.dirname(args.epu))
-    # Get EPU session name from main EPU xml file, this is a function
-    main_sessionName = xml_sessionName(xml)
+def deposition_record(tile_data, presets, objective, masterdf, mic_count, foilhole_data, movies=None):
+    """
+        Combines the parsed EPU session, presets and acquisition metadata into the deposition record.
+
+        With a movie header summary (movie_headers), the frames per movie, movie dimensions and compression
+        are added to the record.
+
+        Returns:
+            dict: The complete data dictionary written by save_deposition_file.
+    """
+    # Get EPU session name from the parsed EPU session
+    main_sessionName = df_lookup(masterdf, 'sessionName')
     # This is the data xml metadata file already in a dictionary
     data = tile_data["xmlDataDict"]["MicroscopeImage"]
     # aqu_data = tile_data["xmlDataDict"]["MicroscopeImage"]
-    software_version = df_lookup(main.masterdf, 'epuVersion')
-    date = df_lookup(main.masterdf, 'sessionDate').strftime("%Y-%m-%d %H:%M:%S")
-    nominal_defocus_min_microns = df_lookup(main.masterdf, 'defocusMin')
-    nominal_defocus_max_microns = df_lookup(main.masterdf, 'defocusMax')
-    collection = df_lookup(main.masterdf, 'afisMode')
-    number_of_images = main.mic_count
-    spot_size = xml_presets.spot
-    C2_micron = xml_presets.C2
-    Objective_micron = str(xml_presets_data.objective)
-    Beam_diameter_micron = xml_presets.beamD
+    software_version = df_lookup(masterdf, 'epuVersion')
+    date = df_lookup(masterdf, 'sessionDate').strftime("%Y-%m-%d %H:%M:%S")
+    nominal_defocus_min_microns = df_lookup(masterdf, 'defocusMin')
+    nominal_defocus_max_microns = df_lookup(masterdf, 'defocusMax')
+    collection = df_lookup(masterdf, 'afisMode')
+    number_of_images = mic_count
+    spot_size = presets["spot"]
+    C2_micron = presets["C2"]
+    Objective_micron = str(objective)
+    Beam_diameter_micron = presets["beamD"]
 
     # Get mag
     xmlMag = data["microscopeData"]["optics"]["TemMagnification"]["NominalMagnification"]
@@ -694,12 +1008,12 @@ def deposition_file(xml):
     microscope_mode = data["microscopeData"]["optics"]["ColumnOperatingTemSubMode"]
     # illumination = data["microscopeData"]["optics"]["IlluminationMode"]
 
-    grid_type = df_lookup(main.masterdf, 'gridType')
+    grid_type = df_lookup(masterdf, 'gridType')
     grid_parts = re.findall(r'[A-Z][a-z]*', grid_type)
 
     # Now, parts will be ['Holey', 'Carbon']
-    grid_topology = grid_parts[0]
-    grid_material = grid_parts[1]
+    grid_topology = grid_parts[0] if grid_parts else '?'
+    grid_material = grid_parts[1] if len(grid_parts) > 1 else '?'
 
     EpuDataDict = dict(main_sessionName=main_sessionName, xmlMag=xmlMag, xmlMetrePix=xmlMetrePix, xmlAPix=xmlAPix,
                        model=model, microscope_serial_number=microscope_serial_number, eV=eV, microscope_mode=microscope_mode, grid_topology=grid_topology,
@@ -710,11 +1024,9 @@ def deposition_file(xml):
                        collection=collection, number_of_images=number_of_images, spot_size=spot_size,
                        C2_micron=C2_micron, Objective_micron=Objective_micron,
                        Beam_diameter_micron=Beam_diameter_micron, illumination="?",
-                       PixelSpacing="?", SubFramePath="?")
+                       PixelSpacing="?", SubFramePath="?", presets=presets["table"])
 
-    FoilHoleDataDict = FoilHoleData(tile_data["xmlData"])
-    CompleteDataDict = {**EpuDataDict, **FoilHoleDataDict}
-    save_deposition_file(CompleteDataDict)
+    return {**EpuDataDict, **foilhole_data, **(movie_record(movies) if movies else {})}
 
 
 def df_lookup(df, column):
@@ -731,45 +1043,207 @@ def df_lookup(df, column):
     """
     return df[column][0]
 
-def perform_minimal_harvest_epu(xml_path, output_dir):
-    # Before running full eminsight analysis, look for all image files, via xml, mrc or jpg
-    # This will declare global searchSupervisorData variables with the file lists, for xml, mrc and jpg
-    # searchSupervisorAtlas(main.atlas_directory)
-    # searchSupervisorData(main.epu_directory)
-    # Get presets for EPU session xml
-    print('')
-    print('\033[1m' + 'Finding all presets from EPU session:' + '\033[0m')
-    print('')
-    atlas_folder = os.path.dirname(args.atlas)
-    atlas_root = os.path.dirname(atlas_folder)
-    atlas_data = searchSupervisorAtlas(atlas_folder)
-
-    tile_folder = os.path.dirname(args.epu)
-    tile_data = searchSupervisorData(tile_folder)
-
-    xml_presets(xml_path, atlas_data, tile_data)
+def presets_stage(xml_path, atlas_data, tile_data):
+    """Parses the EPU presets, returning the acquisition preset values used in the deposition record."""
+    presets = xml_presets(xml_path, atlas_data, tile_data)
+    return {"spot": xml_presets.spot, "C2": xml_presets.C2, "beamD": xml_presets.beamD,
+            "table": presets.reset_index().to_dict("records")}
 
-    # Get presets specific to acqusition magnifcation which are only contained in an acqusition image xml
-    tile_file = os.path.join(tile_folder, tile_data["xmlData"])
 
+def presets_data_stage(tile_data):
+    """Parses the presets only stored in an acquisition image xml, returning the objective aperture."""
     xml_presets_data(tile_data["xmlData"])
+    return xml_presets_data.objective
 
-    # Get main set up parameters from EPU session xml
-    print('')
-    print('\033[1m' + 'Finding main EPU session parameters:' + '\033[0m')
-    print('')
-
-    main.masterdf = xml_session(xml_path)
 
-    grid_folder = os.path.dirname(args.epu)
+def count_mics(grid_folder):
     searchedFiles = find_mics(grid_folder, 'xml')
     if searchedFiles == 'exit':
-        print("exiting due to not finding any image xml data")
-        exit()
-    main.mic_count = len(searchedFiles)
-    # Create a deposition file
-    deposition_file(xml_path)
+        # Raised rather than exit(), which would only end the stage thread
+        raise FileNotFoundError(f"No image xml data found in {grid_folder}")
+    return len(searchedFiles)
 
 
+def count_mics_incremental(grid_folder, state):
+    """
+        Counts the micrographs like count_mics, only listing the Data folders changed since the last harvest.
+    """
+    logger.info('Looking for micrograph data in EPU directory using extension: xml')
+    mic_count, state["images"], new = scan_images(grid_folder, state["images"], 'xml')
+    if not mic_count:
+        raise FileNotFoundError(f"No image xml data found in {grid_folder}")
+    logger.info('Found micrograph data: %d (%d new since the last harvest)', mic_count, new)
+    return mic_count
+
+
+def optics_groups_stage(args):
+    """Returns the stage writing the beam shift optics groups, only for AFIS sessions."""
+    def write_optics_groups(epu_folder, tables, record):
+        # session_optics_groups skips the session when the collection of the record is not AFIS
+        return session_optics_groups(epu_folder, args.output_dir, tables["session"], groups=args.optics_groups,
+                                     record=record, depth=args.prefetch_depth, cs_mm=args.optics_cs,
+                                     amplitude_contrast=args.optics_amplitude_contrast)
+    return write_optics_groups
+
+
+def mrc_summary_stage(output_dir):
+    """Returns the stage writing the MRC header summary, once checked against the xml pixel size."""
+    def write_summary(summary, record, tables):
+        check_pixel_size(summary, record.get("xmlAPix"))
+        return write_mrc_summary(summary, output_dir, tables["session"])
+    return write_summary
+
+
+def epu_stage_graph(args, state=None):
+    """
+        Builds the stage graph of an EPU session harvest.
+
+        The inputs of the graph are the artifacts epu_xml, epu_folder and atlas_folder.
+
+        Args:
+            args (argparse.Namespace): The parsed command line arguments.
+            state (dict, optional): The session state of an incremental harvest (see session_state).
+
+        The summaries, dataset and catalogue stages are optional: the deposition files are written even when
+        one of them fails.
+
+        Returns:
+            StageGraph: The harvest stages, ending with the validation of the deposition mmCIF file.
+    """
+    graph = StageGraph(workers=args.workers, artifact_dir=args.artifact_dir)
+    graph.add("atlas_search", searchSupervisorAtlas, ["atlas_folder"], ["atlas_data"])
+    graph.add("data_search", searchSupervisorData, ["epu_folder"], ["tile_data"])
+    # Get presets for EPU session xml
+    graph.add("xml_presets", presets_stage, ["epu_xml", "atlas_data", "tile_data"], ["presets"])
+    # Get presets specific to acqusition magnifcation which are only contained in an acqusition image xml
+    graph.add("xml_presets_data", presets_data_stage, ["tile_data"], ["objective"])
+    # Get main set up parameters from EPU session xml
+    graph.add("xml_session", xml_session, ["epu_xml"], ["masterdf"])
+    if state is not None:
+        graph.add("find_mics", lambda epu_folder: count_mics_incremental(epu_folder, state), ["epu_folder"],
+                  ["mic_count"])
+    else:
+        graph.add("find_mics", count_mics, ["epu_folder"], ["mic_count"])
+    graph.add("foilhole_data", lambda tile_data: FoilHoleData(tile_data["xmlData"]), ["tile_data"], ["foilhole"])
+    record_inputs = ["tile_data", "presets", "objective", "masterdf", "mic_count", "foilhole"]
+    # Movie headers are walked while the XMLs are parsed, and add their frame counts to the record
+    if args.movie_headers:
+        movies = file_cache(state, "movies")
+        graph.add("movie_headers", lambda epu_folder: inspect_session_movies(epu_folder, MOVIE_READ_WORKERS, movies),
+                  ["epu_folder"], ["movies"])
+        record_inputs.append("movies")
+    graph.add("deposition_record", deposition_record, record_inputs, ["record"])
+    graph.add("deposition_tables", lambda record: deposition_tables(record, args), ["record"], ["tables"])
+    graph.add("write_csv", lambda tables: write_deposition_csv(tables, args.output_dir), ["tables"], ["csv_path"])
+    graph.add("write_json", lambda tables: write_deposition_json(tables, args.output_dir), ["tables"], ["json_path"])
+    graph.add("checksum", write_deposition_checksum, ["json_path"], ["checksum_path"])
+    # Facility-wide columnar dataset, one row per harvested session
+    if args.dataset_dir:
+        graph.add("dataset", lambda tables: append_deposition_record(
+            tables["nested_dict"], tables["session"], args.dataset_dir,
+            dataset_columns(MMCIF_ITEMS, TOMO_MMCIF_ITEMS, MOVIE_MMCIF_ITEMS), args.dataset_format,
+            tables["session_path"]), ["tables"], ["dataset_path"],
+            optional=True)
+    # Facility-wide catalogue, queried with emharvest query
+    if args.catalogue:
+        graph.add("catalogue", lambda tables, record: upsert_session(args.catalogue, tables, record, args),
+                  ["tables", "record"], ["catalogue_row"], optional=True)
+    if args.movie_headers:
+        graph.add("write_movie_summary", lambda movies, tables: write_movie_summary(movies, args.output_dir,
+                                                                                   tables["session"]),
+                  ["movies", "tables"], ["movie_summary_path"], optional=True)
+    # Acquisition throughput from the timestamp of every acquisition image xml
+    if args.timeline:
+        timestamps = file_cache(state, "timeline")
+        graph.add("timeline", lambda epu_folder: epu_timeline(epu_folder, depth=args.prefetch_depth,
+                                                              cache=timestamps),
+                  ["epu_folder"], ["timeline"], optional=True)
+        graph.add("write_timeline", lambda timeline, tables: timeline and write_timeline(timeline, args.output_dir,
+                                                                                        tables["session"]),
+                  ["timeline", "tables"], ["timeline_path"], optional=True)
+    # Target geometry from the stage position of every GridSquare, FoilHole and acquisition xml
+    if args.spatial:
+        graph.add("spatial", lambda epu_folder, masterdf: session_spatial_summary(epu_folder, masterdf,
+                                                                                  depth=args.prefetch_depth),
+                  ["epu_folder", "masterdf"], ["spatial"], optional=True)
+        graph.add("write_spatial", lambda spatial, tables: write_spatial_summary(spatial, args.output_dir,
+                                                                                 tables["session"]),
+                  ["spatial", "tables"], ["spatial_path"], optional=True)
+    # Per-image statistics from a stratified sample of the acquisition xmls, or all of them in small sessions
+    if args.sample or args.time_budget:
+        graph.add("statistics", lambda epu_folder: session_statistics(epu_folder, sample=args.sample,
+                                                                      time_budget=args.time_budget,
+                                                                      depth=args.prefetch_depth),
+                  ["epu_folder"], ["statistics"], optional=True)
+        graph.add("write_statistics", lambda statistics, tables: statistics and write_session_statistics(
+            statistics, args.output_dir, tables["session"]), ["statistics", "tables"], ["statistics_path"],
+            optional=True)
+    # Beam shift optics groups for downstream processing of AFIS sessions
+    if args.optics_groups is not None:
+        graph.add("optics_groups", optics_groups_stage(args), ["epu_folder", "tables", "record"],
+                  ["optics_path"], optional=True)
+    # Header-only MRC reads, cross-checked against the xml pixel size of the record
+    if args.mrc_headers:
+        mrcs = file_cache(state, "mrcs")
+        graph.add("mrc_headers", lambda epu_folder: inspect_session_mrcs(epu_folder, MRC_READ_WORKERS, mrcs),
+                  ["epu_folder"], ["mrc_summary"], optional=True)
+        graph.add("write_mrc_summary", mrc_summary_stage(args.output_dir), ["mrc_summary", "record", "tables"],
+                  ["mrc_summary_path"], optional=True)
+    graph.add("write_cif", lambda tables: write_deposition_cif(tables, args.output_dir), ["tables"], ["cif_path"])
+    graph.add("validation", lambda cif_path, tables: validate_deposition_cif(args, cif_path, tables["session"]),
+              ["cif_path", "tables"], ["validation"])
+    return graph
+
+
+def perform_minimal_harvest_epu(xml_path, output_dir):
+    # Before running full eminsight analysis, look for all image files, via xml, mrc or jpg
+    # The stage graph searches the atlas and data folders once and runs the independent stages concurrently
+    logger.info('Finding all presets and main parameters from EPU session')
+    epu_folder = input_dirname(args.epu)
+    state = load_session_state(output_dir, epu_folder) if args.incremental and not args.stages else None
+    graph = epu_stage_graph(args, state)
+    unknown = [name for name in args.stages or [] if name not in graph.stages]
+    if unknown:
+        logger.error("Unknown stages %s, expected any of %s", ", ".join(unknown), ", ".join(graph.stages))
+        exit(1)
+
+    artifacts = {"epu_xml": xml_path, "epu_folder": epu_folder, "atlas_folder": input_dirname(args.atlas)}
+    targets = args.stages
+    if state is not None:
+        inputs = input_stamps(args.epu, args.atlas)
+        if state["record"] and state["inputs"] == inputs:
+            # Only images were added since the last harvest, update the last deposition record and rewrite it
+            logger.info('EPU session files unchanged since the last harvest, updating the deposition record')
+            with stage("find_mics"):
+                mic_count = count_mics_incremental(epu_folder, state)
+            artifacts["mic_count"] = mic_count
+            artifacts["record"] = {**state["record"], "number_of_images": mic_count}
+            if args.movie_headers:
+                # New movies change the frame totals, only their headers are read
+                with stage("movie_headers"):
+                    artifacts["movies"] = inspect_session_movies(epu_folder, MOVIE_READ_WORKERS,
+                                                                 file_cache(state, "movies"))
+                artifacts["record"].update(movie_record(artifacts["movies"]))
+            targets = graph.downstream("record")
+    artifacts = graph.run(artifacts, targets=targets)
+
+    main.masterdf = artifacts.get("masterdf")
+    main.mic_count = artifacts.get("mic_count")
+    main.timeline = artifacts.get("timeline")
+    if "tables" in artifacts:
+        # Files written for this session, reused from the result cache when nothing changed
+        save_deposition_file.session = artifacts["tables"]["session"]
+        save_deposition_file.outputs = deposition_outputs(output_dir, save_deposition_file.session)
+        save_deposition_file.sinks = sink_inputs(artifacts["tables"], artifacts["record"])
+        for summary_path in ("mrc_summary_path", "movie_summary_path", "timeline_path", "spatial_path", "statistics_path",
+                             "optics_path"):
+            if artifacts.get(summary_path):
+                save_deposition_file.outputs.append(artifacts[summary_path])
+    if state is not None and "record" in artifacts:
+        state["record"] = artifacts["record"]
+        state["inputs"] = inputs
+        save_session_state(output_dir, state)
+    return artifacts.get("validation")
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from xml.parsers.expat import ExpatError
+
+# A file read taking longer than this is given up, so one hung NFS read can not stall a harvest
+DEFAULT_FILE_TIMEOUT_S = 120
+# Further attempts of a read failing with a transient error, e.g. a stale NFS handle
+DEFAULT_RETRIES = 2
+# Wait before the first retry, doubled for every further retry
+DEFAULT_BACKOFF_S = 0.5
+# Failures kept with their full details in the error report, the rest are only counted
+MAX_REPORTED = 1000
+# Reasons that may not recur in the next harvest
+TRANSIENT_REASONS = ("timeout", "io_error")
+# OSErrors that will not go away by trying again
+PERMANENT_ERRORS = (FileNotFoundError, IsADirectoryError, NotADirectoryError, PermissionError)
+
+logger = logging.getLogger(__name__)
+
+
+def failure_reason(error):
+    """
+        Classifies an exception into the reason recorded in the error report.
+
+        Returns:
+            str: timeout, missing_file, permission, io_error, invalid_xml, missing_key, invalid_value or error.
+    """
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    if isinstance(error, (FileNotFoundError, IsADirectoryError, NotADirectoryError)):
+        return "missing_file"
+    if isinstance(error, PermissionError):
+        return "permission"
+    if isinstance(error, OSError):
+        return "io_error"
+    if isinstance(error, ExpatError):
+        return "invalid_xml"
+    if isinstance(error, (KeyError, IndexError)):
+        return "missing_key"
+    if isinstance(error, (ValueError, TypeError)):
+        return "invalid_value"
+    return "error"
+
+
+def is_transient(error):
+    """True for errors worth retrying: timeouts and I/O errors other than missing files and permissions."""
+    return isinstance(error, OSError) and not isinstance(error, PERMANENT_ERRORS)
+
+
+class FailureLog:
+    """
+        Collects the files, fields and stages that failed during a harvest, so it can carry on without them.
+
+        Every failure is recorded with its scope (file, field or stage), its target (a path, a field of a file
+        or a stage name), a reason from failure_reason and the error message. The failures are written to an
+        error report next to the harvested files at the end of the run. Fields filled in with a default are
+        only logged at INFO, as many sessions lack some of them.
+
+        With fail_fast, files and optional stages that fail stop the harvest instead, as before failures were
+        isolated.
+    """
+
+    def __init__(self):
+        self.file_timeout_s = DEFAULT_FILE_TIMEOUT_S
+        self.retries = DEFAULT_RETRIES
+        self.backoff_s = DEFAULT_BACKOFF_S
+        self.fail_fast = False
+        self._entries = []
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def configure(self, file_timeout_s=DEFAULT_FILE_TIMEOUT_S, retries=DEFAULT_RETRIES,
+                  backoff_s=DEFAULT_BACKOFF_S, fail_fast=False):
+        self.file_timeout_s = file_timeout_s or None
+        self.retries = max(0, retries or 0)
+        self.backoff_s = backoff_s
+        self.fail_fast = fail_fast
+
+    def clear(self):
+        with self._lock:
+            self._entries = []
+            self._counts = Counter()
+
+    def record(self, scope, target, error=None, reason=None, attempts=1, message=None):
+        """
+            Records a failure and logs it, as a warning unless it is a field.
+
+            Args:
+                scope (str): file, field or stage.
+                target (str): The file, field (<file>:<path/of/keys>) or stage that failed.
+                error (Exception, optional): The error, classified with failure_reason.
+                reason (str, optional): The reason, when there is no error to classify.
+                attempts (int, optional): The attempts made before giving up.
+                message (str, optional): The message, the error message by default.
+        """
+        reason = reason or failure_reason(error)
+        message = message or (f"{type(error).__name__}: {error}" if error is not None else reason)
+        with self._lock:
+            self._counts[(scope, reason)] += 1
+            if len(self._entries) < MAX_REPORTED:
+                self._entries.append({"scope": scope, "target": str(target), "reason": reason, "message": message,
+                                      "attempts": attempts, "time": round(time.time(), 3)})
+        logger.log(logging.INFO if scope == "field" else logging.WARNING, "Skipped %s %s (%s): %s", scope, target,
+                   reason, message)
+
+    def __len__(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    def count(self, scopes=None, reasons=None):
+        """The failures of the given scopes and reasons, all of them by default."""
+        with self._lock:
+            return sum(count for (scope, reason), count in self._counts.items()
+                       if (scopes is None or scope in scopes) and (reasons is None or reason in reasons))
+
+    def entries(self):
+        with self._lock:
+            return list(self._entries)
+
+    def report(self):
+        """
+            Returns:
+                dict: The number of failures, counted per scope and reason, and the first MAX_REPORTED
+                    failures with their details.
+        """
+        with self._lock:
+            counts = {}
+            for (scope, reason), count in sorted(self._counts.items()):
+                counts.setdefault(scope, {})[reason] = count
+            return {"failures": sum(self._counts.values()), "counts": counts, "entries": list(self._entries)}
+
+    def write_report(self, output_dir, session):
+        """Writes the report to <session>_errors.json, returning its path."""
+        path = os.path.join(output_dir, session + '_errors.json')
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=4)
+        return path
+
+
+failures = FailureLog()
+
+
+def with_retries(func, *args, retries=None, backoff_s=None):
+    """
+        Calls func(*args), trying again after transient errors (see is_transient) with exponential backoff.
+
+        Args:
+            func (callable): The call to make, e.g. a file read.
+            retries (int, optional): Further attempts after the first. Defaults to the configured retries.
+            backoff_s (float, optional): Wait before the first retry, doubled for every further retry, with up
+                to 50% random jitter so parallel readers do not retry in step. Defaults to the configured
+                backoff.
+
+        Returns:
+            tuple: (result of func, attempts made). The last error is raised with an attempts attribute once
+                every attempt failed.
+    """
+    retries = failures.retries if retries is None else retries
+    backoff_s = failures.backoff_s if backoff_s is None else backoff_s
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return func(*args), attempt
+        except Exception as e:
+            if attempt > retries or not is_transient(e):
+                e.attempts = attempt
+                raise
+            delay = backoff_s * 2 ** (attempt - 1) * (1 + random.random() / 2)
+            logger.debug("Attempt %d of %s failed (%s), retrying in %.2f s", attempt, args[0] if args else func,
+                         e, delay)
+            time.sleep(delay)
+
+
+def xml_value(data, *keys, default="?", source=None):
+    """
+        Looks up a value in an xml parsed with xmltodict, e.g. xml_value(data, "microscopeData", "gun",
+        "Sourcetype").
+
+        A missing key is recorded as a field failure of source and gives default rather than raising, so one
+        incomplete xml leaves a field of the deposition unknown instead of stopping the harvest.
+
+        Returns:
+            The value, default when any of the keys is missing.
+    """
+    value = data
+    for key in keys:
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            failures.record("field", f"{source}:{'/'.join(str(key) for key in keys)}", reason="missing_key",
+                            message=f"no {key!r} in the xml, using {default!r}")
+            return default
+    return value
@@ -1,21 +1,36 @@
 import xmltodict
 import math
 
+from emharvest.failures import xml_value
+from emharvest.sources import open_input
+
+def _degrees(radians):
+    """A stage angle in degrees, '?' when it is unknown."""
+    try:
+        return round(float(radians) * (180 / math.pi), 5)
+    except (TypeError, ValueError):
+        return "?"
+
+
 # def FoilHoleData(xmlpath: Path) -> Dict[str, Any]:
 def FoilHoleData(xmlpath):
     # This will fetch the first micrograph xml data
-    with open(xmlpath, "r") as xml:
+    with open_input(xmlpath) as xml:
         for_parsing = xml.read()
         data = xmltodict.parse(for_parsing)
     data = data["MicroscopeImage"]
 
-    sessionName = data["uniqueID"]
+    # A missing value is recorded in the failure log and left unknown ('?'), rather than stopping the harvest
+    sessionName = xml_value(data, "uniqueID", source=xmlpath)
 
     # The values are not always in the same list position in a:KeyValueOfstringanyType
-    keyValueList = data["CustomData"]["a:KeyValueOfstringanyType"]
+    keyValueList = xml_value(data, "CustomData", "a:KeyValueOfstringanyType", default=[], source=xmlpath)
 
-    keyMicroscopeList = data["microscopeData"]["acquisition"]["camera"]["CameraSpecificInput"][
-        "a:KeyValueOfstringanyType"]
+    keyMicroscopeList = xml_value(data, "microscopeData", "acquisition", "camera", "CameraSpecificInput",
+                                  "a:KeyValueOfstringanyType", default=[], source=xmlpath)
+    # xmltodict gives a single entry as a dict rather than a list of one
+    keyValueList, keyMicroscopeList = [entries if isinstance(entries, list) else [entries]
+                                       for entries in (keyValueList, keyMicroscopeList)]
 
     # Loop through the list to find the DoseRate list position
     keyvalue = 0
@@ -26,35 +41,30 @@ def FoilHoleData(xmlpath):
     ]
 
     for i, value in enumerate(keyValueList):
-        key = data["CustomData"]["a:KeyValueOfstringanyType"][i]["a:Key"]
+        key = value.get("a:Key")
 
         if key == "Detectors[BM-Falcon].DoseRate" or key == "Detectors[EF-Falcon].DoseRate":
             keyvalue = i
 
         if key in detector_keys:
-            detectorName = data["CustomData"]["a:KeyValueOfstringanyType"][i]["a:Value"]["#text"]
+            detectorName = xml_value(value, "a:Value", "#text", default="", source=xmlpath)
             if detectorName == "BioQuantum K3":
                 detectorName = "GATAN K3 BIOQUANTUM (6k x 4k)"
             elif detectorName == "Falcon 4i":
                 detectorName = "TFS FALCON 4i (4k x 4k)"
 
         if key == "Aperture[OBJ].Name":
-            objectiveAperture = data["CustomData"]["a:KeyValueOfstringanyType"][i]["a:Value"]["#text"]
+            objectiveAperture = xml_value(value, "a:Value", "#text", source=xmlpath)
             if objectiveAperture == "None":
                 objectiveAperture = '?'
 
     for i, value in enumerate(keyMicroscopeList):
-        keyMicroscopeData = \
-        data["microscopeData"]["acquisition"]["camera"]["CameraSpecificInput"]["a:KeyValueOfstringanyType"][i]["a:Key"]
+        keyMicroscopeData = value.get("a:Key")
         if keyMicroscopeData == "ElectronCountingEnabled":
-            counting = \
-            data["microscopeData"]["acquisition"]["camera"]["CameraSpecificInput"]["a:KeyValueOfstringanyType"][i][
-                "a:Value"]["#text"]
+            counting = xml_value(value, "a:Value", "#text", default="", source=xmlpath)
 
         if keyMicroscopeData == "SuperResolutionFactor":
-            superResolution = \
-            data["microscopeData"]["acquisition"]["camera"]["CameraSpecificInput"]["a:KeyValueOfstringanyType"][i][
-                "a:Value"]["#text"]
+            superResolution = xml_value(value, "a:Value", "#text", default="", source=xmlpath)
 
     if counting == "true":
         if superResolution == "1":
@@ -65,16 +75,17 @@ def FoilHoleData(xmlpath):
     # Retrieve the values
     # xmlDoseRate = data["CustomData"]["a:KeyValueOfstringanyType"][keyvalue]["a:Value"]["#text"]
     xmlDoseRate = "?"  # the data file has only electron_dose on camera and not the dose used on the specimen
-    avgExposureTime = data["microscopeData"]["acquisition"]["camera"]["ExposureTime"]
-    slitWid = data["microscopeData"]["optics"]["EnergyFilter"]["EnergySelectionSlitWidth"]
-    slitInserted = data["microscopeData"]["optics"]["EnergyFilter"]["EnergySelectionSlitInserted"]
+    avgExposureTime = xml_value(data, "microscopeData", "acquisition", "camera", "ExposureTime", source=xmlpath)
+    slitWid = xml_value(data, "microscopeData", "optics", "EnergyFilter", "EnergySelectionSlitWidth", source=xmlpath)
+    slitInserted = xml_value(data, "microscopeData", "optics", "EnergyFilter", "EnergySelectionSlitInserted",
+                             source=xmlpath)
     if slitInserted == "true":
         slitWidth = slitWid
     else:
         slitWidth = "?"
-    electronSource = data["microscopeData"]["gun"]["Sourcetype"]
-    tiltAngleMin = round(float(data["microscopeData"]["stage"]["Position"]["A"]) * (180 / math.pi), 5)
-    tiltAngleMax = round(float(data["microscopeData"]["stage"]["Position"]["B"]) * (180 / math.pi), 5)
+    electronSource = xml_value(data, "microscopeData", "gun", "Sourcetype", source=xmlpath)
+    tiltAngleMin = _degrees(xml_value(data, "microscopeData", "stage", "Position", "A", source=xmlpath))
+    tiltAngleMax = _degrees(xml_value(data, "microscopeData", "stage", "Position", "B", source=xmlpath))
 
     FoilHoleDataDict = dict(sessionName=sessionName, xmlDoseRate=xmlDoseRate, detectorName=detectorName,
                             avgExposureTime=avgExposureTime, detectorMode=detectorMode, slitWidth=slitWidth,
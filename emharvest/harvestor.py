@@ -1,7 +1,12 @@
+import logging
+
 from emharvest.foilHole_data import FoilHoleData
 from emharvest.xml_data_harvest import AnyXMLDataFile
 from emharvest.save_deposition_file import save_deposition_file
 from emharvest.tomo_mdoc_data import TomoMdocData
+from emharvest.profiling import stage
+
+logger = logging.getLogger(__name__)
 
 def perform_serialEM_harvest(mdoc_file, output_dir):
     """
@@ -12,12 +17,13 @@ def perform_serialEM_harvest(mdoc_file, output_dir):
             output_dir (str): The directory where the harvested data will be saved.
 
         Returns:
-            None
+            dict: The structured mmCIF validation result.
     """
-    print(f"Processing serialEM data from file: {mdoc_file}")
-    print(f"Output will be saved to: {output_dir}")
+    logger.info("Processing serialEM data from file: %s", mdoc_file)
+    logger.info("Output will be saved to: %s", output_dir)
 
-    serialEMDataDict = TomoMdocData(mdoc_file)
+    with stage("mdoc_data"):
+        serialEMDataDict = TomoMdocData(mdoc_file)
 
     main_sessionName = "SerialEM_microscopy_data"
 
@@ -38,7 +44,8 @@ def perform_serialEM_harvest(mdoc_file, output_dir):
 
     SerialEMSPATOMODataDict = {**EpuDataDict, **serialEMDataDict}
 
-    save_deposition_file(SerialEMSPATOMODataDict)
+    with stage("save_deposition"):
+        return save_deposition_file(SerialEMSPATOMODataDict)
 
 def perform_tomogram_harvest(tomogram_file, mdoc_file, output_dir):
     """
@@ -50,12 +57,13 @@ def perform_tomogram_harvest(tomogram_file, mdoc_file, output_dir):
             output_dir (str): The directory where the harvested data will be saved.
 
         Returns:
-            None
+            dict: The structured mmCIF validation result.
     """
-    print(f"Processing tomogram data from file: {tomogram_file} and {mdoc_file}")
-    print(f"Output will be saved to: {output_dir}")
+    logger.info("Processing tomogram data from file: %s and %s", tomogram_file, mdoc_file)
+    logger.info("Output will be saved to: %s", output_dir)
 
-    FoilDataDict = FoilHoleData(tomogram_file)
+    with stage("foilhole_data"):
+        FoilDataDict = FoilHoleData(tomogram_file)
     FoilDataDict['tiltAngleMax'] = "?"
     FoilDataDict['tiltAngleMin'] = "?"
     main_sessionName = FoilDataDict["sessionName"]
@@ -67,15 +75,18 @@ def perform_tomogram_harvest(tomogram_file, mdoc_file, output_dir):
 
     TomoOverViewDataDict = {**FoilDataDict, **EpuDataDict}
 
-    OverViewDataDict = AnyXMLDataFile(tomogram_file)
+    with stage("xml_data"):
+        OverViewDataDict = AnyXMLDataFile(tomogram_file)
     TomoDataDict = {**TomoOverViewDataDict, **OverViewDataDict}
 
-    TomoMdocDataDict = TomoMdocData(mdoc_file)
+    with stage("mdoc_data"):
+        TomoMdocDataDict = TomoMdocData(mdoc_file)
 
     TomoDataDict['xmlMag'] = int(TomoMdocDataDict['Magnification'])
     CompleteTomoDataDict = {**TomoDataDict, **TomoMdocDataDict}
 
-    save_deposition_file(CompleteTomoDataDict)
+    with stage("save_deposition"):
+        return save_deposition_file(CompleteTomoDataDict)
 
 def perform_spa_harvest_nonepu(input_spa_file, output_dir):
     """
@@ -86,12 +97,13 @@ def perform_spa_harvest_nonepu(input_spa_file, output_dir):
             output_dir (str): The directory where the harvested data will be saved.
 
         Returns:
-            None
+            dict: The structured mmCIF validation result.
     """
-    print(f"Processing tomogram data from file: {input_spa_file}")
-    print(f"Output will be saved to: {output_dir}")
+    logger.info("Processing tomogram data from file: %s", input_spa_file)
+    logger.info("Output will be saved to: %s", output_dir)
 
-    SPADataDict = FoilHoleData(input_spa_file)
+    with stage("foilhole_data"):
+        SPADataDict = FoilHoleData(input_spa_file)
     main_sessionName = SPADataDict["sessionName"]
 
     EpuDataDict = dict(main_sessionName=main_sessionName, grid_topology="?", grid_material="?",
@@ -99,10 +111,12 @@ def perform_spa_harvest_nonepu(input_spa_file, output_dir):
                        collection="?", number_of_images="?", spot_size="?", C2_micron="?", Objective_micron="?",
                        Beam_diameter_micron="?")
 
-    NonEpuDataDict = AnyXMLDataFile(input_spa_file)
+    with stage("xml_data"):
+        NonEpuDataDict = AnyXMLDataFile(input_spa_file)
 
     SPATotalDataDict = {**SPADataDict, **EpuDataDict}
 
     CompleteSPADataDict = {**SPATotalDataDict, **NonEpuDataDict}
 
-    save_deposition_file(CompleteSPADataDict)
+    with stage("save_deposition"):
+        return save_deposition_file(CompleteSPADataDict)
@@ -0,0 +1,80 @@
+import sys
+import json
+import logging
+import datetime
+
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+SUMMARY_LOGGER = "emharvest.summary"
+
+# LogRecord attributes that are not extra fields passed by the caller
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+        Formats each record as one JSON object per line, including any extra fields passed to the logger.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=None, quiet=False, json_format=False, stream=None):
+    """
+        Sets up the emharvest loggers, replacing any handler installed by an earlier call.
+
+        Without an explicit level, harvests run from a terminal log progress at INFO. When the output is
+        piped or redirected (batch runs), only warnings, errors and the one line session summary are logged.
+
+        Args:
+            level (str, optional): One of LOG_LEVELS, overrides the default level.
+            quiet (bool, optional): Only log warnings and errors, without the session summary.
+            json_format (bool, optional): Write one JSON object per record instead of plain text.
+            stream (file, optional): Where to log to. Defaults to stderr.
+
+        Returns:
+            logging.Logger: The package logger.
+    """
+    stream = stream or sys.stderr
+    if level:
+        level = logging.getLevelName(level.upper())
+    elif quiet:
+        level = logging.WARNING
+    else:
+        level = logging.INFO if stream.isatty() else logging.WARNING
+
+    handler = logging.StreamHandler(stream)
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+    logger = logging.getLogger("emharvest")
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    # The summary is the only output of a default batch run
+    logging.getLogger(SUMMARY_LOGGER).setLevel(logging.WARNING if quiet else min(level, logging.INFO))
+    return logger
+
+
+def log_session_summary(**fields):
+    """
+        Logs the one line summary of a harvested session, the fields are also passed as JSON fields.
+    """
+    message = " ".join(f"{key}={value}" for key, value in fields.items())
+    logging.getLogger(SUMMARY_LOGGER).info(message, extra=fields)
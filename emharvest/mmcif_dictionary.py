@@ -0,0 +1,368 @@
+import os
+import re
+import json
+import time
+import logging
+import urllib.error
+import urllib.request
+
+from gemmi import cif
+
+from emharvest.checksum_manifest import sha256_file
+
+# Categories written by the harvester, only these are compiled into the index
+HARVEST_CATEGORIES = ["em_imaging", "em_image_recording", "em_image_scans", "em_software", "em_support_film",
+                      "em_imaging_optics", "em_tomography", "em_map"]
+# Bumped whenever the compiled categories or layout change, so cached indexes are compiled again
+INDEX_FORMAT = 2
+INDEX_FILENAME = "mmcif_em_index.json"
+DICTIONARY_URL = "https://mmcif.wwpdb.org/dictionaries/ascii/mmcif_pdbx_v50.dic"
+DICTIONARY_MAX_AGE_DAYS = 7
+
+# Compiled type regexes are shared by every validation in the process
+_TYPE_REGEX_CACHE = {}
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_dir():
+    """
+        Returns the local cache directory for compiled dictionary data.
+
+        Returns:
+            str: $EMHARVEST_CACHE_DIR, else $XDG_CACHE_HOME/emharvest, else ~/.cache/emharvest.
+    """
+    env_path = os.environ.get("EMHARVEST_CACHE_DIR")
+    if env_path:
+        return env_path
+    xdg_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(xdg_cache, "emharvest")
+
+
+def default_index_path(cache_dir=None):
+    return os.path.join(cache_dir or default_cache_dir(), INDEX_FILENAME)
+
+
+def _values(frame, tag):
+    """Returns every value of a tag in a save frame as plain strings, whether it is a pair or a loop."""
+    column = frame.find_values(tag)
+    return [cif.as_string(v) for v in column if not cif.is_null(v)]
+
+
+def _value(frame, tag):
+    values = _values(frame, tag)
+    return values[0] if values else None
+
+
+def compile_dictionary(dic_path, categories=None):
+    """
+        Extracts the category and item definitions used by the harvester from a PDBx dictionary.
+
+        Args:
+            dic_path (str): The path to the full mmcif_pdbx_v50.dic dictionary.
+            categories (list, optional): Categories to keep. Defaults to HARVEST_CATEGORIES.
+
+        Returns:
+            dict: A serializable index with version metadata, type constructs and per item
+            type, enumeration and range definitions.
+    """
+    categories = set(categories or HARVEST_CATEGORIES)
+    block = cif.read(dic_path).sole_block()
+
+    index = {
+        "format": INDEX_FORMAT,
+        "dictionary": {
+            "title": cif.as_string(block.find_value("_dictionary.title") or ""),
+            "version": cif.as_string(block.find_value("_dictionary.version") or ""),
+        },
+        "source": {
+            "path": os.path.abspath(dic_path),
+            "sha256": sha256_file(dic_path),
+            "size": os.path.getsize(dic_path),
+            "mtime_ns": os.stat(dic_path).st_mtime_ns,
+        },
+        "compiled": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "types": {},
+        "categories": {},
+    }
+
+    for row in block.find("_item_type_list.", ["code", "primitive_code", "construct"]):
+        index["types"][cif.as_string(row[0])] = {"primitive": cif.as_string(row[1]),
+                                                 "construct": cif.as_string(row[2])}
+
+    for item in block:
+        frame = item.frame
+        if frame is None:
+            continue
+        category_id = _value(frame, "_category.id")
+        if category_id is not None:
+            if category_id in categories:
+                entry = index["categories"].setdefault(category_id, {"items": {}})
+                entry["mandatory"] = _value(frame, "_category.mandatory_code") == "yes"
+                entry["keys"] = _values(frame, "_category_key.name")
+            continue
+
+        names = _values(frame, "_item.name")
+        if not names:
+            continue
+        item_categories = _values(frame, "_item.category_id")
+        mandatory = _values(frame, "_item.mandatory_code")
+        definition = {
+            "type": _value(frame, "_item_type.code"),
+            "enumeration": _values(frame, "_item_enumeration.value"),
+            "ranges": [[cif.as_string(r[0]), cif.as_string(r[1])]
+                       for r in frame.find("_item_range.", ["minimum", "maximum"])],
+        }
+        for n, name in enumerate(names):
+            category_id = item_categories[n] if n < len(item_categories) else name.lstrip("_").split(".")[0]
+            if category_id not in categories:
+                continue
+            entry = index["categories"].setdefault(category_id, {"items": {}, "mandatory": False, "keys": []})
+            item_definition = dict(definition)
+            item_definition["mandatory"] = (mandatory[n] if n < len(mandatory) else "no") == "yes"
+            entry["items"][name] = item_definition
+
+    return index
+
+
+def save_index(index, index_path):
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, index_path)
+
+
+def load_index(index_path):
+    """
+        Loads a compiled dictionary index.
+
+        Args:
+            index_path (str): The path to the compiled index.
+
+        Returns:
+            dict: The index, or None when missing, unreadable or in an older format.
+    """
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get("format") != INDEX_FORMAT:
+        return None
+    return index
+
+
+def download_dictionary(dic_path):
+    """
+        Downloads the latest dictionary from wwPDB to dic_path, replacing it only once the download completes.
+
+        Returns:
+            bool: False when the download failed, e.g. offline, the dictionary already at dic_path is kept.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dic_path)), exist_ok=True)
+    logger.info("Downloading mmCIF dictionary to %s", dic_path)
+    tmp_path = f"{dic_path}.tmp{os.getpid()}"
+    try:
+        urllib.request.urlretrieve(DICTIONARY_URL, tmp_path)
+        os.replace(tmp_path, dic_path)
+    except (urllib.error.URLError, OSError) as e:
+        logger.warning("Could not download the mmCIF dictionary (%s), using the one available locally", e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
+
+
+def ensure_dictionary_index(dic_path, index_path=None, download=False):
+    """
+        Returns a compiled index for the harvested categories, downloading and compiling only when needed.
+
+        The index is recompiled when the dictionary on disk differs from the one it was built from.
+        A download is only attempted when requested and the cached index is missing or older than
+        DICTIONARY_MAX_AGE_DAYS, so repeated runs work offline.
+
+        Args:
+            dic_path (str): Where the full dictionary is, or will be downloaded to.
+            index_path (str, optional): Where the compiled index is cached. Defaults to default_index_path().
+            download (bool, optional): Allow fetching the latest dictionary from wwPDB.
+
+        Returns:
+            dict: The compiled index, or None if no dictionary or index is available.
+    """
+    index_path = index_path or default_index_path()
+    index = load_index(index_path)
+
+    stale = index is None or time.time() - os.path.getmtime(index_path) > DICTIONARY_MAX_AGE_DAYS * 86400
+    # Offline, the cached index or the dictionary on disk is used
+    downloaded = download and stale and download_dictionary(dic_path)
+
+    if os.path.isfile(dic_path):
+        st = os.stat(dic_path)
+        source = index["source"] if index else {}
+        # Only hash the dictionary again when its size or mtime moved
+        changed = index is None or source.get("size") != st.st_size or (
+            source.get("mtime_ns") != st.st_mtime_ns and source.get("sha256") != sha256_file(dic_path))
+        if changed:
+            logger.info("Compiling mmCIF dictionary subset from %s", dic_path)
+            index = compile_dictionary(dic_path)
+            save_index(index, index_path)
+        elif downloaded:
+            # Same dictionary, refresh the cache age so the next runs skip the download
+            os.utime(index_path)
+    return index
+
+
+def _type_regex(index, type_code):
+    construct = index["types"].get(type_code, {}).get("construct")
+    if not construct:
+        return None
+    if construct not in _TYPE_REGEX_CACHE:
+        try:
+            _TYPE_REGEX_CACHE[construct] = re.compile(construct, re.DOTALL)
+        except re.error:
+            _TYPE_REGEX_CACHE[construct] = None
+    return _TYPE_REGEX_CACHE[construct]
+
+
+def _in_ranges(value, ranges):
+    """
+        Checks a value against the _item_range rows of an item, following DDL2: a row whose minimum equals its
+        maximum allows that one value, other rows exclude both their bounds. A '.' bound is unbounded.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        return False
+    for minimum, maximum in ranges:
+        low = float(minimum) if minimum not in (".", "?") else float("-inf")
+        high = float(maximum) if maximum not in (".", "?") else float("inf")
+        if number == low if low == high else low < number < high:
+            return True
+    return False
+
+
+def _check_value(index, block_name, tag, raw_value, line, errors, warnings):
+    """Checks one value of a pair or a loop column against its item definition."""
+    category_id = tag.lstrip("_").split(".")[0]
+    category = index["categories"].get(category_id)
+    definition = category["items"].get(tag) if category else None
+    if definition is None:
+        warnings.append({"item": tag, "line": line, "message": f"[{block_name}] unknown tag {tag}"})
+        return False
+    if cif.is_null(raw_value):
+        return True
+    value = cif.as_string(raw_value)
+    if definition["enumeration"] and value not in definition["enumeration"]:
+        errors.append({"item": tag, "line": line,
+                       "message": f"[{block_name}] {value} is not one of the allowed values: "
+                                  + ", ".join(definition["enumeration"])})
+        return True
+    regex = _type_regex(index, definition["type"])
+    if regex is not None and not regex.fullmatch(value):
+        errors.append({"item": tag, "line": line,
+                       "message": f"[{block_name}] {value} does not match the {definition['type']} regex"})
+        return True
+    if definition["ranges"] and not _in_ranges(value, definition["ranges"]):
+        errors.append({"item": tag, "line": line,
+                       "message": f"[{block_name}] value out of expected range: {value}"})
+    return True
+
+
+def _check_categories(index, block_name, present, errors):
+    """
+        Checks that every category of a block has its mandatory items and its category keys.
+
+        Args:
+            present (dict): Category mapped to {tag: line of its first use} for the tags of the block.
+    """
+    for category_id, tags in present.items():
+        category = index["categories"].get(category_id)
+        if category is None:
+            continue
+        line = min(tags.values(), default=None)
+        mandatory = [name for name, definition in category["items"].items() if definition["mandatory"]]
+        for name in mandatory:
+            if name not in tags:
+                errors.append({"item": name, "line": line,
+                               "message": f"[{block_name}] missing mandatory tag: {name}"})
+        # Keys are mandatory items in the PDBx dictionary, undefined keys are left to the full validation
+        for name in category["keys"]:
+            if name not in tags and name not in mandatory and name in category["items"]:
+                errors.append({"item": name, "line": line,
+                               "message": f"[{block_name}] missing category key: {name}"})
+
+
+def _check_loop_keys(index, block_name, loop, line, errors):
+    """Reports rows of a loop repeating the category key values of an earlier row."""
+    category_id = loop.tags[0].lstrip("_").split(".")[0]
+    category = index["categories"].get(category_id)
+    if category is None or not category["keys"]:
+        return
+    lowered = [tag.lower() for tag in loop.tags]
+    columns = [lowered.index(name.lower()) for name in category["keys"] if name.lower() in lowered]
+    if len(columns) != len(category["keys"]):
+        return
+    seen = set()
+    for row in range(loop.length()):
+        key = tuple(cif.as_string(loop[row, column]) for column in columns)
+        if key in seen:
+            errors.append({"item": category["keys"][0], "line": line,
+                           "message": f"[{block_name}] duplicated key in {category_id}: {', '.join(key)}"})
+        seen.add(key)
+
+
+def validate_with_index(cif_file, index, output_file=None):
+    """
+        Validates the harvested categories of an mmCIF file against a compiled dictionary index.
+
+        The values of pairs and loop columns are checked against the type, enumeration and ranges of their
+        items, the categories of every block must hold their mandatory items and category keys, and the keys
+        of a loop must not repeat.
+
+        Args:
+            cif_file (str): Path to the mmCIF file.
+            index (dict): The compiled index from ensure_dictionary_index.
+            output_file (str, optional): Path to save the validation messages.
+
+        Returns:
+            dict: valid (bool), errors and warnings (lists of {item, line, message}) and a summary
+            message, the same layout as mmcif_validation.
+    """
+    errors, warnings = [], []
+    doc = cif.read(cif_file)
+    for block in doc:
+        present = {}
+        for item in block:
+            if item.pair is not None:
+                tag, raw_value = item.pair
+                present.setdefault(tag.lstrip("_").split(".")[0], {}).setdefault(tag, item.line_number)
+                _check_value(index, block.name, tag, raw_value, item.line_number, errors, warnings)
+            elif item.loop is not None:
+                loop = item.loop
+                for column, tag in enumerate(loop.tags):
+                    present.setdefault(tag.lstrip("_").split(".")[0], {}).setdefault(tag, item.line_number)
+                    for row in range(loop.length()):
+                        if not _check_value(index, block.name, tag, loop[row, column], item.line_number, errors,
+                                            warnings):
+                            break
+                _check_loop_keys(index, block.name, loop, item.line_number, errors)
+        _check_categories(index, block.name, present, errors)
+
+    dictionary = index["dictionary"]
+    result = {"valid": not errors, "errors": errors, "warnings": warnings,
+              "dictionary_version": dictionary["version"]}
+    if output_file:
+        with open(output_file, "w") as outfile:
+            outfile.write(f"# {dictionary['title']} {dictionary['version']} (compiled subset)\n")
+            for entry in errors + warnings:
+                outfile.write(entry["message"] + "\n")
+
+    if result["valid"]:
+        result["message"] = f"Validation succeeded with {len(warnings)} warnings"
+    else:
+        result["message"] = f"Validation failed with {len(errors)} errors and {len(warnings)} warnings"
+    if output_file:
+        result["message"] += f". Results saved to {output_file}"
+    logger.log(logging.INFO if result["valid"] else logging.WARNING, result["message"])
+    return result
@@ -1,45 +1,149 @@
 import os
-import subprocess
+import re
+import logging
+import threading
 
-def mmcif_validation(cif_file, dic_file, output_file):
+from gemmi import cif
+
+DEFAULT_DICTIONARY_NAME = "mmcif_pdbx_v50.dic"
+
+# Parsed dictionaries are kept for the lifetime of the worker process, keyed by absolute path and mtime
+_DDL_CACHE = {}
+_DDL_LOCK = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+# Messages about values breaking the dictionary rules, anything else reported by gemmi is a warning
+_ERROR_PATTERNS = ("is not one of the allowed values", "out of expected range", "does not match",
+                   "missing mandatory", "not a number", "unexpected")
+_MESSAGE_LINE = re.compile(r'^(?:(?P<source>[^\s\[]+):(?P<line>\d+) )?\[(?P<block>[^\]]*)\] (?P<text>.*)$')
+_MESSAGE_TAG = re.compile(r'(_[A-Za-z0-9_\[\]-]+\.[A-Za-z0-9_\[\]-]+)')
+
+
+def _discard(message):
+    """Logger for the shared validator while it is not validating."""
+
+
+def default_dictionary_path():
     """
-    Validates an mmCIF file using the Gemmi validate command and saves the output to a file.
+    Returns the dictionary location used when none is given.
+
+    The EMHARVEST_MMCIF_DICT environment variable takes precedence over the
+    mmcif_dictionary folder of the current working directory.
+    """
+    env_path = os.environ.get("EMHARVEST_MMCIF_DICT")
+    if env_path:
+        return env_path
+    return os.path.join(os.getcwd(), "mmcif_dictionary", DEFAULT_DICTIONARY_NAME)
+
+
+def load_dictionary(dic_file):
+    """
+    Parses an mmCIF dictionary into a gemmi DDL validator, once per process.
+
+    Parameters:
+    dic_file (str): Path to the dictionary file.
+
+    Returns:
+    gemmi.cif.Ddl: The validator, reused for every later call with the same unchanged file.
+    """
+    key = os.path.abspath(dic_file)
+    mtime = os.path.getmtime(key)
+    with _DDL_LOCK:
+        cached = _DDL_CACHE.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        ddl = cif.Ddl(logger=_discard, print_unknown_tags=True)
+        ddl.read_ddl(cif.read(key))
+        _DDL_CACHE[key] = (mtime, ddl)
+        return ddl
+
+
+def _item_lines(doc):
+    """Maps each line number of a CIF document to the tag defined on that line."""
+    lines = {}
+    for block in doc:
+        for item in block:
+            if item.pair is not None:
+                lines[item.line_number] = item.pair[0]
+            elif item.loop is not None:
+                for tag in item.loop.tags:
+                    lines.setdefault(item.line_number, tag)
+    return lines
+
+
+def _structure_messages(messages, item_lines):
+    """Splits gemmi validation messages into per item errors and warnings."""
+    errors, warnings = [], []
+    for message in messages:
+        first_line = message.strip().splitlines()[0] if message.strip() else message
+        match = _MESSAGE_LINE.match(first_line)
+        text = match.group("text") if match else first_line
+        line = int(match.group("line")) if match and match.group("line") else None
+        tag_match = _MESSAGE_TAG.search(text)
+        item = tag_match.group(1) if tag_match else item_lines.get(line, "?")
+        entry = {"item": item, "line": line, "message": message.strip()}
+        if any(pattern in text for pattern in _ERROR_PATTERNS):
+            errors.append(entry)
+        else:
+            warnings.append(entry)
+    return errors, warnings
+
+
+def mmcif_validation(cif_file, dic_file=None, output_file=None):
+    """
+    Validates an mmCIF file in-process through the gemmi API and saves the messages to a file.
 
     Parameters:
     cif_file (str): Path to the mmCIF file.
-    dic_file (str): Path to the dictionary file for validation (default: mmcif_pdbx_v50.dic).
-    output_file (str): Path to save the validation output (default: val_TOMO_data.txt).
+    dic_file (str): Path to the dictionary file for validation (default: default_dictionary_path()).
+    output_file (str): Path to save the validation output, skipped when None.
 
     Returns:
-    bool: True if the file is valid, False otherwise.
-    str: Detailed output message from the validation command.
+    dict: valid (bool), errors and warnings (lists of {item, line, message}) and a summary message.
     """
+    dic_file = dic_file or default_dictionary_path()
+    result = {"valid": False, "errors": [], "warnings": [], "message": ""}
+
+    # Ensure input files exist
+    if not os.path.isfile(cif_file):
+        result["message"] = f"Error: Input CIF file '{cif_file}' does not exist."
+        logger.error(result["message"])
+        return result
+    if not os.path.isfile(dic_file):
+        result["message"] = f"Error: Dictionary file '{dic_file}' does not exist. Download it using the option -l yes"
+        logger.error(result["message"])
+        return result
+
     try:
-        # Ensure input files exist
-        if not os.path.isfile(cif_file):
-            return False, f"Error: Input CIF file '{cif_file}' does not exist."
-        if not os.path.isfile(dic_file):
-            return False, f"Error: Dictionary file '{dic_file}' does not exist. Download it using the option -d yes"
-
-        # Construct the Gemmi command
-        command = [
-            "gemmi", "validate", "-v", cif_file, "-d", dic_file
-        ]
-
-        # Execute the command and redirect output to a file
-        with open(output_file, "w") as outfile:
-            result = subprocess.run(command, stdout=outfile, stderr=subprocess.PIPE, text=True, env=os.environ.copy())
+        ddl = load_dictionary(dic_file)
+        doc = cif.read(cif_file)
+        messages = []
+        # The parsed dictionary is shared, so the logger is swapped under the lock
+        with _DDL_LOCK:
+            ddl.set_logger(messages.append)
+            try:
+                valid = ddl.validate_cif(doc)
+            finally:
+                ddl.set_logger(_discard)
+    except (RuntimeError, ValueError, OSError) as e:
+        result["message"] = f"An unexpected error occurred: {str(e)}"
+        logger.error(result["message"])
+        return result
 
-        # Check for errors in stderr or non-zero exit status
-        if result.returncode != 0:
-            print( f"Validation failed with error and output saved to {output_file}")
-            return False
-        if result.stderr.strip():
-            print(f"Validation encountered issues: {result.stderr.strip()}")
-            return False
+    errors, warnings = _structure_messages(messages, _item_lines(doc))
+    result.update(valid=bool(valid) and not errors, errors=errors, warnings=warnings)
 
-        print(f"Validation succeeded. Results saved to {output_file}")
-        return True
+    if output_file:
+        with open(output_file, "w") as outfile:
+            for message in messages:
+                outfile.write(message.rstrip("\n") + "\n")
 
-    except Exception as e:
-        return False, f"An unexpected error occurred: {str(e)}"
+    if result["valid"]:
+        result["message"] = f"Validation succeeded with {len(warnings)} warnings"
+    else:
+        result["message"] = f"Validation failed with {len(errors)} errors and {len(warnings)} warnings"
+    if output_file:
+        result["message"] += f". Results saved to {output_file}"
+    logger.log(logging.INFO if result["valid"] else logging.WARNING, result["message"])
+    return result
@@ -1,7 +1,18 @@
+import os
+import json
+import logging
+import argparse
+
 from mmcif.api.DataCategory import DataCategory
 from mmcif.api.PdbxContainers import DataContainer
 from mmcif.io.PdbxWriter import PdbxWriter
 
+from emharvest.failures import failures
+from emharvest.logs import configure_logging
+from emharvest.prefetch import DEFAULT_DEPTH, Prefetcher
+
+logger = logging.getLogger(__name__)
+
 
 def write_mmcif_file(data_list, sessionName):
     """
@@ -55,72 +66,227 @@ def insert_data(container, category_id, data_list):
         cat_obj.append(data_list)
 
 
-def translate_xml_to_cif(input_data, sessionName):
+def build_cif_layout(input_data):
     """
-    Translates input XML data into a CIF file.
+    Groups the "category.attribute" keys of the input data into an ordered category to attributes layout.
     """
-    from emharvest.emharvest_main import parse_arguments
-    args = parse_arguments()
-
-    if not input_data:
-        return False
-
-    input_data_filtered = {key: value for key, value in input_data.items() if key != "?"}
-    cif_data_list = []
-
-    # Create a dictionary to store container_id with corresponding categories and values
-    container_dict = {}
-
-    # Iterate over the input data and accumulate category names and values
-    for key, value in input_data_filtered.items():
+    layout = {}
+    for key in input_data:
         if isinstance(key, str) and key != "?":
             container_id, category = key.split(".")
-            if container_id not in container_dict:
-                container_dict[container_id] = {}
-            if category not in container_dict[container_id]:
-                container_dict[container_id][category] = [value]
+            attributes = layout.setdefault(container_id, [])
+            if category not in attributes:
+                attributes.append(category)
             else:
                 # Handle duplicate categories if needed
                 pass
+    return layout
 
-    # Add all accumulated categories and values to the CIF container
-    container = add_container(cif_data_list, sessionName)
 
-    for category_name, categories_values in container_dict.items():
-        category_list = []
+def convert_cif_value(category, cif_values, data_category=None):
+    """
+    Converts a harvested value into the units and vocabulary expected by the mmCIF dictionary.
+    """
+    if category == "date":
+        cif_values = [cif_values[0].split(" ")[0]]
+    elif category == "accelerating_voltage":
+        if not data_category == "serialEM":
+            if cif_values[0] != "?":
+                cif_values = [int(float(cif_values[0]) / 1000)]
+    elif category == "nominal_defocus_min":
+        if cif_values[0] != "?":
+            cif_values = [int((cif_values[0]) * -1000)]
+    elif category == "nominal_defocus_max":
+        if cif_values[0] != "?":
+            cif_values = [int((cif_values[0]) * -1000)]
+    elif category == "mode":
+        if cif_values[0] == "BrightField":
+            cif_values = ["BRIGHT FIELD"]
+    elif category == "topology" or category == "material":
+        cif_values = [cif_values[0].upper()]
+    elif category == "electron_source":
+        if cif_values[0] == "FieldEmission":
+            cif_values = ["FIELD EMISSION GUN"]
+    # elif category == "illumination_mode":
+    #     if cif_values[0] == "PARALLEL":
+    #         cif_values = ["FLOOD BEAM"]
+    elif category == "microscope_model":
+        if cif_values[0] == "EMBL Krios 3":
+            cif_values = ["TFS KRIOS"]
+    return cif_values
+
+
+def build_container(input_data, sessionName, layout=None, data_category=None):
+    """
+    Builds a data container named after the session from the input data, reusing a precomputed layout if given.
+    """
+    layout = layout if layout is not None else build_cif_layout(input_data)
+    container = DataContainer(sessionName)
+
+    for category_name, category_list in layout.items():
         cif_values_list = []
-        for category, cif_values in categories_values.items():
-            if category == "date":
-                cif_values = [cif_values[0].split(" ")[0]]
-            elif category == "accelerating_voltage":
-                if not args.category == "serialEM":
-                    if cif_values[0] != "?":
-                        cif_values = [int(float(cif_values[0]) / 1000)]
-            elif category == "nominal_defocus_min":
-                if cif_values[0] != "?":
-                    cif_values = [int((cif_values[0]) * -1000)]
-            elif category == "nominal_defocus_max":
-                if cif_values[0] != "?":
-                    cif_values = [int((cif_values[0]) * -1000)]
-            elif category == "mode":
-                if cif_values[0] == "BrightField":
-                    cif_values = ["BRIGHT FIELD"]
-            elif category == "topology" or category == "material":
-                cif_values = [cif_values[0].upper()]
-            elif category == "electron_source":
-                if cif_values[0] == "FieldEmission":
-                    cif_values = ["FIELD EMISSION GUN"]
-            # elif category == "illumination_mode":
-            #     if cif_values[0] == "PARALLEL":
-            #         cif_values = ["FLOOD BEAM"]
-            elif category == "microscope_model":
-                if cif_values[0] == "EMBL Krios 3":
-                    cif_values = ["TFS KRIOS"]
-
-            category_list.append(category)
+        for category in category_list:
+            cif_values = convert_cif_value(category, [input_data[category_name + "." + category]], data_category)
             cif_values_list.append(cif_values)
         add_category(container, category_name, category_list)
         insert_data(container, category_name, cif_values_list)
+    return container
+
+
+def translate_xml_to_cif(input_data, sessionName):
+    """
+    Translates input XML data into a CIF file.
+    """
+    from emharvest.emharvest_main import parse_arguments
+    args = parse_arguments()
+
+    if not input_data:
+        return False
+
+    # Add all accumulated categories and values to the CIF container
+    cif_data_list = [build_container(input_data, sessionName, data_category=args.category)]
 
     # Write the modified CIF data to a file
-    return write_mmcif_file(cif_data_list, sessionName)
\ No newline at end of file
+    return write_mmcif_file(cif_data_list, sessionName)
+
+
+class BatchCifWriter:
+    """
+    Streams many sessions as separate data blocks into one CIF file, or into shards of shard_size blocks.
+
+    The category/attribute layout is built once per distinct set of keys and reused for every session,
+    and each shard file is opened once. Use as a context manager:
+
+        with BatchCifWriter("backfill.cif", shard_size=1000) as writer:
+            for sessionName, cif_dict in records:
+                writer.add(cif_dict, sessionName)
+    """
+
+    def __init__(self, output_path, shard_size=None, data_category=None):
+        self.output_path = output_path
+        self.shard_size = shard_size
+        self.data_category = data_category
+        self.paths = []
+        self.blocks_written = 0
+        self._layouts = {}
+        self._handle = None
+        self._writer = None
+        self._blocks_in_shard = 0
+
+    def _shard_path(self, shard):
+        if not self.shard_size:
+            return self.output_path
+        stem, ext = os.path.splitext(self.output_path)
+        return f"{stem}_{shard:04d}{ext or '.cif'}"
+
+    def _open_next(self):
+        self.close()
+        path = self._shard_path(len(self.paths) + 1)
+        self._handle = open(path, "w")
+        self._writer = PdbxWriter(self._handle)
+        self._blocks_in_shard = 0
+        self.paths.append(path)
+
+    def add(self, input_data, sessionName):
+        """
+        Appends one session as a data block, returns False when there is nothing to write.
+        """
+        if not input_data:
+            return False
+        if self._handle is None or (self.shard_size and self._blocks_in_shard >= self.shard_size):
+            self._open_next()
+
+        keys = tuple(input_data)
+        layout = self._layouts.get(keys)
+        if layout is None:
+            layout = self._layouts[keys] = build_cif_layout(input_data)
+
+        self._writer.write([build_container(input_data, sessionName, layout, self.data_category)])
+        self._blocks_in_shard += 1
+        self.blocks_written += 1
+        return True
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def flatten_deposition_record(record):
+    """
+    Converts a nested _dep.json record ({category: {attribute: value}}) back into "category.attribute" keys.
+    """
+    return {f"{category}.{attribute}": value
+            for category, attributes in record.items() for attribute, value in attributes.items()}
+
+
+def _read_record(dep_json, data, prefetcher):
+    """
+    Parses one prefetched _dep.json record, or returns None when it is left out of the batch.
+    """
+    # Files the prefetcher could not read are already in the failure log
+    if dep_json in prefetcher.failed_paths:
+        return None
+    try:
+        record = json.loads(data)
+        if not isinstance(record, dict):
+            raise ValueError("Not a deposition record")
+        return record
+    except ValueError as e:
+        if failures.fail_fast:
+            raise
+        failures.record("file", dep_json, e)
+        return None
+
+
+def write_cif_batch(dep_json_files, output_path, shard_size=None, data_category=None, prefetch_depth=DEFAULT_DEPTH):
+    """
+    Writes the _dep.json records of many sessions as data blocks of one CIF file or of sharded CIF files.
+    The next prefetch_depth records are read while the current one is written.
+    Records that can not be read or parsed are recorded in the failure log and left out.
+
+    Returns the list of CIF files written.
+    """
+    prefetcher = Prefetcher(dep_json_files, depth=prefetch_depth, isolate=True)
+    skipped = 0
+    with BatchCifWriter(output_path, shard_size=shard_size, data_category=data_category) as writer:
+        for dep_json, data in prefetcher:
+            record = _read_record(dep_json, data, prefetcher)
+            if record is None:
+                skipped += 1
+                continue
+            sessionName = os.path.basename(dep_json)
+            if sessionName.endswith("_dep.json"):
+                sessionName = sessionName[:-len("_dep.json")]
+            writer.add(flatten_deposition_record(record), sessionName)
+    prefetcher.log_stats("_dep.json records")
+    logger.info("Wrote %d data blocks to %d CIF file(s)", writer.blocks_written, len(writer.paths))
+    if skipped:
+        logger.warning("Left out %d records that could not be read", skipped)
+    return writer.paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Combine harvested _dep.json records into multi data block CIF files.")
+    parser.add_argument("dep_json", nargs="+", help="Harvested _dep.json files")
+    parser.add_argument("-o", "--output", required=True, help="Output CIF file, used as the stem of shard names")
+    parser.add_argument("-n", "--shard_size", type=int, default=None, help="Data blocks per CIF file (default: all in one)")
+    parser.add_argument("-c", "--category", default=None, choices=["epu", "epu_no_dm", "serialEM"],
+                        help="Data category the records were harvested with")
+    parser.add_argument("--prefetch_depth", type=int, default=DEFAULT_DEPTH,
+                        help=f"Records read ahead of the one being written (default: {DEFAULT_DEPTH}, 0 to disable)")
+    args = parser.parse_args()
+    configure_logging(level="INFO")
+    write_cif_batch(args.dep_json, args.output, shard_size=args.shard_size, data_category=args.category,
+                    prefetch_depth=args.prefetch_depth)
+
+
+if __name__ == "__main__":
+    main()
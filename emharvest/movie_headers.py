@@ -0,0 +1,254 @@
+import os
+import glob
+import json
+import struct
+import logging
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from emharvest.logs import configure_logging
+from emharvest.session_state import incremental_file_results
+from emharvest.sources import DATA_FOLDERS
+
+# Walking an IFD chain is a few small reads per frame, so a pool keeps many movies in flight
+MOVIE_READ_WORKERS = 16
+MOVIE_EXTENSIONS = (".tif", ".tiff", ".eer")
+# One read covers the entry count, the entries and the next IFD offset of IFDs with up to ~40 tags
+IFD_READ_SIZE = 512
+
+TIFF_TAGS = {256: "width", 257: "height", 258: "bits_per_sample", 259: "compression"}
+TIFF_COMPRESSION = {1: "none", 5: "LZW", 7: "JPEG", 8: "deflate", 32773: "PackBits", 32946: "deflate",
+                    65000: "EER 8 bit", 65001: "EER 7 bit", 65002: "EER"}
+# Inline value formats of the TIFF field types: SHORT, LONG, LONG8
+_FIELD_FORMATS = {3: "H", 4: "I", 16: "Q"}
+
+logger = logging.getLogger("emharvest.movie_headers")
+
+
+def find_movies(path):
+    """
+        Lists the movies (TIFF and EER fractions) of an EPU session, next to the acquisition images.
+
+        Returns:
+            list: The movie paths, sorted.
+    """
+    files = glob.glob(path + DATA_FOLDERS + "/*")
+    return sorted(file for file in files if file.lower().endswith(MOVIE_EXTENSIONS))
+
+
+def _read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+def _parse_entries(data, order, entry_size, offset_format):
+    """Reads the inline values of the TIFF_TAGS in the entries of an IFD."""
+    values = {}
+    # The value count of an entry is as wide as an offset, 4 bytes in TIFF and 8 in BigTIFF
+    count_size = struct.calcsize(offset_format)
+    for start in range(0, len(data) - entry_size + 1, entry_size):
+        tag, field_type = struct.unpack_from(order + "HH", data, start)
+        if tag not in TIFF_TAGS or field_type not in _FIELD_FORMATS:
+            continue
+        count = struct.unpack_from(order + offset_format, data, start + 4)[0]
+        if count != 1 and tag != 258:
+            continue
+        # Values that fit in the entry are stored in it, the first sample is enough for BitsPerSample
+        values[TIFF_TAGS[tag]] = struct.unpack_from(order + _FIELD_FORMATS[field_type], data, start + 4 + count_size)[0]
+    return values
+
+
+def read_movie_header(path):
+    """
+        Walks the IFD chain of a TIFF or EER movie, reading only the directories and never the frames.
+
+        The first IFD gives the frame dimensions and compression, every IFD is one frame. Classic TIFF and
+        BigTIFF are supported. A chain pointing past the end of the file, e.g. a movie still being written,
+        counts the frames found so far and is flagged as truncated.
+
+        Args:
+            path (str): The movie file.
+
+        Returns:
+            dict: The frames, width, height, bits per sample, compression code and name, the file size and
+                whether the chain was truncated. Files that can not be read have an "error" instead.
+    """
+    try:
+        file_bytes = os.path.getsize(path)
+        with open(path, "rb", buffering=0) as f:
+            head = f.read(16)
+            order = {b"II": "<", b"MM": ">"}.get(head[:2])
+            if order is None or len(head) < 8:
+                raise ValueError("not a TIFF file")
+            magic = struct.unpack_from(order + "H", head, 2)[0]
+            if magic == 42:
+                count_format, entry_size, offset_format = "H", 12, "I"
+                offset = struct.unpack_from(order + "I", head, 4)[0]
+            elif magic == 43 and len(head) == 16:
+                count_format, entry_size, offset_format = "Q", 20, "Q"
+                offset = struct.unpack_from(order + "Q", head, 8)[0]
+            else:
+                raise ValueError(f"not a TIFF file (magic number {magic})")
+            count_size = struct.calcsize(count_format)
+            offset_size = struct.calcsize(offset_format)
+
+            frames = 0
+            first = None
+            truncated = False
+            seen = set()
+            while offset:
+                if offset in seen:
+                    raise ValueError(f"IFD chain loops back to offset {offset}")
+                if offset + count_size > file_bytes:
+                    truncated = True
+                    break
+                seen.add(offset)
+                data = _read_at(f, offset, IFD_READ_SIZE)
+                entries = struct.unpack_from(order + count_format, data)[0]
+                end = count_size + entries * entry_size
+                if len(data) < end + offset_size:
+                    data = _read_at(f, offset, end + offset_size)
+                if len(data) < end + offset_size:
+                    truncated = True
+                    break
+                if first is None:
+                    first = _parse_entries(data[count_size:end], order, entry_size, offset_format)
+                offset = struct.unpack_from(order + offset_format, data, end)[0]
+                frames += 1
+    except (OSError, ValueError, struct.error) as e:
+        return {"path": path, "error": str(e)}
+
+    first = first or {}
+    compression = first.get("compression", 1)
+    return {
+        "path": path,
+        "frames": frames,
+        "width": first.get("width"),
+        "height": first.get("height"),
+        "bits_per_sample": first.get("bits_per_sample"),
+        "compression_code": compression,
+        "compression": TIFF_COMPRESSION.get(compression, f"code {compression}"),
+        "bigtiff": offset_format == "Q",
+        "truncated": truncated,
+        "file_bytes": file_bytes,
+    }
+
+
+def read_movie_headers(paths, workers=MOVIE_READ_WORKERS):
+    """
+        Walks the IFD chains of many movies on a thread pool.
+
+        Returns:
+            list: The read_movie_header result of each file, in the order of paths.
+    """
+    if not paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        return list(executor.map(read_movie_header, paths))
+
+
+def summarize_movie_headers(headers):
+    """
+        Summarizes the movie headers of a session.
+
+        Returns:
+            dict: The number of movies and of frames in total, the distinct frame counts, dimensions and
+                compressions with their movie counts, the truncated movies and the files that could not be read.
+    """
+    readable = [header for header in headers if "error" not in header]
+    frames = Counter(header["frames"] for header in readable)
+    dimensions = Counter(f"{header['width']}x{header['height']}" for header in readable)
+    compressions = Counter(header["compression"] for header in readable)
+    return {
+        "movies": len(headers),
+        "total_frames": sum(header["frames"] for header in readable),
+        "frames": {str(count): movies for count, movies in frames.most_common()},
+        "dimensions": dict(dimensions.most_common()),
+        "compressions": dict(compressions.most_common()),
+        "truncated": [header["path"] for header in readable if header["truncated"]],
+        "errors": [{"path": header["path"], "error": header["error"]} for header in headers if "error" in header],
+    }
+
+
+def movie_record(summary):
+    """
+        The deposition record fields of a movie summary, the most common value where movies differ.
+
+        Returns:
+            dict: Empty when no movie could be read.
+    """
+    if not summary["frames"]:
+        return {}
+    width, height = next(iter(summary["dimensions"])).split("x")
+    return {
+        "movie_count": summary["movies"],
+        "total_frames": summary["total_frames"],
+        "frames_per_image": int(next(iter(summary["frames"]))),
+        "movie_width": width,
+        "movie_height": height,
+        "movie_compression": next(iter(summary["compressions"])),
+    }
+
+
+def _reread_movie(header):
+    """Movies still being written, or that could not be read, are read again by the next harvest."""
+    return header is None or "error" in header or header["truncated"]
+
+
+def inspect_session_movies(session_dir, workers=MOVIE_READ_WORKERS, cache=None):
+    """
+        Reads the frame count, dimensions and compression of every movie of an EPU session.
+
+        Args:
+            session_dir (str): The EPU session directory.
+            workers (int, optional): Threads walking movies concurrently.
+            cache (dict, optional): The headers of the last incremental harvest (session_state.file_cache), only
+                new movies and those that were truncated or unreadable are read.
+
+        Returns:
+            dict: The summarize_movie_headers summary.
+    """
+    if cache is None:
+        paths = find_movies(session_dir)
+        logger.info('Reading the IFD chains of %d movies', len(paths))
+        headers = read_movie_headers(paths, workers)
+    else:
+        results, read = incremental_file_results(session_dir, cache,
+                                                 lambda name: name.lower().endswith(MOVIE_EXTENSIONS),
+                                                 lambda paths: read_movie_headers(paths, workers), _reread_movie)
+        headers = [header for _, header in results]
+        logger.info('Read the IFD chains of %d movies, %d kept from the last harvest', read, len(headers) - read)
+    summary = summarize_movie_headers(headers)
+    if summary["movies"]:
+        logger.info('Movie frames: %s, dimensions: %s, compression: %s', ", ".join(summary["frames"]),
+                    ", ".join(summary["dimensions"]), ", ".join(summary["compressions"]))
+    if len(summary["frames"]) > 1:
+        logger.warning("Movies have %d different frame counts, the most common is deposited", len(summary["frames"]))
+    for path in summary["truncated"]:
+        logger.warning("Movie %s ends before its last frame, it may still be being written", path)
+    for error in summary["errors"]:
+        logger.warning("Could not read the movie header of %s: %s", error["path"], error["error"])
+    return summary
+
+
+def write_movie_summary(summary, output_dir, session):
+    """Writes the movie header summary of a session to <session>_movies.json, returning its path."""
+    path = output_dir + '/' + session + '_movies.json'
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=4)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the frame counts, dimensions and compression of the "
+                                                 "TIFF/EER movies of an EPU session, without reading any frame.")
+    parser.add_argument("session_dir", help="EPU session directory")
+    parser.add_argument("--workers", type=int, default=MOVIE_READ_WORKERS, help="Threads reading movies")
+    args = parser.parse_args()
+    configure_logging(level="INFO")
+    print(json.dumps(inspect_session_movies(args.session_dir, workers=args.workers), indent=4))
+
+
+if __name__ == "__main__":
+    main()
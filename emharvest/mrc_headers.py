@@ -0,0 +1,187 @@
+import os
+import glob
+import json
+import logging
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import mrcfile
+from mrcfile.utils import data_dtype_from_header
+
+from emharvest.logs import configure_logging
+from emharvest.session_state import incremental_file_results
+from emharvest.sources import DATA_FOLDERS
+
+# Header reads are one small read per file, so a pool keeps many network filesystem round trips in flight
+MRC_READ_WORKERS = 16
+# Header pixel sizes and the EPU xml pixel size (rounded up to 0.1 Angstrom) agree within this tolerance
+APIX_TOLERANCE = 0.1
+
+logger = logging.getLogger("emharvest.mrc_headers")
+
+
+def find_mrcs(path):
+    """
+        Lists the acquisition MRCs of an EPU session, the images find_mics finds the xmls of.
+
+        Returns:
+            list: The MRC paths, sorted.
+    """
+    return sorted(glob.glob(path + DATA_FOLDERS + "/*.mrc"))
+
+
+def read_mrc_header(path):
+    """
+        Reads the header of an MRC file, without reading its extended header or voxel data.
+
+        Args:
+            path (str): The MRC file.
+
+        Returns:
+            dict: The shape (nx, ny, nz), the mode and its data type, the pixel size in Angstrom and the file size.
+                Files that can not be read have an "error" instead.
+    """
+    try:
+        # permissive, so files still being written or with unusual map IDs give a warning rather than an error
+        with mrcfile.open(path, mode="r", header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            voxel_size = mrc.voxel_size
+            try:
+                dtype = str(data_dtype_from_header(header))
+            except ValueError:
+                dtype = None
+            return {
+                "path": path,
+                "nx": int(header.nx),
+                "ny": int(header.ny),
+                # Sections of a stack, or frames of a movie
+                "nz": int(header.nz),
+                "mode": int(header.mode),
+                "dtype": dtype,
+                "apix": round(float(voxel_size.x), 4),
+                "extended_header_bytes": int(header.nsymbt),
+                "file_bytes": os.path.getsize(path),
+            }
+    except (OSError, ValueError) as e:
+        return {"path": path, "error": str(e)}
+
+
+def read_mrc_headers(paths, workers=MRC_READ_WORKERS):
+    """
+        Reads the headers of many MRC files on a thread pool.
+
+        Returns:
+            list: The read_mrc_header result of each file, in the order of paths.
+    """
+    if not paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        return list(executor.map(read_mrc_header, paths))
+
+
+def summarize_mrc_headers(headers):
+    """
+        Summarizes the MRC headers of a session.
+
+        Returns:
+            dict: The number of files, the distinct shapes, pixel sizes and modes with their file counts, the
+                files that could not be read, and the voxel data bytes that were not read.
+    """
+    readable = [header for header in headers if "error" not in header]
+    shapes = Counter(f"{header['nx']}x{header['ny']}x{header['nz']}" for header in readable)
+    pixel_sizes = Counter(header["apix"] for header in readable)
+    modes = Counter(f"{header['mode']} ({header['dtype']})" for header in readable)
+    return {
+        "files": len(headers),
+        "shapes": dict(shapes.most_common()),
+        "pixel_sizes": {str(apix): count for apix, count in pixel_sizes.most_common()},
+        "modes": dict(modes.most_common()),
+        "frames": sorted({header["nz"] for header in readable}),
+        # Everything after the 1024 byte main header
+        "bytes_not_read": sum(max(header["file_bytes"] - 1024, 0) for header in readable),
+        "errors": [{"path": header["path"], "error": header["error"]} for header in headers if "error" in header],
+    }
+
+
+def check_pixel_size(summary, xml_apix):
+    """
+        Cross-checks the pixel sizes in the MRC headers against the pixel size of the acquisition xml.
+
+        Headers without a pixel size (0) are ignored.
+
+        Returns:
+            list: The header pixel sizes that differ from xml_apix.
+    """
+    try:
+        xml_apix = float(xml_apix)
+    except (TypeError, ValueError):
+        return []
+    mismatched = [float(apix) for apix in summary["pixel_sizes"]
+                  if float(apix) > 0 and abs(float(apix) - xml_apix) > APIX_TOLERANCE]
+    summary["xml_apix"] = xml_apix
+    summary["apix_mismatch"] = mismatched
+    for apix in mismatched:
+        logger.warning("MRC header pixel size %g A of %d files differs from the xml pixel size %g A",
+                       apix, summary["pixel_sizes"][str(apix)], xml_apix)
+    return mismatched
+
+
+def inspect_session_mrcs(session_dir, workers=MRC_READ_WORKERS, cache=None):
+    """
+        Reads the header of every acquisition MRC of an EPU session and summarizes them.
+
+        Args:
+            session_dir (str): The EPU session directory.
+            workers (int, optional): Threads reading headers concurrently.
+            cache (dict, optional): The headers of the last incremental harvest (session_state.file_cache), only
+                new MRCs and those that could not be read are read.
+
+        Returns:
+            dict: The summarize_mrc_headers summary.
+    """
+    if cache is None:
+        paths = find_mrcs(session_dir)
+        logger.info('Reading the headers of %d acquisition MRCs', len(paths))
+        headers = read_mrc_headers(paths, workers)
+    else:
+        results, read = incremental_file_results(session_dir, cache, lambda name: name.endswith(".mrc"),
+                                                 lambda paths: read_mrc_headers(paths, workers),
+                                                 reread=lambda header: header is None or "error" in header)
+        headers = [header for _, header in results]
+        logger.info('Read the headers of %d acquisition MRCs, %d kept from the last harvest', read,
+                    len(headers) - read)
+    summary = summarize_mrc_headers(headers)
+    if summary["files"]:
+        logger.info('MRC shapes: %s, pixel sizes (A): %s', ", ".join(summary["shapes"]),
+                    ", ".join(summary["pixel_sizes"]))
+    for error in summary["errors"]:
+        logger.warning("Could not read the MRC header of %s: %s", error["path"], error["error"])
+    return summary
+
+
+def write_mrc_summary(summary, output_dir, session):
+    """Writes the MRC header summary of a session to <session>_mrc_headers.json, returning its path."""
+    path = output_dir + '/' + session + '_mrc_headers.json'
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=4)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the headers of the acquisition MRCs of an EPU session, "
+                                                 "without reading the image data.")
+    parser.add_argument("session_dir", help="EPU session directory")
+    parser.add_argument("--workers", type=int, default=MRC_READ_WORKERS, help="Threads reading headers")
+    parser.add_argument("--apix", type=float, help="Warn about header pixel sizes that differ from this (Angstrom)")
+    args = parser.parse_args()
+    configure_logging(level="INFO")
+
+    summary = inspect_session_mrcs(args.session_dir, workers=args.workers)
+    if args.apix:
+        check_pixel_size(summary, args.apix)
+    print(json.dumps(summary, indent=4))
+
+
+if __name__ == "__main__":
+    main()
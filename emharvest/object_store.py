@@ -0,0 +1,340 @@
+import io
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+import posixpath
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Objects are read in blocks of this size, smaller objects in one request
+BLOCK_SIZE = 4 * 1024 * 1024
+# Blocks kept in memory, least recently used first out
+CACHE_BYTES = 256 * 1024 * 1024
+# Block requests in flight for one large object
+FETCH_WORKERS = 16
+URL = re.compile(r"^([a-zA-Z][a-zA-Z0-9+.-]*)://(.*)$")
+
+logger = logging.getLogger(__name__)
+
+
+def split_url(path):
+    """
+        Returns:
+            tuple: (protocol, bucket/key) of an object store URL such as s3://bucket/key, (None, path) otherwise.
+    """
+    match = URL.match(str(path))
+    if not match:
+        return None, path
+    return match.group(1), match.group(2)
+
+
+class MemoryObjectStore:
+    """
+        In-process object store, with the list and ranged get requests of S3, for tests and benchmarks.
+
+        Every request is counted and can be delayed by latency_s, so a harvest from the store shows how many
+        round trips it would make to a real object store and what they would cost.
+
+        Args:
+            latency_s (float, optional): Time each request takes.
+    """
+
+    def __init__(self, latency_s=0.0):
+        self.latency_s = latency_s
+        self.objects = {}
+        self.versions = {}
+        self.requests = {"list": 0, "get": 0}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_directory(cls, directory, prefix, latency_s=0.0):
+        """Loads every file below directory into a new store, under prefix (e.g. bucket/session)."""
+        store = cls(latency_s)
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    store.put(posixpath.join(prefix, os.path.relpath(path, directory).replace(os.sep, "/")), f.read())
+        return store
+
+    def put(self, key, data):
+        with self._lock:
+            self.objects[key] = bytes(data)
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _request(self, kind):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        with self._lock:
+            self.requests[kind] += 1
+
+    def list(self, prefix):
+        """All the objects below prefix, as S3 lists them without a delimiter: {key: {"size", "version"}}."""
+        self._request("list")
+        with self._lock:
+            return {key: {"size": len(data), "version": self.versions[key]}
+                    for key, data in self.objects.items() if key.startswith(prefix)}
+
+    def get(self, key, start=None, end=None):
+        """The bytes [start, end) of an object, all of it by default."""
+        self._request("get")
+        try:
+            data = self.objects[key][start:end]
+        except KeyError:
+            raise FileNotFoundError(key) from None
+        with self._lock:
+            self.bytes_sent += len(data)
+        return data
+
+
+class FsspecStore:
+    """
+        The list and get requests of an fsspec filesystem, e.g. s3fs for s3:// URLs.
+
+        Args:
+            protocol (str): The fsspec protocol.
+            **options: Passed to fsspec.filesystem, e.g. endpoint_url for S3-compatible storage.
+    """
+
+    def __init__(self, protocol, **options):
+        try:
+            import fsspec
+        except ImportError:
+            raise ImportError(f"Reading {protocol}:// paths requires fsspec and its {protocol} backend "
+                              f"(e.g. pip install fsspec s3fs)") from None
+        self.fs = fsspec.filesystem(protocol, **options)
+
+    def list(self, prefix):
+        return {name: {"size": info.get("size", 0), "version": info.get("ETag") or info.get("mtime")}
+                for name, info in self.fs.find(prefix, detail=True).items() if info.get("type") != "directory"}
+
+    def get(self, key, start=None, end=None):
+        try:
+            return self.fs.cat_file(key, start=start, end=end)
+        except FileNotFoundError:
+            raise FileNotFoundError(key) from None
+
+
+class _BlockFile(io.RawIOBase):
+    """Seekable reads of one object through the block cache of its filesystem."""
+
+    def __init__(self, fs, key, size):
+        self.fs = fs
+        self.key = key
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.position = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence] + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        data = self.fs.read_range(self.key, self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class ObjectStoreFileSystem:
+    """
+        Reads and lists an object store like a read-only filesystem, with as few round trips as possible.
+
+        A prefix is listed once, recursively, and the listing answers every later search below it, so
+        finding the images of a session is one (paginated) list request rather than one per folder. Objects
+        are read in blocks of block_size through an in-memory LRU cache, so the xmls read by several harvest
+        stages are fetched once, and the blocks of large objects are fetched in parallel. With a cache_dir,
+        objects read whole are also kept on disk, keyed by their path, size and version, for later harvests.
+
+        Args:
+            store: The object store, with list(prefix) and get(key, start, end) requests (MemoryObjectStore,
+                FsspecStore).
+            protocol (str): The URL protocol of the store, e.g. s3.
+            block_size (int, optional): Bytes per block request.
+            cache_bytes (int, optional): Bytes of blocks kept in memory.
+            cache_dir (str, optional): Directory of the on-disk object cache.
+            workers (int, optional): Block requests in flight for one large object.
+    """
+
+    def __init__(self, store, protocol, block_size=BLOCK_SIZE, cache_bytes=CACHE_BYTES, cache_dir=None,
+                 workers=FETCH_WORKERS):
+        self.store = store
+        self.protocol = protocol
+        self.block_size = block_size
+        self.cache_bytes = cache_bytes
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.stats = {"lists": 0, "gets": 0, "block_hits": 0, "disk_hits": 0, "bytes_fetched": 0}
+        self._listings = {}
+        self._blocks = OrderedDict()
+        self._cached_bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def url(self, key):
+        return f"{self.protocol}://{key}"
+
+    def find(self, prefix):
+        """
+            Returns:
+                dict: Every object below prefix mapped to its size and version, listed once per prefix.
+        """
+        prefix = prefix.rstrip("/") + "/"
+        with self._lock:
+            for listed, listing in self._listings.items():
+                if prefix == listed:
+                    return listing
+                if prefix.startswith(listed):
+                    return {key: info for key, info in listing.items() if key.startswith(prefix)}
+        listing = self.store.list(prefix)
+        with self._lock:
+            self.stats["lists"] += 1
+            # A listing of a parent prefix replaces the listings below it
+            for listed in [listed for listed in self._listings if listed.startswith(prefix)]:
+                del self._listings[listed]
+            self._listings[prefix] = listing
+        logger.debug("Listed %d objects below %s", len(listing), self.url(prefix))
+        return listing
+
+    def info(self, key):
+        """The size and version of an object, listing its folder when no listing covers it yet."""
+        with self._lock:
+            listing = next((listing for listed, listing in self._listings.items() if key.startswith(listed)), None)
+        if listing is None:
+            listing = self.find(posixpath.dirname(key))
+        if key not in listing:
+            raise FileNotFoundError(self.url(key))
+        return listing[key]
+
+    def _fetch(self, key, block, size):
+        start = block * self.block_size
+        try:
+            data = self.store.get(key, start, min(size, start + self.block_size))
+        except Exception:
+            with self._lock:
+                del self._inflight[(key, block)]
+            raise
+        with self._lock:
+            self.stats["gets"] += 1
+            self.stats["bytes_fetched"] += len(data)
+            self._blocks[(key, block)] = data
+            self._cached_bytes += len(data)
+            del self._inflight[(key, block)]
+            while self._cached_bytes > self.cache_bytes and len(self._blocks) > 1:
+                _, evicted = self._blocks.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+        return data
+
+    def _block_future(self, key, block, size):
+        with self._lock:
+            data = self._blocks.get((key, block))
+            if data is not None:
+                self._blocks.move_to_end((key, block))
+                self.stats["block_hits"] += 1
+                future = Future()
+                future.set_result(data)
+                return future
+            # A block already being fetched for another reader is waited for rather than fetched again
+            future = self._inflight.get((key, block))
+            if future is None:
+                future = self._executor.submit(self._fetch, key, block, size)
+                self._inflight[(key, block)] = future
+            return future
+
+    def read_range(self, key, start, length):
+        size = self.info(key)["size"]
+        end = min(size, start + length)
+        if start >= end:
+            return b""
+        first, last = start // self.block_size, (end - 1) // self.block_size
+        futures = [self._block_future(key, block, size) for block in range(first, last + 1)]
+        data = b"".join(future.result() for future in futures)
+        offset = first * self.block_size
+        return data[start - offset:end - offset]
+
+    def _disk_path(self, key, info):
+        digest = hashlib.sha256(f"{self.url(key)}\0{info['size']}\0{info['version']}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def cat(self, key):
+        """Reads a whole object, its blocks fetched in parallel."""
+        info = self.info(key)
+        if self.cache_dir:
+            disk_path = self._disk_path(key, info)
+            try:
+                with open(disk_path, "rb") as f:
+                    data = f.read()
+                with self._lock:
+                    self.stats["disk_hits"] += 1
+                return data
+            except FileNotFoundError:
+                pass
+        size = info["size"]
+        futures = [self._block_future(key, block, size) for block in range(max(1, -(-size // self.block_size)))]
+        data = b"".join(future.result() for future in futures)
+        if self.cache_dir:
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            tmp_path = f"{disk_path}.tmp{os.getpid()}.{threading.get_ident()}"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, disk_path)
+        return data
+
+    def open(self, key):
+        """A seekable binary file reading the object through the block cache."""
+        return io.BufferedReader(_BlockFile(self, key, self.info(key)["size"]), buffer_size=self.block_size)
+
+    def log_stats(self):
+        logger.debug("%s:// requests: %d lists, %d gets (%d bytes), %d block cache hits, %d disk cache hits",
+                     self.protocol, self.stats["lists"], self.stats["gets"], self.stats["bytes_fetched"],
+                     self.stats["block_hits"], self.stats["disk_hits"])
+
+
+_filesystems = {}
+_settings = {"cache_dir": None, "block_size": BLOCK_SIZE}
+_registry_lock = threading.Lock()
+
+
+def configure(cache_dir=None, block_size=BLOCK_SIZE):
+    """Sets the on-disk cache and block size of the object store filesystems, including those already in use."""
+    _settings.update(cache_dir=cache_dir, block_size=block_size)
+    for fs in _filesystems.values():
+        fs.cache_dir, fs.block_size = cache_dir, block_size
+
+
+def register_store(protocol, store):
+    """
+        Serves the URLs of a protocol from a store, e.g. register_store("memory", MemoryObjectStore(...)).
+
+        Returns:
+            ObjectStoreFileSystem: The filesystem reading the store.
+    """
+    with _registry_lock:
+        _filesystems[protocol] = ObjectStoreFileSystem(store, protocol, **_settings)
+        return _filesystems[protocol]
+
+
+def get_filesystem(protocol):
+    """The filesystem of a protocol, an fsspec backend unless a store was registered for it."""
+    with _registry_lock:
+        if protocol not in _filesystems:
+            _filesystems[protocol] = ObjectStoreFileSystem(FsspecStore(protocol), protocol, **_settings)
+        return _filesystems[protocol]
+
+
+def log_filesystem_stats():
+    for fs in _filesystems.values():
+        fs.log_stats()
@@ -0,0 +1,192 @@
+import os
+import re
+import logging
+
+import numpy as np
+import pandas as pd
+import starfile
+from sklearn.cluster import MiniBatchKMeans
+
+from emharvest.prefetch import DEFAULT_DEPTH, Prefetcher
+from emharvest.sources import DATA_FOLDERS, glob_inputs
+from emharvest.spatial import HOLE_ID, STAGE_TOLERANCE_UM, stage_position
+
+# More groups than this leave too few particles per group to refine
+MAX_OPTICS_GROUPS = 100
+KMEANS_BATCH_SIZE = 4096
+# RELION needs the spherical aberration (mm) and amplitude contrast of every optics group. EPU records
+# neither, so the Cs of TFS Krios and Glacios microscopes and RELION's default amplitude contrast are used
+DEFAULT_CS_MM = 2.7
+AMPLITUDE_CONTRAST = 0.1
+
+_BEAM_SHIFT = re.compile(rb"<BeamShift[^>]*>\s*<a:_x>([^<]*)</a:_x>\s*<a:_y>([^<]*)</a:_y>")
+
+logger = logging.getLogger(__name__)
+
+
+def read_beam_shifts(session_dir, depth=DEFAULT_DEPTH):
+    """
+        Reads the image beam shift and stage position of every acquisition xml of an EPU session.
+
+        The xmls are read ahead with a Prefetcher and both values are matched in the raw bytes, so no xml is
+        parsed.
+
+        Args:
+            session_dir (str): The EPU session directory.
+            depth (int, optional): Files read ahead of the one being matched.
+
+        Returns:
+            pandas.DataFrame: One row per micrograph with its path relative to the session (the acquisition
+                MRC, named after its xml), FoilHole id, beam shift and stage position in microns. Acquisitions
+                without a beam shift are left out.
+    """
+    paths = glob_inputs(session_dir + DATA_FOLDERS + "/*.xml")
+    values = np.full((len(paths), 4), np.nan)
+    prefetcher = Prefetcher(paths, depth, isolate=True)
+    for index, (path, data) in enumerate(prefetcher):
+        match = _BEAM_SHIFT.search(data)
+        if match:
+            try:
+                values[index, :2] = float(match.group(1)), float(match.group(2))
+            except ValueError:
+                pass
+        position = stage_position(data)
+        if position:
+            values[index, 2:] = position
+    prefetcher.log_stats("acquisition xmls")
+
+    shifts = pd.DataFrame({
+        # Sliced rather than os.path.relpath, which does not know archive members (<archive>::<member>)
+        "micrograph": [path[len(session_dir):-len(".xml")].lstrip("/") + ".mrc" for path in paths],
+        "hole": [(HOLE_ID.match(os.path.basename(path)) or [None, None])[1] for path in paths],
+        "beam_x": values[:, 0], "beam_y": values[:, 1],
+        "stage_x": values[:, 2] * 1e6, "stage_y": values[:, 3] * 1e6,
+    })
+    missing = int(np.isnan(values[:, 0]).sum())
+    if missing:
+        logger.warning("%d acquisition xmls have no beam shift", missing)
+    # Archive members come in archive order, the STAR file lists micrographs sorted either way
+    return shifts.dropna(subset=["beam_x", "beam_y"]).sort_values("micrograph").reset_index(drop=True)
+
+
+def holes_per_stage_position(shifts):
+    """
+        The most FoilHoles acquired from one stage position, the number of beam shift targets of an AFIS cluster.
+    """
+    stage = shifts[["stage_x", "stage_y"]].div(STAGE_TOLERANCE_UM).round()
+    if stage.isna().all(axis=None) or shifts["hole"].isna().all():
+        return 1
+    return int(shifts.assign(sx=stage["stage_x"], sy=stage["stage_y"]).groupby(["sx", "sy"])["hole"].nunique().max())
+
+
+def cluster_beam_shifts(shifts, groups):
+    """
+        Clusters beam shifts into optics groups with mini-batch k-means.
+
+        Mini-batch k-means updates the centres from small random batches, so 10^6 micrographs are clustered
+        in seconds. Groups are numbered from 1 in order of their centre (y, then x), so the same session always
+        gets the same numbering.
+
+        Args:
+            shifts (numpy.ndarray): (n, 2) beam shifts.
+            groups (int): The number of optics groups.
+
+        Returns:
+            tuple: (optics group of each micrograph, (groups, 2) group centres).
+    """
+    shifts = np.asarray(shifts, dtype=np.float64).reshape(-1, 2)
+    groups = max(1, min(groups, len(np.unique(shifts, axis=0))))
+    if groups == 1:
+        return np.ones(len(shifts), dtype=np.int32), shifts.mean(axis=0, keepdims=True)
+    model = MiniBatchKMeans(n_clusters=groups, batch_size=KMEANS_BATCH_SIZE, n_init=3, random_state=0)
+    labels = model.fit_predict(shifts)
+    centres = model.cluster_centers_
+    order = np.lexsort((centres[:, 0], centres[:, 1]))
+    rank = np.empty(groups, dtype=np.int32)
+    rank[order] = np.arange(1, groups + 1)
+    return rank[labels], centres[order]
+
+
+def write_optics_star(shifts, labels, path, pixel_size=None, voltage_kv=None, cs_mm=DEFAULT_CS_MM,
+                      amplitude_contrast=AMPLITUDE_CONTRAST):
+    """
+        Writes the optics groups as a RELION STAR file with a data_optics and a data_micrographs block.
+
+        Args:
+            shifts (pandas.DataFrame): The read_beam_shifts result.
+            labels (numpy.ndarray): The optics group of each micrograph.
+            path (str): The STAR file to write.
+            pixel_size (float, optional): The micrograph pixel size in Angstrom, added to the optics groups.
+            voltage_kv (float, optional): The accelerating voltage in kV, added to the optics groups.
+            cs_mm (float, optional): The spherical aberration in mm.
+            amplitude_contrast (float, optional): The amplitude contrast.
+
+        Returns:
+            str: The path of the STAR file.
+    """
+    numbers = np.arange(1, int(labels.max()) + 1) if len(labels) else np.empty(0, dtype=np.int32)
+    optics = pd.DataFrame({"rlnOpticsGroupName": [f"opticsGroup{number}" for number in numbers],
+                           "rlnOpticsGroup": numbers})
+    if pixel_size:
+        optics["rlnMicrographOriginalPixelSize"] = pixel_size
+    if voltage_kv:
+        optics["rlnVoltage"] = voltage_kv
+    optics["rlnSphericalAberration"] = cs_mm
+    optics["rlnAmplitudeContrast"] = amplitude_contrast
+    micrographs = pd.DataFrame({"rlnMicrographName": shifts["micrograph"].to_numpy(), "rlnOpticsGroup": labels})
+    starfile.write({"optics": optics, "micrographs": micrographs}, path)
+    return path
+
+
+def session_optics_groups(session_dir, output_dir, session, groups=None, record=None, depth=DEFAULT_DEPTH,
+                          cs_mm=DEFAULT_CS_MM, amplitude_contrast=AMPLITUDE_CONTRAST):
+    """
+        Assigns the micrographs of an AFIS session to beam shift optics groups and writes <session>_optics.star.
+
+        Args:
+            session_dir (str): The EPU session directory.
+            output_dir (str): The output directory.
+            session (str): The session name, for the STAR file name.
+            groups (int, optional): The number of optics groups. By default, the most FoilHoles acquired from
+                one stage position, i.e. one group per beam shift target of an AFIS cluster.
+            record (dict, optional): The deposition record, for the pixel size and voltage of the optics groups.
+                Sessions whose record collection is not AFIS are skipped.
+            depth (int, optional): Files read ahead of the one being matched.
+            cs_mm (float, optional): The spherical aberration in mm, when the record has no "cs".
+            amplitude_contrast (float, optional): The amplitude contrast of the optics groups.
+
+        Returns:
+            str: The path of the STAR file, None for non-AFIS sessions or when no acquisition has a beam shift.
+    """
+    record = record or {}
+    if record.get("collection", "AFIS") != "AFIS":
+        logger.info("Optics groups by beam shift only apply to AFIS sessions, not %s, skipping",
+                    record["collection"])
+        return None
+    shifts = read_beam_shifts(session_dir, depth)
+    if shifts.empty:
+        logger.warning("No beam shifts found, no optics groups written")
+        return None
+    if not groups:
+        groups = holes_per_stage_position(shifts)
+    groups = min(groups, MAX_OPTICS_GROUPS)
+    labels, centres = cluster_beam_shifts(shifts[["beam_x", "beam_y"]].to_numpy(), groups)
+    logger.info("Assigned %d micrographs to %d beam shift optics groups", len(labels), len(centres))
+    logger.debug("Optics group beam shift centres: %s", centres.round(4).tolist())
+
+    try:
+        voltage = float(record.get("eV"))
+        voltage_kv = voltage / 1000 if voltage > 1000 else voltage
+    except (TypeError, ValueError):
+        voltage_kv = None
+    # The record holds the pixel size as text, e.g. "0.8"
+    try:
+        pixel_size = float(record.get("xmlAPix"))
+    except (TypeError, ValueError):
+        pixel_size = None
+    try:
+        cs_mm = float(record.get("cs", cs_mm))
+    except (TypeError, ValueError):
+        pass
+    return write_optics_star(shifts, labels, output_dir + '/' + session + '_optics.star', pixel_size, voltage_kv,
+                             cs_mm, amplitude_contrast)
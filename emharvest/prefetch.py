@@ -0,0 +1,184 @@
+import os
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import xmltodict
+
+from emharvest.failures import failures, with_retries
+from emharvest.sources import read_input, sequential_archive, split_archive_path
+
+# Files read ahead of the one being parsed, enough to cover GPFS/NFS latency for small metadata files
+DEFAULT_DEPTH = 8
+
+logger = logging.getLogger(__name__)
+
+
+def _advise_willneed(path):
+    """Asks the kernel to start reading a file into the page cache, where posix_fadvise is available."""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def _read_file(path):
+    return read_input(path)
+
+
+def _read_with_retries(path):
+    return with_retries(_read_file, path)
+
+
+class Prefetcher:
+    """
+        Reads a known list of files ahead of the code processing them one after another.
+
+        While the current file is being parsed, the next depth files are read on background threads into a
+        bounded buffer, and the depth files after those are announced to the kernel with
+        posix_fadvise(WILLNEED). On network filesystems this keeps several reads in flight, so processing is
+        limited by storage bandwidth rather than by the latency of each open and read.
+
+        Iterating yields (path, bytes) in the order of the file list. Reads failing with a transient error are
+        retried with backoff, and a read still running after the file timeout of the failure log is given up.
+        A file that could not be read raises its error when its turn comes, as open() would have. With
+        isolate, it is recorded in the failure log instead and yielded as empty bytes, i.e. as a file without
+        any of the values looked for, so one bad file does not stop a scan of thousands. A depth of 0 reads
+        each file when it is reached, without a timeout. Members of a compressed tarball are taken from one
+        pass over the archive instead.
+
+        A read that never returns (e.g. from a hung NFS server) keeps its thread, and the process waits for it
+        when it exits; the session timeout of the work queue ends such a harvest.
+
+        Args:
+            paths (list): The files to read, in processing order.
+            depth (int, optional): Files buffered ahead of the current one. Defaults to DEFAULT_DEPTH.
+            isolate (bool, optional): Record and skip files that can not be read, unless the failure log is
+                set to fail fast.
+    """
+
+    def __init__(self, paths, depth=DEFAULT_DEPTH, isolate=False):
+        self.paths = list(paths)
+        self.depth = max(0, depth or 0)
+        self.isolate = isolate and not failures.fail_fast
+        self.failed = 0
+        # The files given up on, so callers can tell them from files that are empty
+        self.failed_paths = set()
+        self.files = 0
+        self.hits = 0
+        self.bytes_read = 0
+        self.wait_s = 0.0
+        self.advised = 0
+
+    def __iter__(self):
+        archive = sequential_archive(self.paths)
+        if archive is not None:
+            members = archive.iter_read(split_archive_path(path)[1] for path in self.paths)
+            for path, (_, data) in zip(self.paths, members):
+                self._count(data, hit=True)
+                yield path, data
+            return
+
+        if not self.depth:
+            for path in self.paths:
+                try:
+                    data, _ = _read_with_retries(path)
+                except Exception as e:
+                    data = self._failed(path, e)
+                self._count(data, hit=False)
+                yield path, data
+            return
+
+        pending = deque()
+        next_read = 0
+        next_advice = 0
+        timed_out = False
+        executor = ThreadPoolExecutor(max_workers=self.depth)
+        try:
+            for index, path in enumerate(self.paths):
+                # Keep depth reads buffered or in flight, and the kernel working on the files after them
+                while next_read < len(self.paths) and next_read <= index + self.depth:
+                    pending.append(executor.submit(_read_with_retries, self.paths[next_read]))
+                    next_read += 1
+                next_advice = max(next_advice, next_read)
+                while next_advice < len(self.paths) and next_advice <= index + 2 * self.depth:
+                    self.advised += _advise_willneed(self.paths[next_advice])
+                    next_advice += 1
+
+                future = pending.popleft()
+                hit = future.done()
+                wait_start = time.perf_counter()
+                try:
+                    data, _ = future.result(timeout=failures.file_timeout_s)
+                except FutureTimeout:
+                    timed_out = True
+                    data = self._failed(path, TimeoutError(f"no data after {failures.file_timeout_s} s"))
+                except Exception as e:
+                    data = self._failed(path, e)
+                if not hit:
+                    self.wait_s += time.perf_counter() - wait_start
+                self._count(data, hit)
+                yield path, data
+        finally:
+            # Stopped early, drop the reads that were not needed
+            for future in pending:
+                future.cancel()
+            # Threads stuck in a read that timed out are not waited for
+            executor.shutdown(wait=not timed_out)
+
+    def _failed(self, path, error):
+        """Raises the error of a file, or records it and returns empty bytes when isolating failures."""
+        if not self.isolate:
+            raise error
+        self.failed += 1
+        self.failed_paths.add(path)
+        failures.record("file", path, error, attempts=getattr(error, "attempts", 1))
+        return b""
+
+    def _count(self, data, hit):
+        self.files += 1
+        self.hits += hit
+        self.bytes_read += len(data)
+
+    def stats(self):
+        """
+            Returns:
+                dict: Files read, how many were already buffered when reached (hits), how many could not be
+                read (failed), the hit rate, the bytes read, the time spent waiting for reads and the files
+                announced with posix_fadvise.
+        """
+        return {"depth": self.depth, "files": self.files, "hits": self.hits, "failed": self.failed,
+                "hit_rate": round(self.hits / self.files, 3) if self.files else None,
+                "bytes_read": self.bytes_read, "wait_s": round(self.wait_s, 6), "advised": self.advised}
+
+    def log_stats(self, label="files"):
+        stats = self.stats()
+        logger.debug("Prefetched %d %s (depth %d): %d hits, %d failed, %d bytes, waited %.3f s", stats["files"],
+                     label, stats["depth"], stats["hits"], stats["failed"], stats["bytes_read"], stats["wait_s"])
+
+
+def iter_xml_dicts(paths, depth=DEFAULT_DEPTH):
+    """
+        Parses a list of XML files in order, reading ahead of the parser.
+
+        Args:
+            paths (list): The XML files, e.g. the acquisition image xmls found by find_mics, or a Prefetcher
+                whose statistics are read afterwards.
+            depth (int, optional): Files read ahead of the one being parsed.
+
+        Returns:
+            generator: (path, dict parsed with xmltodict) for each file.
+    """
+    prefetcher = paths if isinstance(paths, Prefetcher) else Prefetcher(paths, depth)
+    for path, data in prefetcher:
+        yield path, xmltodict.parse(data)
@@ -0,0 +1,388 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+from rich.console import Console
+from rich.table import Table
+
+STAGE_METRICS = ["wall_s", "cpu_s", "files_opened", "bytes_read"]
+# Memory metrics are merged by their maximum over calls and sessions rather than summed
+MEMORY_METRICS = ["mem_peak_bytes", "mem_retained_bytes", "rss_bytes"]
+BUDGET_ACTIONS = ["warn", "fail"]
+MEMORY_TOP_SITES = 5
+
+_UNITS = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2, "G": 1024 ** 3, "GB": 1024 ** 3}
+_SIZE = re.compile(r'^\s*([\d.]+)\s*([KMG]?B?)\s*$', re.IGNORECASE)
+
+_local = threading.local()
+_audit_hook_installed = False
+# Stages open in any thread, so files opened by worker threads count towards the stage that started them
+_open_records = []
+
+logger = logging.getLogger(__name__)
+
+
+def _active_stages():
+    """Stages currently open in this thread, innermost last."""
+    if not hasattr(_local, "stages"):
+        _local.stages = []
+    return _local.stages
+
+
+def _audit_hook(event, args):
+    # Count every file opened while a stage is active
+    if event == "open" and _open_records and not getattr(_local, "suppress", False):
+        for record in list(_open_records):
+            record["files_opened"] += 1
+
+
+def _read_proc(path):
+    """Reads a /proc file without counting it as a file opened by the stage, None where it is not available."""
+    _local.suppress = True
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+    finally:
+        _local.suppress = False
+
+
+def _process_bytes_read():
+    """Bytes read by the process so far (rchar from /proc/self/io), None where it is not available."""
+    for line in (_read_proc("/proc/self/io") or b"").splitlines():
+        if line.startswith(b"rchar:"):
+            return int(line.split()[1])
+    return None
+
+
+def _process_rss():
+    """Resident set size of the process in bytes (from /proc/self/statm), None where it is not available."""
+    content = _read_proc("/proc/self/statm")
+    if not content:
+        return None
+    return int(content.split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def parse_size(value):
+    """
+        Parses a memory size such as 512MB, 2G or 1048576 into bytes.
+    """
+    match = _SIZE.match(str(value))
+    if not match:
+        raise ValueError(f"Invalid memory size '{value}', expected e.g. 512MB or 2GB")
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+def parse_memory_budgets(spec):
+    """
+        Parses a memory budget specification into a {stage: bytes} dict.
+
+        Args:
+            spec (str): A size applying to every stage (e.g. 1GB), or comma separated stage=size pairs
+                where the stage * sets the default (e.g. xml_session=200MB,*=1GB).
+
+        Returns:
+            dict: Budgets in bytes keyed by stage name, "*" for the default.
+    """
+    budgets = {}
+    for part in (spec or "").split(","):
+        if not part.strip():
+            continue
+        name, _, size = part.rpartition("=")
+        budgets[name.strip() or "*"] = parse_size(size)
+    return budgets
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    """Raised at the end of a stage whose peak memory exceeded its budget, with the fail budget action."""
+
+
+class StageProfiler:
+    """
+        Times named harvest stages: wall time, CPU time, files opened and bytes read.
+
+        Profiling is off until enable() is called, so stage() costs next to nothing in normal runs.
+        Files opened, bytes read and CPU time are counted for the whole process, so stages that run
+        concurrently share them (StageGraph runs its stages serially while profiling). When a dump directory
+        is given, the outermost stage open in the process is also recorded with cProfile and saved as
+        <dump_dir>/<stage>.pstats. Only one cProfile profiler runs at a time, as concurrent profilers
+        conflict from Python 3.12 (sys.monitoring); stages started in other threads meanwhile are timed only.
+
+        With memory tracking, each stage also records how far the Python heap (tracemalloc) grew at its peak,
+        the heap it left allocated, the process RSS at its end and the allocation sites that grew the most.
+        Like I/O, the traced heap is shared by concurrent stages. Stages over their memory budget are
+        logged as warnings, or raise MemoryBudgetExceeded with the fail action.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.dump_dir = None
+        self.budgets = {}
+        self.budget_action = "warn"
+        self.records = []
+        self._lock = threading.Lock()
+        self._profiling = False
+
+    def enable(self, dump_dir=None, memory=False, budgets=None, budget_action="warn"):
+        global _audit_hook_installed
+        self.enabled = True
+        self.dump_dir = dump_dir
+        self.budgets = budgets or {}
+        self.budget_action = budget_action
+        self.memory = memory or bool(self.budgets)
+        if dump_dir:
+            os.makedirs(dump_dir, exist_ok=True)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if not _audit_hook_installed:
+            # Audit hooks cannot be removed, the hook is a no-op while no stage is open
+            sys.addaudithook(_audit_hook)
+            _audit_hook_installed = True
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+
+    def budget(self, name):
+        return self.budgets.get(name, self.budgets.get("*"))
+
+    @contextmanager
+    def stage(self, name):
+        """
+            Context manager timing the enclosed block as the stage called name.
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        stack = _active_stages()
+        record = {"stage": name, "files_opened": 0}
+        profile = None
+        with self._lock:
+            self.records.append(record)
+            if self.dump_dir and not self._profiling:
+                profile = cProfile.Profile()
+                self._profiling = True
+        if self.memory:
+            self._memory_start(record)
+        bytes_start = _process_bytes_read()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        stack.append(record)
+        _open_records.append(record)
+        if profile:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile:
+                profile.disable()
+                self._profiling = False
+            stack.remove(record)
+            _open_records.remove(record)
+            wall_s = time.perf_counter() - wall_start
+            record["cpu_s"] = time.process_time() - cpu_start
+            bytes_end = _process_bytes_read()
+            record["bytes_read"] = bytes_end - bytes_start if bytes_start is not None and bytes_end is not None else None
+            record["depth"] = len(stack)
+            if profile:
+                record["pstats"] = os.path.join(self.dump_dir, f"{name}.pstats")
+                profile.dump_stats(record["pstats"])
+            if self.memory:
+                self._memory_end(record)
+            # Set last, a record with wall_s is complete
+            record["wall_s"] = wall_s
+            if record.get("over_budget") and self.budget_action == "fail":
+                raise MemoryBudgetExceeded(record["budget_message"])
+
+    def _track_peak(self):
+        """Folds the traced peak since the last stage boundary into every open stage, then restarts it."""
+        peak = tracemalloc.get_traced_memory()[1]
+        with self._lock:
+            for record in self.records:
+                if "_mem_peak" in record:
+                    record["_mem_peak"] = max(record["_mem_peak"], peak)
+            tracemalloc.reset_peak()
+
+    def _memory_start(self, record):
+        self._track_peak()
+        record["_snapshot"] = tracemalloc.take_snapshot()
+        record["_mem_start"] = tracemalloc.get_traced_memory()[0]
+        record["_mem_peak"] = record["_mem_start"]
+
+    def _memory_end(self, record):
+        snapshot = tracemalloc.take_snapshot()
+        self._track_peak()
+        # Both relative to the heap when the stage started, so a stage is not charged for what earlier stages kept
+        mem_start = record.pop("_mem_start")
+        record["mem_peak_bytes"] = record.pop("_mem_peak") - mem_start
+        record["mem_retained_bytes"] = tracemalloc.get_traced_memory()[0] - mem_start
+        record["rss_bytes"] = _process_rss()
+
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+        growth = snapshot.filter_traces(ignore).compare_to(record.pop("_snapshot").filter_traces(ignore), "lineno")
+        record["top_allocations"] = [
+            {"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+             "size_bytes": stat.size_diff, "count": stat.count_diff}
+            for stat in growth[:MEMORY_TOP_SITES] if stat.size_diff > 0]
+
+        budget = self.budget(record["stage"])
+        if budget is not None:
+            record["budget_bytes"] = budget
+            record["over_budget"] = record["mem_peak_bytes"] > budget
+            if record["over_budget"]:
+                record["budget_message"] = (f"Stage {record['stage']} peaked at "
+                                            f"{_format_bytes(record['mem_peak_bytes'])}, over its "
+                                            f"{_format_bytes(budget)} memory budget")
+                logger.warning(record["budget_message"])
+
+    def summary(self):
+        """
+            Returns the recorded stages, merged by name, in the order they first started.
+        """
+        stages = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            if "wall_s" not in record:
+                continue
+            entry = stages.setdefault(record["stage"], {"stage": record["stage"], "calls": 0,
+                                                        **{metric: 0 for metric in STAGE_METRICS}})
+            entry["calls"] += 1
+            for metric in STAGE_METRICS:
+                if record.get(metric) is None:
+                    entry[metric] = None
+                elif entry[metric] is not None:
+                    entry[metric] += record[metric]
+            if "depth" in record:
+                entry["depth"] = min(entry.get("depth", record["depth"]), record["depth"])
+            if "mem_peak_bytes" in record:
+                _merge_memory(entry, record)
+        return list(stages.values())
+
+    def write_json(self, path, extra=None):
+        report = {"stages": self.summary()}
+        if extra:
+            report.update(extra)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=4)
+        return path
+
+    def print_summary(self, title="Harvest profile"):
+        print_stage_table(self.summary(), title)
+
+
+def _merge_memory(entry, row):
+    """Keeps the largest memory metrics of a stage, and the allocation sites of its highest peak."""
+    if "mem_peak_bytes" not in entry or row["mem_peak_bytes"] > entry["mem_peak_bytes"]:
+        entry["top_allocations"] = row.get("top_allocations", [])
+    for metric in MEMORY_METRICS:
+        if row.get(metric) is not None:
+            entry[metric] = max(entry.get(metric) or 0, row[metric])
+    if "budget_bytes" in row:
+        entry["budget_bytes"] = row["budget_bytes"]
+        entry["over_budget"] = entry.get("over_budget", False) or row["over_budget"]
+
+
+def _format_bytes(n):
+    if n is None:
+        return "-"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n) < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def print_stage_table(rows, title="Harvest profile"):
+    table = Table(title=title)
+    columns = ["Stage", "Calls", "Wall (s)", "CPU (s)", "Files", "Read"]
+    if rows and "sessions" in rows[0]:
+        columns.insert(1, "Sessions")
+    memory = any("mem_peak_bytes" in row for row in rows)
+    if memory:
+        columns += ["Heap peak", "Retained", "RSS", "Budget"]
+    for column in columns:
+        table.add_column(column, justify="left" if column == "Stage" else "right")
+    for row in rows:
+        cells = ["  " * row.get("depth", 0) + row["stage"]]
+        if "sessions" in row:
+            cells.append(str(row["sessions"]))
+        cells += [str(row["calls"]), f"{row['wall_s']:.3f}", f"{row['cpu_s']:.3f}",
+                  str(row["files_opened"]), _format_bytes(row["bytes_read"])]
+        if memory:
+            budget = _format_bytes(row.get("budget_bytes"))
+            if row.get("over_budget_sessions"):
+                budget = f"[red]{budget} ({row['over_budget_sessions']} over)[/red]"
+            elif row.get("over_budget"):
+                budget = f"[red]{budget} exceeded[/red]"
+            cells += [_format_bytes(row.get("mem_peak_bytes")), _format_bytes(row.get("mem_retained_bytes")),
+                      _format_bytes(row.get("rss_bytes")), budget]
+        table.add_row(*cells)
+    Console().print(table)
+
+
+# Shared profiler used by every harvest module
+profiler = StageProfiler()
+stage = profiler.stage
+
+
+def aggregate_profiles(reports):
+    """
+        Aggregates per-session profile reports into batch level stage totals.
+
+        Args:
+            reports (list): Profile report dicts, or paths to the JSON files written by StageProfiler.write_json.
+
+        Returns:
+            list: One row per stage with the number of sessions, summed metrics and the slowest session wall time.
+            Memory profiles add the largest memory metrics of any session and the number of sessions over budget.
+    """
+    stages = {}
+    for report in reports:
+        if isinstance(report, str):
+            with open(report, "r") as f:
+                report = json.load(f)
+        for row in report.get("stages", []):
+            entry = stages.setdefault(row["stage"], {"stage": row["stage"], "sessions": 0, "calls": 0,
+                                                     "depth": row.get("depth", 0), "max_wall_s": 0,
+                                                     **{metric: 0 for metric in STAGE_METRICS}})
+            entry["sessions"] += 1
+            entry["calls"] += row["calls"]
+            entry["max_wall_s"] = max(entry["max_wall_s"], row["wall_s"])
+            for metric in STAGE_METRICS:
+                if row.get(metric) is None:
+                    entry[metric] = None
+                elif entry[metric] is not None:
+                    entry[metric] += row[metric]
+            if "mem_peak_bytes" in row:
+                _merge_memory(entry, row)
+                entry["over_budget_sessions"] = entry.get("over_budget_sessions", 0) + bool(row.get("over_budget"))
+    return list(stages.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate EMharvest profile reports across sessions.")
+    parser.add_argument("reports", nargs="+", help="*_profile.json files written with --profile")
+    parser.add_argument("-o", "--output", help="Write the aggregated stages to this JSON file")
+    args = parser.parse_args()
+
+    rows = aggregate_profiles(args.reports)
+    print_stage_table(rows, title=f"Batch profile ({len(args.reports)} sessions)")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"sessions": len(args.reports), "stages": rows}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import logging
+
+from emharvest import __version__
+from emharvest.sources import input_state, listing_digest
+
+CACHE_FORMAT = 3
+ENTRY_FILENAME = "entry.json"
+# Names of the outputs restored into an output directory, detached from the cache before it is harvested again
+RESTORED_FILENAME = ".emharvest_restored.json"
+# Outputs written by save_deposition_file, detached even without a record of the restored files
+OUTPUT_SUFFIXES = ("_dep.json", "_dep.csv", "_dep.cif", "_dep.checksum")
+OUTPUT_PREFIX = "val_"
+# Command line options that change what is harvested or how it is validated
+FINGERPRINT_OPTIONS = ["mode", "category", "full_validation", "download_dict", "mrc_headers", "movie_headers", "timeline", "spatial", "optics_groups", "optics_cs", "optics_amplitude_contrast", "sample"]
+INPUT_OPTIONS = ["epu", "atlas", "input_file", "tomogram_file", "mdoc_file", "dict_path"]
+
+logger = logging.getLogger(__name__)
+
+
+def _file_state(path, content=False):
+    """Identifies one input file by its content hash, or by its size and mtime (version for objects)."""
+    return input_state(path, content) if path else None
+
+
+def directory_index_digest(path):
+    """
+        Digests the mtime of every directory below path.
+
+        A directory's mtime changes whenever an entry is added, removed or renamed in it, so new
+        acquisitions change the digest while only directories, not the files in them, are stat'ed.
+
+        Args:
+            path (str): The session directory.
+
+        Returns:
+            str: A SHA-256 hex digest, or None when path is not a directory.
+    """
+    if not path or not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for root, dirs, _ in os.walk(path):
+        dirs.sort()
+        digest.update(f"{os.path.relpath(root, path)}\0{os.stat(root).st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def code_digest():
+    """Digests the size and mtime of the harvester's own modules, so a changed harvester never reuses results."""
+    digest = hashlib.sha256(__version__.encode())
+    for module in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))):
+        st = os.stat(module)
+        digest.update(f"{os.path.basename(module)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def harvest_fingerprint(args, session_dir, item_maps, content=False, representatives=()):
+    """
+        Fingerprints everything a harvest result depends on.
+
+        Args:
+            args (argparse.Namespace): The parsed command line arguments.
+            session_dir (str): The session directory, digested with directory_index_digest.
+            item_maps (list): The deposition row to mmCIF item mappings (e.g. MMCIF_ITEMS).
+            content (bool, optional): Hash the input files instead of using their size and mtime.
+            representatives (list, optional): The representative xmls the session metadata is read from. An
+                xml rewritten in place leaves its directory's mtime unchanged, so each one is stamped.
+
+        Returns:
+            tuple: (fingerprint hex digest, the components it was computed from).
+    """
+    components = {
+        "format": CACHE_FORMAT,
+        "version": __version__,
+        "code": code_digest(),
+        "mapping": hashlib.sha256(json.dumps(item_maps, sort_keys=True).encode()).hexdigest(),
+        "options": {option: getattr(args, option, None) for option in FINGERPRINT_OPTIONS},
+        "inputs": {option: _file_state(getattr(args, option, None), content) for option in INPUT_OPTIONS},
+        "session_index": directory_index_digest(session_dir) or listing_digest(session_dir),
+        "representatives": [_file_state(path, content) for path in representatives],
+    }
+    fingerprint = hashlib.sha256(json.dumps(components, sort_keys=True).encode()).hexdigest()
+    return fingerprint, components
+
+
+def entry_dir(cache_dir, fingerprint):
+    return os.path.join(cache_dir, fingerprint[:2], fingerprint)
+
+
+def load_cached_result(cache_dir, fingerprint):
+    """
+        Returns the cache entry of a fingerprint, or None when it is missing or incomplete.
+    """
+    directory = entry_dir(cache_dir, fingerprint)
+    try:
+        with open(os.path.join(directory, ENTRY_FILENAME), "r") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get("format") != CACHE_FORMAT:
+        return None
+    if not all(os.path.isfile(os.path.join(directory, name)) for name in entry["files"]):
+        return None
+    entry["directory"] = directory
+    return entry
+
+
+def _link_or_copy(source, destination):
+    """Links (or copies across filesystems) source to destination, replacing destination atomically."""
+    tmp_path = destination + ".cache_tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+def restore_cached_result(entry, output_dir):
+    """
+        Hard links the cached outputs of a session into the output directory.
+
+        The names of the restored files are recorded in the output directory, so detach_outputs can unlink
+        them before a later harvest rewrites them.
+
+        Returns:
+            list: The restored output paths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    names = set(_restored_names(output_dir)) | set(entry["files"])
+    tmp_path = os.path.join(output_dir, f"{RESTORED_FILENAME}.tmp{os.getpid()}")
+    with open(tmp_path, "w") as f:
+        json.dump(sorted(names), f)
+    os.replace(tmp_path, os.path.join(output_dir, RESTORED_FILENAME))
+    restored = []
+    for name in entry["files"]:
+        destination = os.path.join(output_dir, name)
+        _link_or_copy(os.path.join(entry["directory"], name), destination)
+        restored.append(destination)
+    logger.info("Reused %d cached outputs for session %s (fingerprint %s)",
+                len(restored), entry["session"], entry["fingerprint"][:12])
+    return restored
+
+
+def store_result(cache_dir, fingerprint, components, output_files, session, result):
+    """
+        Copies a harvest's outputs into the cache under its fingerprint.
+
+        The entry is assembled in a temporary directory and renamed into place, so concurrent
+        workers never see a partial entry. An existing entry is kept when it is valid and replaced
+        when it is damaged. Outputs are copied rather than linked so the cache
+        cannot change when an output file is later edited in place.
+
+        Args:
+            cache_dir (str): The result cache directory.
+            fingerprint (str): The harvest fingerprint.
+            components (dict): The fingerprint components, kept for troubleshooting.
+            output_files (list): The output paths to cache.
+            session (str): The session name.
+            result (dict): Summary values restored with the outputs (validation result, micrograph count).
+
+        Returns:
+            str: The entry directory.
+    """
+    directory = entry_dir(cache_dir, fingerprint)
+    tmp_dir = f"{directory}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    names = []
+    for path in output_files:
+        if os.path.isfile(path):
+            shutil.copy2(path, os.path.join(tmp_dir, os.path.basename(path)))
+            names.append(os.path.basename(path))
+    entry = {"format": CACHE_FORMAT, "fingerprint": fingerprint, "session": session, "files": names,
+             "result": result, "components": components}
+    with open(os.path.join(tmp_dir, ENTRY_FILENAME), "w") as f:
+        json.dump(entry, f, indent=4, default=str)
+    try:
+        os.replace(tmp_dir, directory)
+    except OSError:
+        if load_cached_result(cache_dir, fingerprint):
+            # Another worker stored the same fingerprint first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            _replace_entry(tmp_dir, directory)
+    logger.info("Cached %d outputs for session %s (fingerprint %s)", len(names), session, fingerprint[:12])
+    return directory
+
+
+def _replace_entry(tmp_dir, directory):
+    """Moves a damaged entry aside and renames the new one into its place."""
+    damaged_dir = f"{directory}.damaged{os.getpid()}"
+    try:
+        os.replace(directory, damaged_dir)
+    except OSError:
+        # Another worker replaced it first
+        pass
+    try:
+        os.replace(tmp_dir, directory)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.rmtree(damaged_dir, ignore_errors=True)
+
+
+def _restored_names(output_dir):
+    try:
+        with open(os.path.join(output_dir, RESTORED_FILENAME), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def detach_outputs(output_dir):
+    """
+        Unlinks the outputs that are hard links into the cache, before they are written again.
+
+        The harvest rewrites its outputs in place, which would otherwise also rewrite the cached copy. Every
+        file restored by restore_cached_result is unlinked, the summaries of the optional stages included.
+    """
+    if not os.path.isdir(output_dir):
+        return
+    restored = set(_restored_names(output_dir))
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            if (entry.name in restored or entry.name.endswith(OUTPUT_SUFFIXES) or entry.name.startswith(OUTPUT_PREFIX)) \
+                    and entry.is_file(follow_symlinks=False) and entry.stat().st_nlink > 1:
+                os.remove(entry.path)
+    if restored:
+        os.remove(os.path.join(output_dir, RESTORED_FILENAME))
@@ -0,0 +1,199 @@
+import os
+import re
+import json
+import time
+import logging
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t as student_t
+
+from emharvest.prefetch import DEFAULT_DEPTH, Prefetcher
+from emharvest.sources import DATA_FOLDERS, glob_inputs
+
+ACQUISITION_PATTERN = DATA_FOLDERS + "/*.xml"
+# Sessions with at most this many acquisition xmls are read whole, sampling would save little
+FULL_SCAN_IMAGES = 1000
+CONFIDENCE = 0.95
+# Fewer images than this give no usable interval, even when the time budget runs out first
+MIN_SAMPLE = 2
+
+# The per-image values matched in the raw bytes of an acquisition xml, with the factor to their unit
+_CUSTOM_VALUE = rb"<a:Key>%s</a:Key>\s*<a:Value[^>]*>([^<]*)</a:Value>"
+IMAGE_VALUES = {
+    "applied_defocus_um": (re.compile(_CUSTOM_VALUE % rb"AppliedDefocus"), 1e6),
+    "dose_on_camera": (re.compile(_CUSTOM_VALUE % rb"DoseOnCamera"), 1),
+    "dose_rate": (re.compile(_CUSTOM_VALUE % rb"DoseRate"), 1),
+    "exposure_time_s": (re.compile(rb"<camera>.*?<ExposureTime>([^<]*)</ExposureTime>", re.DOTALL), 1),
+    "pixel_size_a": (re.compile(rb"<pixelSize>\s*<x>\s*<numericValue>([^<]*)</numericValue>"), 1e10),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def _grid_square(path):
+    """The GridSquare folder of an acquisition image, <session>/*/GridSquare*/Data/<image>.xml."""
+    return os.path.basename(os.path.dirname(os.path.dirname(path)))
+
+
+def stratified_order(strata, seed=0):
+    """
+        Orders items so that every prefix of the order is a proportional stratified sample.
+
+        The items of each stratum are shuffled and spread evenly over [0, 1), item r of a stratum of N_h at
+        (r + u) / N_h with u random in [0, 1), and all items are sorted by that position. The first n items
+        then hold about n * N_h / N items of each stratum, so a sample can be cut at any size, or whenever a
+        time budget runs out.
+
+        Args:
+            strata (list): The stratum of each item, e.g. its GridSquare.
+            seed (int, optional): Random seed, the same strata always give the same order.
+
+        Returns:
+            numpy.ndarray: The item indexes in sampling order.
+    """
+    rng = np.random.default_rng(seed)
+    _, inverse, counts = np.unique(np.asarray(strata, dtype=object).astype(str), return_inverse=True,
+                                   return_counts=True)
+    shuffled = rng.permutation(len(inverse))
+    items = shuffled[np.argsort(inverse[shuffled], kind="stable")]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    ranks = np.arange(len(items)) - starts[inverse[items]]
+    position = (ranks + rng.random(len(items))) / counts[inverse[items]]
+    return items[np.argsort(position, kind="stable")]
+
+
+def stratified_mean(values, strata, population, confidence=CONFIDENCE):
+    """
+        Estimates the session mean of a per-image value from a stratified sample.
+
+        Each sampled stratum is weighted by its share of the images, and the variance of the estimate takes
+        the finite population correction of each stratum, so a full scan has an interval of zero width.
+        Strata with a single sampled value borrow the variance of the whole sample. Strata without a sampled
+        value are left out and the weights of the others rescaled.
+
+        Args:
+            values (numpy.ndarray): The value of each sampled image, NaN where an image does not have it.
+            strata (list): The stratum of each sampled image.
+            population (dict): The number of images of each stratum.
+            confidence (float, optional): The confidence level of the interval.
+
+        Returns:
+            dict: The mean, its confidence interval and the number of sampled values, None without values.
+    """
+    frame = pd.DataFrame({"stratum": strata, "value": values}).dropna(subset=["value"])
+    if frame.empty:
+        return None
+    per_stratum = frame.groupby("stratum")["value"].agg(["count", "mean", "var"])
+    sizes = pd.Series(population, dtype=float).reindex(per_stratum.index)
+    weights = sizes / sizes.sum()
+    pooled = frame["value"].var() if len(frame) > 1 else 0.0
+    variances = per_stratum["var"].fillna(pooled)
+    correction = (1 - per_stratum["count"] / sizes).clip(lower=0)
+    mean = float((weights * per_stratum["mean"]).sum())
+    error = float(np.sqrt((weights ** 2 * correction * variances / per_stratum["count"]).sum()))
+    half_width = float(student_t.ppf((1 + confidence) / 2, max(len(frame) - len(per_stratum), 1))) * error
+    return {"mean": round(mean, 6), "ci": [round(mean - half_width, 6), round(mean + half_width, 6)],
+            "images": len(frame)}
+
+
+def image_values(data):
+    """
+        Matches the IMAGE_VALUES in the raw bytes of an acquisition xml.
+
+        Returns:
+            list: One value per IMAGE_VALUES entry, NaN where the xml does not have it.
+    """
+    values = []
+    for pattern, factor in IMAGE_VALUES.values():
+        match = pattern.search(data)
+        try:
+            values.append(float(match.group(1)) * factor if match else np.nan)
+        except ValueError:
+            values.append(np.nan)
+    return values
+
+
+def session_statistics(session_dir, sample=None, time_budget=None, depth=DEFAULT_DEPTH,
+                       full_scan_images=FULL_SCAN_IMAGES, seed=0):
+    """
+        Estimates the per-image statistics of an EPU session from a stratified sample of its acquisition xmls.
+
+        The acquisition xmls are found in the session listing (the archive or object store index for those
+        sessions), and GridSquares are the strata. At most sample xmls are read, and reading stops once
+        time_budget seconds have passed, in stratified_order so the xmls read at any point are a proportional
+        sample. Sessions with at most full_scan_images (or sample) acquisitions are read whole instead.
+
+        Args:
+            session_dir (str): The EPU session directory.
+            sample (int, optional): The most acquisition xmls to read.
+            time_budget (float, optional): Seconds after which no further xml is read.
+            depth (int, optional): Files read ahead of the one being matched.
+            full_scan_images (int, optional): Sessions up to this size are read whole.
+            seed (int, optional): Random seed of the sample.
+
+        Returns:
+            dict: The images and GridSquares of the session, whether it was sampled, the sampling fraction, and
+                the stratified_mean of every IMAGE_VALUES entry, None when the session has no acquisitions.
+    """
+    start = time.perf_counter()
+    paths = glob_inputs(session_dir + ACQUISITION_PATTERN)
+    if not paths:
+        logger.warning("No acquisition xmls found, no session statistics to compute")
+        return None
+    squares = [_grid_square(path) for path in paths]
+    population = Counter(squares)
+
+    full_scan = len(paths) <= max(sample or 0, full_scan_images)
+    if full_scan:
+        selected = np.arange(len(paths))
+    else:
+        selected = stratified_order(squares, seed)[:sample or len(paths)]
+        if time_budget is None:
+            # Without a deadline the order does not matter, and listing order reads archives front to back
+            selected = np.sort(selected)
+    deadline = None if full_scan or time_budget is None else start + time_budget
+
+    values = []
+    prefetcher = Prefetcher([paths[index] for index in selected], depth, isolate=True)
+    iterator = iter(prefetcher)
+    for _, data in iterator:
+        values.append(image_values(data))
+        if deadline is not None and len(values) >= MIN_SAMPLE and time.perf_counter() > deadline:
+            break
+    iterator.close()
+    prefetcher.log_stats("sampled acquisition xmls")
+
+    read = selected[:len(values)]
+    values = np.array(values, dtype=np.float64).reshape(-1, len(IMAGE_VALUES))
+    strata = [squares[index] for index in read]
+    per_square = np.fromiter(population.values(), dtype=np.int64)
+    statistics = {
+        "images": len(paths),
+        "squares": len(population),
+        "images_per_square": {"mean": round(float(per_square.mean()), 2), "max": int(per_square.max())},
+        "full_scan": full_scan,
+        "sampled": len(read),
+        "sampling_fraction": round(len(read) / len(paths), 6),
+        "squares_sampled": len(set(strata)),
+        "confidence": CONFIDENCE,
+        "seed": seed,
+        "time_budget_s": time_budget,
+        "budget_exhausted": len(read) < len(selected),
+        "wall_s": round(time.perf_counter() - start, 3),
+        "values": {name: stratified_mean(values[:, column], strata, population)
+                   for column, name in enumerate(IMAGE_VALUES)},
+    }
+    logger.info("Session statistics from %d of %d acquisition xmls (%s), %d of %d GridSquares", len(read),
+                len(paths), "full scan" if full_scan else f"{statistics['sampling_fraction']:.2%} sample",
+                statistics["squares_sampled"], statistics["squares"])
+    return statistics
+
+
+def write_session_statistics(statistics, output_dir, session):
+    """Writes the session statistics to <session>_statistics.json, returning its path."""
+    path = output_dir + '/' + session + '_statistics.json'
+    with open(path, "w") as f:
+        json.dump(statistics, f, indent=4)
+    return path
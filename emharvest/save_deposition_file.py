@@ -1,11 +1,67 @@
+import os
+import logging
 import pandas as pd
 import numpy as np
 import json
-import urllib
-import hashlib
 
+from emharvest.catalogue import upsert_session
+from emharvest.checksum_manifest import sha256_file
+from emharvest.profiling import stage
+from emharvest.dataset_sink import append_deposition_record, dataset_columns
 from emharvest.mmcif_writer import translate_xml_to_cif
-from emharvest.mmcif_validator import *
+from emharvest.mmcif_validator import mmcif_validation, default_dictionary_path
+from emharvest.mmcif_dictionary import download_dictionary, ensure_dictionary_index, validate_with_index
+from emharvest.result_cache import OUTPUT_SUFFIXES
+
+logger = logging.getLogger(__name__)
+
+# mmCIF items written for every session, keyed by the deposition CSV row names
+MMCIF_ITEMS = {
+    'Microscope': 'em_imaging.microscope_model',
+    'microscope_serial_number': 'em_imaging.microscope_serial_number',
+    'software_name': 'em_software.name',
+    'software_version': 'em_software.version',
+    'software_category': 'em_software.category',
+    'date': 'em_imaging.date',
+    'eV': 'em_imaging.accelerating_voltage',
+    'mag': 'em_imaging.nominal_magnification',
+    'apix': '?',
+    'nominal_defocus_min_microns': 'em_imaging.nominal_defocus_min',
+    'nominal_defocus_max_microns': 'em_imaging.nominal_defocus_max',
+    'spot_size': '?',
+    'C2_micron': 'em_imaging.c2_aperture_diameter',
+    'Objective_micron': '?',
+    'Beam_diameter_micron': '?',
+    'collection': '?',
+    'number_of_images': '?',
+    "microscope_mode": 'em_imaging.mode',
+    "grid_material": 'em_support_film.material',
+    "grid_topology": 'em_support_film.topology',
+    "detector_name": "em_image_recording.film_or_detector_model",
+    "dose_rate": "em_image_recording.avg_electron_dose_per_image",
+    "avg_exposure_time": "em_image_recording.average_exposure_time",
+    "detector_mode": "em_image_recording.detector_mode",
+    "illumination_mode": "em_imaging.illumination_mode",
+    "slit_width": "em_imaging_optics.energyfilter_slit_width",
+    "electron_source": "em_imaging.electron_source",
+    "tilt_angle_min": "em_imaging.tilt_angle_min",
+    "tilt_angle_max": "em_imaging.tilt_angle_max",
+    "objectiveAperture": "em_imaging.objective_aperture"
+}
+
+# Additional mmCIF items for EPU tomography sessions
+TOMO_MMCIF_ITEMS = {
+    "pixel_spacing_x": "em_map.pixel_spacing_x",
+    "pixel_spacing_y": "em_map.pixel_spacing_y",
+    "pixel_spacing_z": "em_map.pixel_spacing_z",
+    "angle_increment": "em_tomography.axis1_angle_increment",
+    "rotation_axis": "em_tomography.dual_tilt_axis_rotation",
+    "max_angle": "em_tomography.axis1_max_angle",
+    "min_angle": "em_tomography.axis1_min_angle",
+    "angle2_increment": "em_tomography.axis2_angle_increment",
+    "max_angle2": "em_tomography.axis2_max_angle",
+    "min_angle2": "em_tomography.axis2_min_angle"
+}
 
 def SubFramePath(CompleteDataDict, n):
     """
@@ -36,13 +92,7 @@ def checksum(path, out):
        Returns:
            None
     """
-    filename = path
-    sha256_hash = hashlib.sha256()
-    with open(filename, "rb") as f:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-        checksum = sha256_hash.hexdigest()
+    checksum = sha256_file(path)
 
     # Open file for writing
     checkfile = open(out, "w")
@@ -51,8 +101,7 @@ def checksum(path, out):
     # Close file
     checkfile.close()
 
-    print('Created checksum')
-    print()
+    logger.info('Created checksum %s', out)
 
 def save_deposition_file(CompleteDataDict):
     """
@@ -62,11 +111,68 @@ def save_deposition_file(CompleteDataDict):
             CompleteDataDict (dict): A dictionary containing the complete data.
 
         Returns:
-            None
+            dict: The structured mmCIF validation result (see mmcif_validation).
     """
     from emharvest.emharvest_main import parse_arguments
 
     args = parse_arguments()
+    tables = deposition_tables(CompleteDataDict, args)
+    write_deposition_csv(tables, args.output_dir)
+    depfilepath = write_deposition_json(tables, args.output_dir)
+
+    # Deposition Checksum
+    with stage("checksum"):
+        write_deposition_checksum(depfilepath)
+
+    # Facility-wide columnar dataset, one row per harvested session
+    if args.dataset_dir:
+        with stage("dataset"):
+            append_deposition_record(tables["nested_dict"], tables["session"], args.dataset_dir,
+                                     dataset_columns(MMCIF_ITEMS, TOMO_MMCIF_ITEMS, MOVIE_MMCIF_ITEMS), args.dataset_format,
+                                     tables["session_path"])
+
+    # Facility-wide catalogue, queried with emharvest query
+    if args.catalogue:
+        with stage("catalogue"):
+            upsert_session(args.catalogue, tables, CompleteDataDict, args)
+
+    with stage("write_cif"):
+        cif_filepath = write_deposition_cif(tables, args.output_dir)
+
+    with stage("validation"):
+        validation = validate_deposition_cif(args, cif_filepath, tables["session"])
+
+    # Files written for this session, reused from the result cache when nothing changed
+    save_deposition_file.session = tables["session"]
+    save_deposition_file.outputs = deposition_outputs(args.output_dir, tables["session"])
+    save_deposition_file.sinks = sink_inputs(tables, CompleteDataDict)
+    return validation
+
+# Additional mmCIF items for sessions whose movie headers were read (--movie_headers)
+MOVIE_MMCIF_ITEMS = {
+    "frames_per_image": "em_image_scans.frames_per_image",
+    "movie_width": "em_image_scans.dimension_width",
+    "movie_height": "em_image_scans.dimension_height",
+    "movie_count": "?",
+    "total_frames": "?",
+    "movie_compression": "?"
+}
+
+
+def deposition_tables(CompleteDataDict, args):
+    """
+        Builds the deposition tables of a session, ready to be written by the write_deposition_* functions.
+
+        Args:
+            CompleteDataDict (dict): A dictionary containing the complete data.
+            args (argparse.Namespace): The parsed command line arguments.
+
+        Returns:
+            dict: The session name and absolute directory, the deposition values by CSV row name, the CSV table,
+            the nested JSON record and the mmCIF items.
+    """
+    from emharvest.emharvest_main import session_path
+
     # Save doppio deposition csv file
     dictHorizontal1 = {
         'Microscope': CompleteDataDict['model'],
@@ -113,53 +219,18 @@ def save_deposition_file(CompleteDataDict):
                                 'max_angle2': '?',
                                 'min_angle2': '?'
                                 })
+    movies = 'frames_per_image' in CompleteDataDict
+    if movies:
+        dictHorizontal1.update({key: CompleteDataDict[key] for key in MOVIE_MMCIF_ITEMS})
 
     df1 = pd.DataFrame([dictHorizontal1])
 
     # Sample data for the second row
-    dictHorizontal2 = {
-        'Microscope': 'em_imaging.microscope_model',
-        'microscope_serial_number': 'em_imaging.microscope_serial_number',
-        'software_name': 'em_software.name',
-        'software_version': 'em_software.version',
-        'software_category': 'em_software.category',
-        'date': 'em_imaging.date',
-        'eV': 'em_imaging.accelerating_voltage',
-        'mag': 'em_imaging.nominal_magnification',
-        'apix': '?',
-        'nominal_defocus_min_microns': 'em_imaging.nominal_defocus_min',
-        'nominal_defocus_max_microns': 'em_imaging.nominal_defocus_max',
-        'spot_size': '?',
-        'C2_micron': 'em_imaging.c2_aperture_diameter',
-        'Objective_micron': '?',
-        'Beam_diameter_micron': '?',
-        'collection': '?',
-        'number_of_images': '?',
-        "microscope_mode": 'em_imaging.mode',
-        "grid_material": 'em_support_film.material',
-        "grid_topology": 'em_support_film.topology',
-        "detector_name": "em_image_recording.film_or_detector_model",
-        "dose_rate": "em_image_recording.avg_electron_dose_per_image",
-        "avg_exposure_time": "em_image_recording.average_exposure_time",
-        "detector_mode": "em_image_recording.detector_mode",
-        "illumination_mode": "em_imaging.illumination_mode",
-        "slit_width": "em_imaging_optics.energyfilter_slit_width",
-        "electron_source": "em_imaging.electron_source",
-        "tilt_angle_min": "em_imaging.tilt_angle_min",
-        "tilt_angle_max": "em_imaging.tilt_angle_max",
-        "objectiveAperture": "em_imaging.objective_aperture"
-    }
+    dictHorizontal2 = dict(MMCIF_ITEMS)
     if args.mode == "TOMO" and args.category != "serialEM":
-        dictHorizontal2.update({"pixel_spacing_x": "em_map.pixel_spacing_x",
-                                "pixel_spacing_y": "em_map.pixel_spacing_y",
-                                "pixel_spacing_z": "em_map.pixel_spacing_z",
-                                "angle_increment": "em_tomography.axis1_angle_increment",
-                                "rotation_axis": "em_tomography.dual_tilt_axis_rotation",
-                                "max_angle": "em_tomography.axis1_max_angle",
-                                "min_angle": "em_tomography.axis1_min_angle",
-                                "angle2_increment": "em_tomography.axis2_angle_increment",
-                                "max_angle2": "em_tomography.axis2_max_angle",
-                                "min_angle2": "em_tomography.axis2_min_angle"})
+        dictHorizontal2.update(TOMO_MMCIF_ITEMS)
+    if movies:
+        dictHorizontal2.update(MOVIE_MMCIF_ITEMS)
 
     df2 = pd.DataFrame([dictHorizontal2])
 
@@ -167,10 +238,6 @@ def save_deposition_file(CompleteDataDict):
     df = pd.concat([df1, df2], ignore_index=True, sort=False)
     # df = df1.merge(df2, left_index=0, right_index=0)
 
-    ## Deposition file
-    depfilepath = args.output_dir + '/' + CompleteDataDict['main_sessionName'] + '_dep.json'
-    checksumpath = args.output_dir + '/' + CompleteDataDict['main_sessionName'] + '_dep.checksum'
-
     # Human readable deposition file
     # df.to_csv (args.output_dir+'/'+sessionName+'.dep', index = False, header=True)
     # Manual headings
@@ -225,6 +292,13 @@ def save_deposition_file(CompleteDataDict):
                                   '[CryoTomo is usually single axis tilt]',
                                   '[CryoTomo is usually single axis tilt]',
                                   '[CryoTomo is usually single axis tilt]'])
+    if movies:
+        tfs_xml_path_list.extend(['[Fractions movie][IFD count]',
+                                  '[Fractions movie][IFD 0][ImageWidth]',
+                                  '[Fractions movie][IFD 0][ImageLength]',
+                                  '[Fractions movie] count',
+                                  '[Fractions movie][IFD count] sum',
+                                  '[Fractions movie][IFD 0][Compression]'])
 
     emdb_xml_path_list = [
         '[emd][structure_determination_list][structure_determination][microscopy_list]',
@@ -270,6 +344,13 @@ def save_deposition_file(CompleteDataDict):
                                    '[emd][structure_determination_list][structure_determination][microscopy_list][tomgraphy_microscopy][tilt_series][axis2][max_angle]',
                                    '[emd][structure_determination_list][structure_determination][microscopy_list][tomgraphy_microscopy][tilt_series][axis2][min_angle]'
                                    ])
+    if movies:
+        emdb_xml_path_list.extend(['[emd][structure_determination_list][structure_determination][microscopy_list][single_particle_microscopy][image_recording_list][image_recording][digitization_details][frames_per_image]',
+                                   '[emd][structure_determination_list][structure_determination][microscopy_list][single_particle_microscopy][image_recording_list][image_recording][digitization_details][dimensions][width]',
+                                   '[emd][structure_determination_list][structure_determination][microscopy_list][single_particle_microscopy][image_recording_list][image_recording][digitization_details][dimensions][height]',
+                                   '?',
+                                   '?',
+                                   '?'])
 
     # Transpose
     df_transpose = df.T
@@ -286,8 +367,6 @@ def save_deposition_file(CompleteDataDict):
     df_transpose.index.name = 'Items'
     # add square brackets around keys
     df_transpose['JSON'] = df_transpose['JSON'].apply(lambda x: '[' + x.replace('.', '][') + ']')
-    # Save to CSV
-    df_transpose.to_csv(args.output_dir + '/' + CompleteDataDict['main_sessionName'] + '_dep.csv', index=True, header=True)
     df1_selected = df1.apply(lambda x: x.map(lambda item: item.item() if isinstance(item, (np.generic, np.ndarray)) else item) if x.name in df1.columns else x, axis=0)
 
     # df1_selected = df1.applymap(lambda x: x.item() if isinstance(x, (np.generic, np.ndarray)) else x)
@@ -301,34 +380,100 @@ def save_deposition_file(CompleteDataDict):
                 nested_dict[top_key] = {}
             nested_dict[top_key][sub_key] = df1.at[0, col]
 
+    # Input data as cif dictionary
+    cif_dict = {}
+
+    for key in dictHorizontal2:
+        cif_dict[dictHorizontal2[key]] = dictHorizontal1[key]
+
+    return {"session": CompleteDataDict['main_sessionName'], "session_path": session_path(args),
+            "values": dictHorizontal1, "csv": df_transpose, "nested_dict": nested_dict, "cif_dict": cif_dict}
+
+
+def write_deposition_csv(tables, output_dir):
+    """
+        Writes the human readable deposition table and returns its path.
+    """
+    csv_path = output_dir + '/' + tables["session"] + '_dep.csv'
+    tables["csv"].to_csv(csv_path, index=True, header=True)
+    return csv_path
+
+
+def write_deposition_json(tables, output_dir):
+    """
+        Writes the nested deposition record as JSON and returns its path.
+    """
+    depfilepath = output_dir + '/' + tables["session"] + '_dep.json'
     # Convert nested dictionary to JSON
-    json_output = json.dumps(nested_dict, indent=4, default=str)
+    json_output = json.dumps(tables["nested_dict"], indent=4, default=str)
 
     # write to json file
     with open(depfilepath, 'w') as f:
         f.write(json_output)
 
     # This can be run before doing full analysis of the session directories
-    print("Created deposition file")
+    logger.info("Created deposition file %s", depfilepath)
+    return depfilepath
 
-    # Deposition Checksum
-    checksum(depfilepath, checksumpath)
 
-    # Input data as cif dictionary
-    cif_dict = {}
+def write_deposition_checksum(depfilepath):
+    """
+        Writes the checksum of the deposition JSON file next to it and returns its path.
+    """
+    checksumpath = depfilepath[:-len('.json')] + '.checksum'
+    checksum(depfilepath, checksumpath)
+    return checksumpath
 
-    for key in dictHorizontal2:
-        cif_dict[dictHorizontal2[key]] = dictHorizontal1[key]
 
+def write_deposition_cif(tables, output_dir):
+    """
+        Writes the deposition mmCIF file and returns its path.
+    """
     # transalating and writting to cif file
-    print("CIF_DICTIONARY", cif_dict, "\n")
-    translate_xml_to_cif(cif_dict, CompleteDataDict['main_sessionName'])
+    logger.debug("CIF dictionary: %s", tables["cif_dict"])
+    translate_xml_to_cif(tables["cif_dict"], tables["session"])
+    return output_dir + '/' + tables["session"] + '_dep.cif'
 
-    cif_filepath = args.output_dir + '/' + CompleteDataDict['main_sessionName'] + '_dep.cif'
-    dic_path = os.path.join(os.getcwd(), "mmcif_dictionary/mmcif_pdbx_v50.dic")
 
-    if args.download_dict == "yes":
-        urllib.request.urlretrieve("https://mmcif.wwpdb.org/dictionaries/ascii/mmcif_pdbx_v50.dic", dic_path)
-    validation_output = args.output_dir + '/' + 'val_' + CompleteDataDict['main_sessionName'] + '.txt'
-    mmcif_validation(cif_filepath, dic_path, validation_output)
+def deposition_outputs(output_dir, session):
+    """
+        Returns the paths of every file written for a session by save_deposition_file.
+    """
+    outputs = [output_dir + '/' + session + suffix for suffix in OUTPUT_SUFFIXES]
+    outputs.append(output_dir + '/' + 'val_' + session + '.txt')
+    return outputs
+
+def sink_inputs(tables, record):
+    """
+        Returns the deposition values the dataset and catalogue are written from, as plain JSON values, kept in
+        the result cache so a cached session is still added to both.
+    """
+    inputs = {"values": tables["values"], "nested_dict": tables["nested_dict"], "presets": record.get("presets")}
+    return json.loads(json.dumps(inputs, default=lambda value: value.item() if hasattr(value, "item") else str(value)))
+
+def validate_deposition_cif(args, cif_filepath, sessionName):
+    """
+        Validates the deposition mmCIF file against the cached dictionary subset, or the full dictionary.
+
+        Args:
+            args (argparse.Namespace): The parsed command line arguments.
+            cif_filepath (str): The path to the deposition mmCIF file.
+            sessionName (str): The session name used for the validation report file name.
+
+        Returns:
+            dict: The structured validation result.
+    """
+    dic_path = args.dict_path or default_dictionary_path()
+    validation_output = args.output_dir + '/' + 'val_' + sessionName + '.txt'
+
+    if args.full_validation:
+        if args.download_dict == "yes":
+            download_dictionary(dic_path)
+        return mmcif_validation(cif_filepath, dic_path, validation_output)
+
+    # Validate against the cached em_* subset of the dictionary, compiled once and usable offline
+    index = ensure_dictionary_index(dic_path, download=args.download_dict == "yes")
+    if index is None:
+        return mmcif_validation(cif_filepath, dic_path, validation_output)
+    return validate_with_index(cif_filepath, index, validation_output)
 
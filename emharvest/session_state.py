@@ -0,0 +1,171 @@
+import os
+import glob
+import json
+import fnmatch
+import logging
+
+import numpy as np
+
+from emharvest.sources import DATA_FOLDERS
+
+STATE_FORMAT = 1
+STATE_FILENAME = "harvest_state.json"
+
+logger = logging.getLogger(__name__)
+
+
+def _file_stamp(path):
+    """Identifies an input file by its size and mtime, None when it does not exist."""
+    if not path or not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _json_value(value):
+    # numpy scalars from the session tables keep their value, anything else is stored as text
+    return value.item() if isinstance(value, np.generic) else str(value)
+
+
+def state_path(output_dir):
+    return os.path.join(output_dir, STATE_FILENAME)
+
+
+def load_session_state(output_dir, session_dir):
+    """
+        Reads the state left by the last incremental harvest of a session.
+
+        Args:
+            output_dir (str): The output directory of the session.
+            session_dir (str): The session directory, a state written for another session is ignored.
+
+        Returns:
+            dict: The state, or an empty state when there is none to reuse.
+    """
+    empty = {"format": STATE_FORMAT, "session_dir": os.path.abspath(session_dir), "images": {}, "record": None,
+             "inputs": None, "files": {}}
+    try:
+        with open(state_path(output_dir), "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return empty
+    if state.get("format") != STATE_FORMAT or state.get("session_dir") != empty["session_dir"]:
+        logger.info("Ignoring the harvest state in %s, it was written for another session", output_dir)
+        return empty
+    state.setdefault("files", {})
+    return state
+
+
+def file_cache(state, kind):
+    """
+        The per-file results of one kind (e.g. movie headers) kept in the state, for incremental_file_results.
+
+        Returns:
+            dict: None without a state, so callers read every file.
+    """
+    if state is None:
+        return None
+    return state["files"].setdefault(kind, {})
+
+
+def save_session_state(output_dir, state):
+    """Writes the session state atomically, so an interrupted harvest leaves the previous state intact."""
+    path = state_path(output_dir)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1, default=_json_value)
+    os.replace(tmp_path, path)
+    return path
+
+
+def input_stamps(*paths):
+    """The size and mtime of the files a deposition record is parsed from, e.g. EpuSession.dm."""
+    return {os.path.abspath(path): _file_stamp(path) for path in paths if path}
+
+
+def _data_folders(session_dir):
+    """
+        The GridSquare Data folders of an EPU session, with their mtimes. They are globbed with the DATA_FOLDERS
+        pattern find_mics and the full harvest stages search, so both find the same images.
+    """
+    for data_dir in sorted(glob.glob(session_dir + DATA_FOLDERS)):
+        if os.path.isdir(data_dir):
+            yield os.path.relpath(data_dir, session_dir), data_dir, os.stat(data_dir).st_mtime_ns
+
+
+def incremental_file_results(session_dir, cache, match, read, reread=None):
+    """
+        Reads the files of the GridSquare Data folders that were added since the last harvest, reusing the
+        results kept for the others.
+
+        Like scan_images, Data folders whose mtime did not change are not listed again. Files whose result
+        asks for it (reread, e.g. a movie still being written) are read again.
+
+        Args:
+            session_dir (str): The EPU session directory.
+            cache (dict): The results of the last harvest (file_cache), updated in place.
+            match (callable): Selects the file names to read.
+            read (callable): Reads a list of paths, returning one JSON serializable result per path.
+            reread (callable, optional): True for the results of files to read again.
+
+        Returns:
+            tuple: (path and result of every file, in Data folder and name order, number of files read).
+    """
+    folders = {}
+    to_read = []
+    for key, data_dir, mtime_ns in _data_folders(session_dir):
+        previous = cache.get(key)
+        if previous and previous["mtime_ns"] == mtime_ns:
+            names = list(previous["results"])
+        else:
+            names = sorted(name for name in os.listdir(data_dir) if match(name) and not name.startswith('.'))
+        old = previous["results"] if previous else {}
+        results = {}
+        for name in names:
+            if name in old and not (reread and reread(old[name])):
+                results[name] = old[name]
+            else:
+                results[name] = None
+                to_read.append((key, name))
+        folders[key] = {"mtime_ns": mtime_ns, "results": results}
+
+    paths = [os.path.join(session_dir, key, name) for key, name in to_read]
+    for (key, name), result in zip(to_read, read(paths) if paths else []):
+        folders[key]["results"][name] = result
+    cache.clear()
+    cache.update(folders)
+    return [(os.path.join(session_dir, key, name), result) for key, folder in folders.items()
+            for name, result in folder["results"].items()], len(to_read)
+
+
+def scan_images(session_dir, images, search='xml'):
+    """
+        Counts the acquisition images of an EPU session, only listing the Data folders that changed.
+
+        Adding or removing a file changes the mtime of its folder, so Data folders with the mtime recorded in
+        the last scan are not listed again. The images matched are the ones find_mics globs for:
+        <session>/*/GridSquare*/Data/*<search>*.
+
+        Args:
+            session_dir (str): The EPU session directory.
+            images (dict): The image index of the last scan, Data folder mapped to its mtime and image names.
+            search (str, optional): The image file name search term.
+
+        Returns:
+            tuple: (number of images, the updated index, number of images not seen in the last scan).
+    """
+    updated = {}
+    total = 0
+    new = 0
+    for key, data_dir, mtime_ns in _data_folders(session_dir):
+        previous = images.get(key)
+        if previous and previous["mtime_ns"] == mtime_ns:
+            names = previous["names"]
+        else:
+            names = sorted(name for name in os.listdir(data_dir)
+                           if fnmatch.fnmatch(name, '*' + search + '*') and not name.startswith('.'))
+            seen = set(previous["names"]) if previous else set()
+            new += sum(name not in seen for name in names)
+        updated[key] = {"mtime_ns": mtime_ns, "names": names}
+        total += len(names)
+    return total, updated, new
@@ -0,0 +1,398 @@
+import io
+import os
+import hashlib
+import glob
+import fnmatch
+import logging
+import tarfile
+import zipfile
+import posixpath
+import threading
+from collections import Counter
+
+from emharvest.checksum_manifest import sha256_file
+from emharvest.object_store import get_filesystem, split_url
+
+# Inputs are local paths, object store URLs (e.g. s3://bucket/session/EpuSession.dm) or archive members.
+# A file inside an archive is written <archive>::<member>, e.g. session.tar.gz::Supervisor_1/EpuSession.dm
+ARCHIVE_SEPARATOR = "::"
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz", ".zip")
+# Magic numbers of the compressions tarballs can only be read front to back with
+STREAM_MAGIC = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00")
+# The files searchSupervisorAtlas and searchSupervisorData read, (name pattern, excluded path part). The
+# first member matching each is kept while a compressed tarball is indexed, so the harvest needs no second pass.
+REPRESENTATIVE_MEMBERS = [("EpuSession.dm", None), ("ScreeningSession.dm", None), ("Atlas*.xml", None),
+                          ("Tile*.xml", None), ("GridSquare*.xml", None), ("FoilHole*.xml", "Data"),
+                          ("FoilHole*Data*.xml", None)]
+# The GridSquare folders of an EPU session and their acquisition Data folders, one level below the session
+# (e.g. Images-Disc1). Every search for acquisitions, and the incremental scans, use these patterns
+SQUARE_FOLDERS = "/*/GridSquare*"
+DATA_FOLDERS = SQUARE_FOLDERS + "/Data"
+
+logger = logging.getLogger(__name__)
+
+
+def split_archive_path(path):
+    """
+        Splits an input path into its archive and the member inside it.
+
+        Returns:
+            tuple: (archive, member), member being '' for the whole archive. (None, path) for plain paths.
+    """
+    path = str(path)
+    # Archives are read from local storage, an archive in an object store is one object
+    if split_url(path)[0]:
+        return None, path
+    if ARCHIVE_SEPARATOR in path:
+        archive, member = path.split(ARCHIVE_SEPARATOR, 1)
+        return archive, _normalize(member)
+    if path.lower().endswith(ARCHIVE_SUFFIXES):
+        return path, ""
+    return None, path
+
+
+def is_archive_input(path):
+    return bool(path) and split_archive_path(path)[0] is not None
+
+
+def is_remote_input(path):
+    return bool(path) and split_url(path)[0] is not None
+
+
+def is_local_input(path):
+    """True for files on a local or network filesystem, which every reader can open."""
+    return not is_archive_input(path) and not is_remote_input(path)
+
+
+def _normalize(name):
+    name = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    return "" if name == "." else name
+
+
+def _join(archive, member):
+    return archive + ARCHIVE_SEPARATOR + member
+
+
+class ArchiveIndex:
+    """
+        Member index of a tar or zip archive, built once and shared by every reader of the archive.
+
+        Zip archives and uncompressed tarballs are read at random: each member is read at its offset, without
+        touching the others. Compressed tarballs can only be decompressed front to back, so they are indexed in
+        one sequential pass that also keeps the REPRESENTATIVE_MEMBERS (and any wanted member) in memory.
+        Reading another member needs a further pass, many members are read together with iter_read.
+
+        Args:
+            path (str): The archive.
+            wanted (list, optional): Member names kept in memory while a compressed tarball is indexed.
+    """
+
+    def __init__(self, path, wanted=()):
+        self.path = os.path.abspath(path)
+        self.members = {}
+        self.kept = {}
+        self._zip = None
+        with open(self.path, "rb") as f:
+            magic = f.read(6)
+        if zipfile.is_zipfile(self.path):
+            self.kind = "zip"
+            self._zip = zipfile.ZipFile(self.path)
+            for info in self._zip.infolist():
+                if not info.is_dir():
+                    self.members[_normalize(info.filename)] = info
+        elif magic.startswith(STREAM_MAGIC):
+            self.kind = "stream"
+            self._index_stream(set(wanted))
+        else:
+            self.kind = "tar"
+            # Only the member headers are read, tarfile seeks over the member data
+            with tarfile.open(self.path, "r:") as tar:
+                for member in tar:
+                    if member.isreg() and not member.issparse():
+                        self.members[_normalize(member.name)] = (member.offset_data, member.size)
+        logger.info("Indexed %d members of %s (%s)", len(self.members), self.path,
+                    "one sequential pass" if self.kind == "stream" else "random access")
+
+    def _index_stream(self, wanted):
+        representatives = list(REPRESENTATIVE_MEMBERS)
+        with tarfile.open(self.path, "r|*") as tar:
+            for member in tar:
+                if not member.isreg():
+                    continue
+                name = _normalize(member.name)
+                self.members[name] = member.size
+                keep = name in wanted
+                basename = posixpath.basename(name)
+                for rule in representatives:
+                    pattern, exclude = rule
+                    if fnmatch.fnmatch(basename, pattern) and not (exclude and exclude in name):
+                        representatives.remove(rule)
+                        keep = True
+                        break
+                if keep:
+                    self.kept[name] = tar.extractfile(member).read()
+        logger.debug("Kept %d representative members of %s", len(self.kept), self.path)
+
+    def names(self, prefix=""):
+        """The member names below prefix, in archive order."""
+        if not prefix:
+            return list(self.members)
+        prefix = prefix.rstrip("/") + "/"
+        return [name for name in self.members if name.startswith(prefix)]
+
+    def read(self, name):
+        """
+            Returns:
+                bytes: The content of a member, FileNotFoundError when the archive has no such member.
+        """
+        if name in self.kept:
+            return self.kept[name]
+        if name not in self.members:
+            raise FileNotFoundError(f"{name} not found in {self.path}")
+        if self.kind == "zip":
+            return self._zip.read(self.members[name])
+        if self.kind == "tar":
+            offset, size = self.members[name]
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                return f.read(size)
+        logger.debug("Reading %s needs another pass over %s", name, self.path)
+        return next(self.iter_read([name]))[1]
+
+    def iter_read(self, names):
+        """
+            Reads many members, yielding (name, bytes) in the order of names.
+
+            A compressed tarball is read in one pass, members reached before their turn are buffered until
+            it comes, so names in archive order (as listed by names and glob_inputs) need no buffer.
+        """
+        names = list(names)
+        if self.kind != "stream":
+            for name in names:
+                yield name, self.read(name)
+            return
+        missing = [name for name in names if name not in self.members]
+        if missing:
+            raise FileNotFoundError(f"{missing[0]} not found in {self.path}")
+        remaining = Counter(names)
+        position = 0
+        buffered = {}
+        with tarfile.open(self.path, "r|*") as tar:
+            for member in tar:
+                name = _normalize(member.name)
+                if not remaining[name] or not member.isreg() or name in buffered:
+                    continue
+                buffered[name] = tar.extractfile(member).read()
+                while position < len(names) and names[position] in buffered:
+                    name = names[position]
+                    data = buffered[name]
+                    # The same member may be asked for more than once
+                    remaining[name] -= 1
+                    if not remaining[name]:
+                        del buffered[name]
+                    yield name, data
+                    position += 1
+                if position == len(names):
+                    return
+
+
+_indexes = {}
+_index_locks = {}
+_lock = threading.Lock()
+
+
+def archive_index(archive, wanted=()):
+    """Returns the ArchiveIndex of an archive, built on first use and shared by the harvest stages."""
+    archive = os.path.abspath(archive)
+    with _lock:
+        index_lock = _index_locks.setdefault(archive, threading.Lock())
+    # Stages running concurrently on the same archive wait for one index rather than each building their own
+    with index_lock:
+        if archive not in _indexes:
+            _indexes[archive] = ArchiveIndex(archive, wanted)
+        return _indexes[archive]
+
+
+def _remote(path):
+    protocol, key = split_url(path)
+    return get_filesystem(protocol), key
+
+
+def resolve_input(path, name):
+    """
+        Resolves a session file given as a whole archive, or as an object store folder (ending in /), to the
+        first file called name in it, e.g. EpuSession.dm.
+
+        Returns:
+            str: <archive>::<member> for archives, the object URL for folders, path unchanged otherwise.
+    """
+    if is_remote_input(path):
+        fs, key = _remote(path)
+        if not path.endswith("/"):
+            fs.info(key)
+            return path
+        for candidate in sorted(fs.find(key)):
+            if posixpath.basename(candidate) == name:
+                logger.info("Found %s", fs.url(candidate))
+                return fs.url(candidate)
+        raise FileNotFoundError(f"No {name} found in {path}")
+    archive, member = split_archive_path(path)
+    if archive is None:
+        return path
+    if member:
+        archive_index(archive, [member])
+        return _join(archive, member)
+    for candidate in archive_index(archive).names():
+        if posixpath.basename(candidate) == name:
+            logger.info("Found %s in %s", candidate, archive)
+            return _join(archive, candidate)
+    raise FileNotFoundError(f"No {name} found in {archive}")
+
+
+def input_dirname(path):
+    """os.path.dirname of an input path, inside the archive for archive members."""
+    if is_remote_input(path):
+        return posixpath.dirname(path)
+    archive, member = split_archive_path(path)
+    if archive is None:
+        return os.path.dirname(path)
+    return _join(archive, posixpath.dirname(member))
+
+
+def input_abspath(path):
+    """The absolute form of an input path, which identifies a session wherever it was harvested from."""
+    if is_remote_input(path):
+        return str(path)
+    archive, member = split_archive_path(path)
+    if archive is None:
+        return os.path.abspath(path)
+    return _join(os.path.abspath(archive), member) if member else os.path.abspath(archive)
+
+
+def input_state(path, content=False):
+    """
+        Identifies an input by its size and version, or its content hash, for the result cache. Archive
+        members are identified by their archive, objects by their listing.
+
+        Returns:
+            dict: None when the input does not exist.
+    """
+    if is_remote_input(path):
+        fs, key = _remote(path)
+        try:
+            info = fs.info(key)
+        except FileNotFoundError:
+            return None
+        if content:
+            return {"path": path, "sha256": hashlib.sha256(fs.cat(key)).hexdigest()}
+        return {"path": path, "size": info["size"], "version": str(info["version"])}
+    file_path = split_archive_path(path)[0] or path
+    if not os.path.isfile(file_path):
+        return None
+    if content:
+        return {"path": os.path.abspath(path), "sha256": sha256_file(file_path)}
+    st = os.stat(file_path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def listing_digest(path):
+    """
+        Digests the names, sizes and versions of the objects below an object store folder, the counterpart of
+        result_cache.directory_index_digest for remote sessions. None for other paths.
+    """
+    if not is_remote_input(path):
+        return None
+    fs, key = _remote(path)
+    digest = hashlib.sha256()
+    for name, info in sorted(fs.find(key).items()):
+        digest.update(f"{name}\0{info['size']}\0{info['version']}\n".encode())
+    return digest.hexdigest()
+
+
+def read_input(path):
+    """Reads a file, an object or an archive member as bytes."""
+    if is_remote_input(path):
+        fs, key = _remote(path)
+        return fs.cat(key)
+    archive, member = split_archive_path(path)
+    if archive is None:
+        with open(path, "rb") as f:
+            return f.read()
+    return archive_index(archive).read(member)
+
+
+def open_input(path, mode="r"):
+    """
+        Opens a file, an object or an archive member for reading.
+
+        Objects opened in binary mode are read a block at a time, other objects and archive members are read
+        whole into memory.
+
+        Args:
+            path (str): A plain path, an object store URL or <archive>::<member>.
+            mode (str, optional): "r" for text, "rb" for bytes.
+    """
+    if is_local_input(path):
+        return open(path, mode)
+    if is_remote_input(path) and "b" in mode:
+        fs, key = _remote(path)
+        return fs.open(key)
+    data = read_input(path)
+    return io.BytesIO(data) if "b" in mode else io.StringIO(data.decode("utf-8"))
+
+
+def find_inputs(pattern, path):
+    """
+        Lists the files below an archive or object store directory whose name matches pattern, as
+        atlas_files.findpattern.
+
+        Returns:
+            list: The paths relative to path, in archive order for archives and sorted for objects.
+    """
+    if is_remote_input(path):
+        fs, prefix = _remote(path)
+        names = sorted(fs.find(prefix))
+    else:
+        archive, prefix = split_archive_path(path)
+        names = archive_index(archive).names(prefix)
+    return [posixpath.relpath(name, prefix or ".") for name in names
+            if fnmatch.fnmatch(posixpath.basename(name), pattern)]
+
+
+def _glob_match(name, parts):
+    # As in glob.glob without recursive, ** matches one directory level like *
+    segments = name.split("/")
+    return len(segments) == len(parts) and all(fnmatch.fnmatchcase(segment, part.replace("**", "*"))
+                                               for segment, part in zip(segments, parts))
+
+
+def glob_inputs(pattern):
+    """
+        glob.glob for plain paths, objects and archive members.
+
+        Returns:
+            list: The matching paths, in archive order for archive members and sorted otherwise.
+    """
+    if is_remote_input(pattern):
+        fs, key_pattern = _remote(pattern)
+        parts = posixpath.normpath(key_pattern).split("/")
+        # Only the folder before the first wildcard is listed
+        literal = next((index for index, part in enumerate(parts) if glob.has_magic(part)), len(parts))
+        return [fs.url(key) for key in sorted(fs.find("/".join(parts[:literal]))) if _glob_match(key, parts)]
+    archive, member_pattern = split_archive_path(pattern)
+    if archive is None:
+        return sorted(glob.glob(pattern))
+    parts = member_pattern.split("/")
+    return [_join(archive, name) for name in archive_index(archive).names() if _glob_match(name, parts)]
+
+
+def sequential_archive(paths):
+    """
+        Returns the ArchiveIndex of a compressed tarball all the paths are members of, None otherwise, so
+        readers of many members can take them from one pass with iter_read.
+    """
+    archives = {split_archive_path(path)[0] for path in paths}
+    if len(archives) != 1 or None in archives:
+        return None
+    index = archive_index(archives.pop())
+    return index if index.kind == "stream" else None
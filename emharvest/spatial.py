@@ -0,0 +1,274 @@
+import os
+import re
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import ConvexHull, QhullError, cKDTree
+
+from emharvest.prefetch import DEFAULT_DEPTH, Prefetcher
+from emharvest.sources import DATA_FOLDERS, SQUARE_FOLDERS, glob_inputs
+
+# The xmls of each kind of target, relative to the EPU session directory
+TARGET_PATTERNS = {
+    "square": SQUARE_FOLDERS + "/GridSquare*.xml",
+    "hole": SQUARE_FOLDERS + "/FoilHoles/FoilHole*.xml",
+    "acquisition": DATA_FOLDERS + "/*.xml",
+}
+# Acquisitions closer than this (microns) were taken from the same stage position
+STAGE_TOLERANCE_UM = 0.01
+
+_STAGE_POSITION = re.compile(rb"<stage>.*?<Position>.*?<X>([^<]*)</X>\s*<Y>([^<]*)</Y>", re.DOTALL)
+HOLE_ID = re.compile(r"FoilHole_(\d+)_")
+
+logger = logging.getLogger(__name__)
+
+
+def _percentiles(values):
+    if not len(values):
+        return None
+    low, median, high = np.percentile(values, [5, 50, 95])
+    return {"p5": round(float(low), 3), "median": round(float(median), 3), "p95": round(float(high), 3)}
+
+
+def stage_position(data):
+    """
+        Matches the stage position in the raw bytes of an EPU image xml.
+
+        Returns:
+            tuple: (x, y) in metres, None when the xml has no stage position.
+    """
+    match = _STAGE_POSITION.search(data)
+    if not match:
+        return None
+    try:
+        return float(match.group(1)), float(match.group(2))
+    except ValueError:
+        return None
+
+
+def read_target_positions(session_dir, depth=DEFAULT_DEPTH):
+    """
+        Reads the stage position of every GridSquare, FoilHole and acquisition xml of an EPU session.
+
+        The xmls are read ahead with a Prefetcher and the position is matched in the raw bytes, so no xml is
+        parsed.
+
+        Args:
+            session_dir (str): The EPU session directory.
+            depth (int, optional): Files read ahead of the one being matched.
+
+        Returns:
+            pandas.DataFrame: One row per target with its kind, GridSquare, FoilHole id and x, y in microns.
+                Targets without a stage position are left out.
+    """
+    paths = []
+    kinds = []
+    for kind, pattern in TARGET_PATTERNS.items():
+        found = glob_inputs(session_dir + pattern)
+        paths += found
+        kinds += [kind] * len(found)
+
+    xy = np.full((len(paths), 2), np.nan)
+    prefetcher = Prefetcher(paths, depth, isolate=True)
+    for index, (path, data) in enumerate(prefetcher):
+        position = stage_position(data)
+        if position:
+            xy[index] = position
+    prefetcher.log_stats("target xmls")
+
+    squares = [os.path.basename(os.path.dirname(path)) if kind == "square"
+               else os.path.basename(os.path.dirname(os.path.dirname(path))) for path, kind in zip(paths, kinds)]
+    holes = [(HOLE_ID.match(os.path.basename(path)) or [None, None])[1] for path in paths]
+    targets = pd.DataFrame({"kind": pd.Categorical(kinds, categories=list(TARGET_PATTERNS)), "square": squares,
+                            "hole": holes, "x": xy[:, 0] * 1e6, "y": xy[:, 1] * 1e6})
+    missing = int(np.isnan(xy[:, 0]).sum())
+    if missing:
+        logger.warning("%d target xmls have no stage position", missing)
+    return targets.dropna(subset=["x", "y"]).reset_index(drop=True)
+
+
+class TargetIndex:
+    """
+        KD-tree index of the targets of one kind, e.g. the FoilHoles of a session.
+
+        Neighbours and spacings are answered by the tree, in O(n log n) rather than by comparing
+        every pair of targets, so sessions with millions of targets are indexed in seconds.
+
+        Args:
+            xy (numpy.ndarray): (n, 2) target positions in microns.
+    """
+
+    def __init__(self, xy):
+        self.xy = np.ascontiguousarray(xy, dtype=np.float64).reshape(-1, 2)
+        # Sliding midpoint splits build much faster than balanced ones, for about the same query time
+        self.tree = cKDTree(self.xy, balanced_tree=False, compact_nodes=False) if len(self.xy) else None
+
+    def __len__(self):
+        return len(self.xy)
+
+    def nearest_spacing(self):
+        """
+            Returns:
+                numpy.ndarray: The distance from each target to its nearest neighbour, empty for fewer than two.
+        """
+        if len(self) < 2:
+            return np.empty(0)
+        distances, _ = self.tree.query(self.xy, k=2, workers=-1)
+        return distances[:, 1]
+
+    def within(self, x, y, radius):
+        """
+            Returns:
+                list: The indexes of the targets within radius of (x, y).
+        """
+        return self.tree.query_ball_point([x, y], radius) if self.tree is not None else []
+
+
+def stage_position_clusters(acquisitions, holes):
+    """
+        Groups the holes by the stage position they were acquired from, the AFIS clusters EPU acquired.
+
+        Under AFIS, every acquisition of a cluster is recorded at the stage position of the cluster, as
+        optics_groups.holes_per_stage_position counts them. Linking holes by neighbours within the clustering
+        radius instead would chain whole GridSquares together when holes are closer than the radius.
+
+        Args:
+            acquisitions (pandas.DataFrame): The acquisition targets, with their FoilHole id and stage position.
+            holes (pandas.DataFrame): The hole targets, one row per FoilHole, with their own position.
+
+        Returns:
+            tuple: ((n, 2) positions of the acquired holes, cluster label of each, number of clusters).
+    """
+    acquired = acquisitions.dropna(subset=["hole"])
+    stage = np.round(acquired[["x", "y"]].to_numpy() / STAGE_TOLERANCE_UM).reshape(-1, 2)
+    if not len(stage):
+        return np.empty((0, 2)), np.empty(0, dtype=np.int64), 0
+    _, labels = np.unique(stage, axis=0, return_inverse=True)
+    # A hole imaged again from another position stays in the cluster it was first acquired from
+    cluster = pd.Series(labels.reshape(-1), index=acquired["hole"].to_numpy())
+    cluster = cluster[~cluster.index.duplicated()]
+    members = holes[holes["hole"].isin(cluster.index)]
+    _, labels = np.unique(cluster[members["hole"]].to_numpy(), return_inverse=True)
+    return members[["x", "y"]].to_numpy(), labels.reshape(-1), int(labels.max()) + 1 if len(labels) else 0
+
+
+def cluster_extents(xy, labels, count):
+    """
+        Returns:
+            tuple: (targets per cluster, largest distance from each cluster centroid to one of its targets).
+    """
+    sizes = np.bincount(labels, minlength=count)
+    centroid_x = np.bincount(labels, weights=xy[:, 0], minlength=count) / sizes
+    centroid_y = np.bincount(labels, weights=xy[:, 1], minlength=count) / sizes
+    distances = np.hypot(xy[:, 0] - centroid_x[labels], xy[:, 1] - centroid_y[labels])
+    extents = np.zeros(count)
+    np.maximum.at(extents, labels, distances)
+    return sizes, extents
+
+
+def _hull_area(xy):
+    """Area (square microns) of the convex hull of the points, 0 when they do not span an area."""
+    if len(xy) < 3:
+        return 0.0
+    try:
+        # In 2D, the hull "volume" is its area
+        return float(ConvexHull(xy).volume)
+    except QhullError:
+        return 0.0
+
+
+def spatial_summary(targets, clustering_radius=None):
+    """
+        Summarizes the geometry of the targets of a session.
+
+        Args:
+            targets (pandas.DataFrame): The read_target_positions result.
+            clustering_radius (float, optional): The AFIS clustering radius in microns, NaN or None for
+                accurate positioning.
+
+        Returns:
+            dict: The nearest neighbour spacing of the holes and acquisitions, the distinct acquisition stage
+                positions and images per position, the holes acquired from each stage position with their
+                extents against the clustering radius, and per GridSquare the holes, acquisitions, hull area
+                and hole density.
+    """
+    # A hole imaged again is one target
+    holes = targets[targets["kind"] == "hole"].drop_duplicates("hole")
+    acquisitions = targets[targets["kind"] == "acquisition"]
+    hole_index = TargetIndex(holes[["x", "y"]].to_numpy())
+    hole_spacing = hole_index.nearest_spacing()
+
+    # Under AFIS, every acquisition of a cluster is recorded at the stage position of the cluster
+    stage_xy = np.round(acquisitions[["x", "y"]].to_numpy() / STAGE_TOLERANCE_UM).reshape(-1, 2)
+    positions, per_position = np.unique(stage_xy, axis=0, return_counts=True)
+    stage_index = TargetIndex(positions * STAGE_TOLERANCE_UM)
+
+    summary = {
+        "targets": {kind: int(count) for kind, count in targets["kind"].value_counts(sort=False).items()},
+        "holes": len(holes),
+        "hole_spacing_um": _percentiles(hole_spacing),
+        "stage_positions": len(per_position),
+        "images_per_stage_position": {"mean": round(float(per_position.mean()), 2),
+                                      "max": int(per_position.max())} if len(per_position) else None,
+        "stage_move_um": _percentiles(stage_index.nearest_spacing()),
+    }
+
+    cluster_xy, labels, count = stage_position_clusters(acquisitions, holes)
+    if clustering_radius and not np.isnan(clustering_radius) and count:
+        sizes, extents = cluster_extents(cluster_xy, labels, count)
+        summary["clusters"] = {
+            "radius_um": round(float(clustering_radius), 3),
+            "count": int(count),
+            "holes_per_cluster": {"mean": round(float(sizes.mean()), 2), "max": int(sizes.max()),
+                                  "distribution": {str(size): int(clusters) for size, clusters in
+                                                   zip(*np.unique(sizes, return_counts=True))}},
+            "extent_um": _percentiles(extents),
+            # Clusters whose holes reach further than the configured beam shift
+            "over_radius": int((extents > clustering_radius).sum()),
+        }
+
+    holes = holes.assign(spacing=hole_spacing if len(hole_spacing) else np.nan)
+    per_square = holes.groupby("square", sort=True).agg(holes=("hole", "size"), spacing=("spacing", "median"))
+    per_square["acquisitions"] = acquisitions.groupby("square").size().reindex(per_square.index, fill_value=0)
+    areas = pd.Series({square: _hull_area(group[["x", "y"]].to_numpy())
+                       for square, group in holes.groupby("square", sort=True)})
+    per_square["area_um2"] = areas.reindex(per_square.index, fill_value=0.0)
+    summary["squares"] = {
+        square: {"holes": int(row["holes"]), "acquisitions": int(row["acquisitions"]),
+                 "area_um2": round(float(row["area_um2"]), 1),
+                 "holes_per_1000_um2": round(float(row["holes"] / row["area_um2"] * 1000), 2)
+                 if row["area_um2"] else None,
+                 "median_spacing_um": None if np.isnan(row["spacing"]) else round(float(row["spacing"]), 3)}
+        for square, row in per_square.iterrows()
+    }
+    return summary
+
+
+def session_spatial_summary(session_dir, masterdf=None, depth=DEFAULT_DEPTH):
+    """
+        Indexes the targets of an EPU session and summarizes their geometry.
+
+        Args:
+            session_dir (str): The EPU session directory.
+            masterdf (pandas.DataFrame, optional): The parsed EPU session (xml_session), for the clustering radius.
+            depth (int, optional): Files read ahead of the one being matched.
+
+        Returns:
+            dict: The spatial_summary of the session.
+    """
+    targets = read_target_positions(session_dir, depth)
+    radius = masterdf['clusteringRadius'][0] if masterdf is not None and 'clusteringRadius' in masterdf else None
+    summary = spatial_summary(targets, radius)
+    logger.info("Indexed %d holes and %d stage positions, median hole spacing %s um", summary["holes"],
+                summary["stage_positions"], (summary["hole_spacing_um"] or {}).get("median", "?"))
+    return summary
+
+
+def write_spatial_summary(summary, output_dir, session):
+    """Writes the spatial summary of a session to <session>_spatial.json, returning its path."""
+    path = output_dir + '/' + session + '_spatial.json'
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=4)
+    return path
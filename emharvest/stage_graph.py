@@ -0,0 +1,207 @@
+import os
+import pickle
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from emharvest.failures import failures
+from emharvest.profiling import profiler, stage
+
+# Harvest stages mostly wait on XML reads and parsing, a few threads are enough to overlap them
+DEFAULT_WORKERS = min(8, (os.cpu_count() or 1) + 2)
+ARTIFACT_SUFFIX = ".pickle"
+
+logger = logging.getLogger(__name__)
+
+
+class StageGraph:
+    """
+        Runs the harvest as a graph of named stages, each declaring the artifacts it reads and writes.
+
+        A stage starts as soon as all of its inputs exist, so independent stages (e.g. the atlas and data
+        searches, or writing the CSV, JSON and CIF files) run concurrently on a thread pool. Each artifact is
+        produced once per run and handed to every stage that reads it. Stages are timed as profiler stages
+        under their own names. While profiling, the stages run one at a time: CPU time and I/O are measured
+        for the whole process, so only then are a stage's numbers its own.
+
+        Optional stages (e.g. the timeline or spatial summaries) may fail without failing the run: their
+        failure is recorded in the failure log, and the stages reading their outputs are skipped, while the
+        rest of the harvest completes.
+
+        With an artifact directory, every artifact is also pickled there, so single stages can later be run
+        again (e.g. only the validation) from the artifacts of an earlier run. Only load artifact directories
+        written by EMharvest itself, as loading a pickle can run arbitrary code.
+    """
+
+    def __init__(self, workers=None, artifact_dir=None):
+        self.workers = 1 if profiler.enabled else workers or DEFAULT_WORKERS
+        self.artifact_dir = artifact_dir
+        self.stages = {}
+        self.producers = {}
+
+    def add(self, name, func, inputs=(), outputs=None, optional=False):
+        """
+            Adds a stage to the graph.
+
+            Args:
+                name (str): The stage name, also used for profiling.
+                func (callable): Called with the input artifacts as positional arguments.
+                inputs (list, optional): The names of the artifacts the stage reads.
+                outputs (list, optional): The names of the artifacts the stage writes. Defaults to the stage
+                    name. With several outputs, func returns a tuple with one value per output.
+                optional (bool, optional): The harvest completes without the outputs of the stage when it fails,
+                    unless the failure log is set to fail fast.
+        """
+        outputs = [name] if outputs is None else list(outputs)
+        if name in self.stages:
+            raise ValueError(f"Stage {name} is already in the graph")
+        for output in outputs:
+            if output in self.producers:
+                raise ValueError(f"Artifact {output} is already produced by stage {self.producers[output]}")
+            self.producers[output] = name
+        self.stages[name] = {"func": func, "inputs": list(inputs), "outputs": outputs, "optional": optional}
+
+    def downstream(self, artifact):
+        """
+            Returns:
+                list: The names of the stages that read an artifact, directly or through other stages.
+        """
+        artifacts = {artifact}
+        selected = []
+        # Stages are added after the stages producing their inputs, so one pass in order is enough
+        for name, spec in self.stages.items():
+            if artifacts.intersection(spec["inputs"]):
+                selected.append(name)
+                artifacts.update(spec["outputs"])
+        return selected
+
+    def artifact_path(self, artifact):
+        return os.path.join(self.artifact_dir, artifact + ARTIFACT_SUFFIX)
+
+    def _load_artifact(self, artifact):
+        """Returns (True, value) for an artifact saved in the artifact directory, (False, None) otherwise."""
+        if not self.artifact_dir or not os.path.isfile(self.artifact_path(artifact)):
+            return False, None
+        with open(self.artifact_path(artifact), "rb") as f:
+            return True, pickle.load(f)
+
+    def _save_artifact(self, artifact, value):
+        path = self.artifact_path(artifact)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def plan(self, artifacts, targets=None):
+        """
+            Selects the stages a run needs.
+
+            Without targets, every stage runs. With targets, the target stages always run, and other stages only
+            run to produce inputs that are neither given nor saved in the artifact directory.
+
+            Args:
+                artifacts (dict): The artifacts given to the run, updated with the artifacts loaded from disk.
+                targets (list, optional): The names of the stages to run again.
+
+            Returns:
+                list: The names of the stages to run.
+        """
+        if not targets:
+            return list(self.stages)
+        unknown = [name for name in targets if name not in self.stages]
+        if unknown:
+            raise ValueError(f"Unknown stages {', '.join(unknown)}, expected any of {', '.join(self.stages)}")
+
+        selected = []
+        loaded = {}
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name in selected:
+                continue
+            selected.append(name)
+            for artifact in self.stages[name]["inputs"]:
+                if artifact in artifacts or artifact in loaded:
+                    continue
+                found, value = self._load_artifact(artifact)
+                if found:
+                    loaded[artifact] = value
+                elif artifact in self.producers:
+                    pending.append(self.producers[artifact])
+                else:
+                    raise ValueError(f"Stage {name} needs artifact {artifact}, which is neither given nor produced")
+
+        # Artifacts produced again by this run are not taken from the artifact directory
+        for name in selected:
+            for artifact in self.stages[name]["outputs"]:
+                loaded.pop(artifact, None)
+        artifacts.update(loaded)
+        return [name for name in self.stages if name in selected]
+
+    def _run_stage(self, name, args):
+        with stage(name):
+            return self.stages[name]["func"](*args)
+
+    def run(self, artifacts, targets=None):
+        """
+            Runs the stages of the graph, concurrently wherever their inputs allow.
+
+            Args:
+                artifacts (dict): The initial artifacts, e.g. the input file paths.
+                targets (list, optional): Only run these stages and the stages needed for their inputs.
+
+            Returns:
+                dict: Every artifact given, loaded or produced by the run, without the outputs of failed optional
+                    stages and of the stages reading them.
+        """
+        artifacts = dict(artifacts)
+        remaining = self.plan(artifacts, targets)
+        if self.artifact_dir:
+            os.makedirs(self.artifact_dir, exist_ok=True)
+        logger.debug("Running stages: %s", ", ".join(remaining))
+
+        running = {}
+        # Outputs of optional stages that failed, never produced by this run
+        lost = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while remaining or running:
+                # Skip the stages reading a lost output, their own outputs are lost with them
+                for name in list(remaining):
+                    missing = lost.intersection(self.stages[name]["inputs"])
+                    if missing:
+                        remaining.remove(name)
+                        lost.update(self.stages[name]["outputs"])
+                        logger.warning("Skipping stage %s, its input %s was not produced", name,
+                                       ", ".join(sorted(missing)))
+                # Start every stage whose inputs are all available
+                for name in list(remaining):
+                    if all(artifact in artifacts for artifact in self.stages[name]["inputs"]):
+                        remaining.remove(name)
+                        args = [artifacts[artifact] for artifact in self.stages[name]["inputs"]]
+                        running[executor.submit(self._run_stage, name, args)] = name
+                if not running:
+                    if not remaining:
+                        break
+                    raise RuntimeError(f"Stages {', '.join(remaining)} can not run, their inputs are never produced")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BaseException as e:
+                        if isinstance(e, Exception) and self.stages[name]["optional"] and not failures.fail_fast:
+                            logger.debug("Optional stage %s failed", name, exc_info=e)
+                            failures.record("stage", name, e)
+                            lost.update(self.stages[name]["outputs"])
+                            continue
+                        for other in running:
+                            other.cancel()
+                        logger.error("Stage %s failed", name)
+                        raise
+                    outputs = self.stages[name]["outputs"]
+                    values = [result] if len(outputs) == 1 else list(result)
+                    for artifact, value in zip(outputs, values):
+                        artifacts[artifact] = value
+                        if self.artifact_dir:
+                            self._save_artifact(artifact, value)
+        return artifacts
@@ -0,0 +1,289 @@
+import os
+import re
+import random
+import shutil
+import argparse
+import datetime
+
+REPO_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "_repo_data")
+EPU_TEMPLATE = os.path.join(REPO_DATA, "Supervisor_20230919_140141_84_bi23047-106_grid1")
+ATLAS_TEMPLATE = os.path.join(REPO_DATA, "atlas", "Supervisor_20230919_115905_Atlas_bi23047-106")
+
+_SQUARE_TEMPLATE = os.path.join("Images-Disc1", "GridSquare_19493759", "GridSquare_20230919_140816")
+_HOLE_TEMPLATE = os.path.join("Images-Disc1", "GridSquare_19493759", "FoilHoles", "FoilHole_19507368_20230919_142541")
+_DATA_TEMPLATE = os.path.join("Images-Disc1", "GridSquare_19493759", "Data",
+                              "FoilHole_19513699_Data_19508496_19508498_20230919_154056")
+_ATLAS_SAMPLE_TEMPLATE = os.path.join("Sample2", "Atlas")
+
+_STAGE_X = re.compile(r'(<Position>.*?<X>)[^<]*(</X>)', re.DOTALL)
+_STAGE_Y = re.compile(r'(<Position>.*?<Y>)[^<]*(</Y>)', re.DOTALL)
+_BEAM_SHIFT = re.compile(r'(<BeamShift[^>]*><a:_x>)[^<]*(</a:_x><a:_y>)[^<]*(</a:_y>)')
+_DATE_TIME = re.compile(r'(<acquisitionDateTime>)[^<]*(</acquisitionDateTime>)')
+_DEFOCUS = re.compile(r'(<optics>.*?<Defocus>)[^<]*(</Defocus>)', re.DOTALL)
+_UNIQUE_ID = re.compile(r'(<uniqueID>)[^<]*(</uniqueID>)')
+
+# TomoMdocData reads the microscope, serial number and date from the first line
+MDOC_HEADER = """T = SerialEM: TFS KRIOS    3593  19-Sep-23  15:41:00
+PixelSpacing = 1.63
+Voltage = 300
+ImageFile = {name}.mrc
+ImageSize = 4096 4096
+DataMode = 1
+
+[T =     Tilt axis angle = 85.3, binning = 1  spot = 5  camera = 0]
+"""
+
+MDOC_SECTION = """
+[ZValue = {z}]
+TiltAngle = {tilt:.2f}
+StagePosition = {x:.3f} {y:.3f}
+StageZ = 12.34
+Magnification = 64000
+Intensity = 0.125
+ExposureDose = 3.2
+DoseRate = 12.5
+PixelSpacing = 1.63
+SpotSize = 7
+Defocus = {defocus:.3f}
+ImageShift = 0.01 -0.02
+RotationAngle = 85.3
+ExposureTime = 0.8
+Binning = 1
+CameraIndex = 0
+DividedBy2 = 0
+OperatingMode = 1
+UsingCDS = 0
+MagIndex = 31
+LowDoseConSet = 4
+CountsPerElectron = 1
+TargetDefocus = {defocus:.1f}
+SubFramePath = X:\\frames\\{name}_{z:03d}_{tilt:.2f}.eer
+NumSubFrames = 600
+FrameDosesAndNumber = 0.0053 600
+DateTime = {date}
+FilterSlitAndLoss = 20 0
+ChannelName = Camera
+MultishotHoleAndPosition = 0 0
+"""
+
+
+def _timestamp(t):
+    return t.strftime("%Y%m%d_%H%M%S")
+
+
+def _xml_datetime(t):
+    return t.strftime("%Y-%m-%dT%H:%M:%S.") + f"{t.microsecond:06d}0+01:00"
+
+
+def _substitute(text, x=None, y=None, when=None, defocus=None, beam_shift=None, unique_id=None):
+    """Rewrites the per image fields of a template MicroscopeImage XML."""
+    if x is not None:
+        text = _STAGE_X.sub(lambda m: f"{m.group(1)}{x!r}{m.group(2)}", text, count=1)
+    if y is not None:
+        text = _STAGE_Y.sub(lambda m: f"{m.group(1)}{y!r}{m.group(2)}", text, count=1)
+    if when is not None:
+        text = _DATE_TIME.sub(lambda m: f"{m.group(1)}{_xml_datetime(when)}{m.group(2)}", text, count=1)
+    if defocus is not None:
+        text = _DEFOCUS.sub(lambda m: f"{m.group(1)}{defocus!r}{m.group(2)}", text, count=1)
+    if beam_shift is not None:
+        text = _BEAM_SHIFT.sub(lambda m: f"{m.group(1)}{beam_shift[0]!r}{m.group(2)}{beam_shift[1]!r}{m.group(3)}",
+                               text, count=1)
+    if unique_id is not None:
+        text = _UNIQUE_ID.sub(lambda m: f"{m.group(1)}{unique_id}{m.group(2)}", text, count=1)
+    return text
+
+
+def _link_or_copy(source, destination):
+    """Hard links large template files where possible to keep synthetic sessions cheap."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _read(path):
+    with open(path, "r") as f:
+        return f.read()
+
+
+def generate_epu_session(output_dir, grid_squares=2, foil_holes=4, acquisitions=2, discs=1,
+                         jpg=False, seed=0, template_dir=EPU_TEMPLATE):
+    """
+        Builds a synthetic EPU session from the template XMLs and EpuSession.dm.
+
+        Every GridSquare gets foil_holes FoilHole XMLs and every FoilHole gets acquisitions acquisition XMLs,
+        with distinct stage positions, timestamps, defocus values and image beam shifts.
+
+        Args:
+            output_dir (str): The session directory to create.
+            grid_squares (int): Number of GridSquares (N).
+            foil_holes (int): FoilHoles per GridSquare (M).
+            acquisitions (int): Acquisition images per FoilHole (K).
+            discs (int, optional): Number of Images-Disc folders the GridSquares are spread over.
+            jpg (bool, optional): Also link the template JPGs next to each XML.
+            seed (int, optional): Random seed, the same arguments always produce the same session.
+            template_dir (str, optional): The template EPU session.
+
+        Returns:
+            dict: The session directory, the EpuSession.dm path and the number of files written per kind.
+    """
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    epu_path = os.path.join(output_dir, "EpuSession.dm")
+    shutil.copyfile(os.path.join(template_dir, "EpuSession.dm"), epu_path)
+
+    square_xml = _read(os.path.join(template_dir, _SQUARE_TEMPLATE + ".xml"))
+    hole_xml = _read(os.path.join(template_dir, _HOLE_TEMPLATE + ".xml"))
+    data_xml = _read(os.path.join(template_dir, _DATA_TEMPLATE + ".xml"))
+    templates_jpg = {kind: os.path.join(template_dir, path + ".jpg")
+                     for kind, path in [("square", _SQUARE_TEMPLATE), ("hole", _HOLE_TEMPLATE), ("data", _DATA_TEMPLATE)]}
+
+    counts = {"GridSquare": 0, "FoilHole": 0, "Data": 0, "jpg": 0}
+    clock = datetime.datetime(2023, 9, 19, 14, 8, 12)
+    next_id = 20000000
+
+    def write(path, text, kind):
+        with open(path + ".xml", "w") as f:
+            f.write(text)
+        counts[kind] += 1
+        if jpg:
+            _link_or_copy(templates_jpg[{"GridSquare": "square", "FoilHole": "hole", "Data": "data"}[kind]], path + ".jpg")
+            counts["jpg"] += 1
+
+    for n in range(grid_squares):
+        disc = n % max(discs, 1) + 1
+        square_id = next_id
+        next_id += 1
+        square_dir = os.path.join(output_dir, f"Images-Disc{disc}", f"GridSquare_{square_id}")
+        os.makedirs(os.path.join(square_dir, "FoilHoles"), exist_ok=True)
+        os.makedirs(os.path.join(square_dir, "Data"), exist_ok=True)
+
+        # GridSquares sit on a coarse grid across the specimen, holes are scattered around their square
+        square_x = (n % 10) * 8e-5 - 4e-4
+        square_y = (n // 10) * 8e-5 - 4e-4
+        write(os.path.join(square_dir, f"GridSquare_{_timestamp(clock)}"),
+              _substitute(square_xml, x=square_x, y=square_y, when=clock, unique_id=f"square-{square_id}"), "GridSquare")
+
+        for m in range(foil_holes):
+            hole_id = next_id
+            next_id += 1
+            hole_x = square_x + rng.uniform(-3e-5, 3e-5)
+            hole_y = square_y + rng.uniform(-3e-5, 3e-5)
+            clock += datetime.timedelta(seconds=rng.uniform(5, 15))
+            write(os.path.join(square_dir, "FoilHoles", f"FoilHole_{hole_id}_{_timestamp(clock)}"),
+                  _substitute(hole_xml, x=hole_x, y=hole_y, when=clock, unique_id=f"hole-{hole_id}"), "FoilHole")
+
+            for k in range(acquisitions):
+                clock += datetime.timedelta(seconds=rng.uniform(3, 6), microseconds=rng.randrange(10 ** 6))
+                beam_shift = (rng.gauss(0, 0.05), rng.gauss(0, 0.05))
+                defocus = -rng.choice([0.5, 1.0, 1.5, 2.0, 2.5]) * 1e-6
+                write(os.path.join(square_dir, "Data",
+                                   f"FoilHole_{hole_id}_Data_{next_id}_{next_id + 2}_{_timestamp(clock)}"),
+                      _substitute(data_xml, x=hole_x, y=hole_y, when=clock, defocus=defocus, beam_shift=beam_shift,
+                                  unique_id=f"data-{hole_id}-{k}"), "Data")
+                next_id += 3
+
+        clock += datetime.timedelta(minutes=rng.uniform(1, 3))
+
+    return {"session_dir": output_dir, "epu": epu_path, "files": counts}
+
+
+def generate_atlas(output_dir, samples=1, tiles=4, template_dir=ATLAS_TEMPLATE):
+    """
+        Builds a synthetic atlas screening session with samples Sample folders, each with an atlas and tiles.
+
+        Args:
+            output_dir (str): The atlas directory to create.
+            samples (int): Number of Sample folders (S).
+            tiles (int, optional): Atlas tiles per sample.
+            template_dir (str, optional): The template atlas session.
+
+        Returns:
+            dict: The atlas directory and the ScreeningSession.dm path.
+    """
+    os.makedirs(os.path.join(output_dir, "Atlas"), exist_ok=True)
+    screening_path = os.path.join(output_dir, "ScreeningSession.dm")
+    shutil.copyfile(os.path.join(template_dir, "ScreeningSession.dm"), screening_path)
+    shutil.copyfile(os.path.join(template_dir, "Atlas", "Atlas.dm"), os.path.join(output_dir, "Atlas", "Atlas.dm"))
+
+    sample_template = os.path.join(template_dir, _ATLAS_SAMPLE_TEMPLATE)
+    atlas_xml = sorted(f for f in os.listdir(sample_template) if f.startswith("Atlas_") and f.endswith(".xml"))[0]
+    tile_xml = sorted(f for f in os.listdir(sample_template) if f.startswith("Tile_") and f.endswith(".xml"))[0]
+    atlas_text = _read(os.path.join(sample_template, atlas_xml))
+    tile_text = _read(os.path.join(sample_template, tile_xml))
+
+    for s in range(samples):
+        atlas_id = 30000000 + s * 1000
+        sample_dir = os.path.join(output_dir, f"Sample{s}")
+        os.makedirs(os.path.join(sample_dir, "Atlas"), exist_ok=True)
+        shutil.copyfile(os.path.join(template_dir, "Sample2", "Sample.dm"), os.path.join(sample_dir, "Sample.dm"))
+        shutil.copyfile(os.path.join(sample_template, "Atlas.dm"), os.path.join(sample_dir, "Atlas", "Atlas.dm"))
+        with open(os.path.join(sample_dir, "Atlas", f"Atlas_{atlas_id}.xml"), "w") as f:
+            f.write(_substitute(atlas_text, unique_id=f"atlas-{atlas_id}"))
+        for t in range(tiles):
+            with open(os.path.join(sample_dir, "Atlas", f"Tile_{atlas_id + t + 1}_{t}_{atlas_id}.xml"), "w") as f:
+                f.write(_substitute(tile_text, unique_id=f"tile-{atlas_id}-{t}"))
+
+    return {"atlas_dir": output_dir, "atlas": screening_path}
+
+
+def generate_tomo_mdocs(output_dir, tilt_series=1, tilts=41, tilt_step=3.0, seed=0):
+    """
+        Writes SerialEM style tilt series mdoc files (Position_<n>.mdoc) with tilts sections each.
+
+        Args:
+            output_dir (str): The directory to write the mdoc files to.
+            tilt_series (int): Number of mdoc files.
+            tilts (int): Tilt images per series (T), collected dose-symmetrically around 0 degrees.
+            tilt_step (float, optional): Tilt increment in degrees.
+            seed (int, optional): Random seed.
+
+        Returns:
+            list: The mdoc file paths.
+    """
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    clock = datetime.datetime(2023, 9, 19, 15, 41, 0)
+    for s in range(tilt_series):
+        name = f"Position_{s + 1}"
+        path = os.path.join(output_dir, name + ".mdoc")
+        # Dose-symmetric order: 0, +step, -step, +2 step...
+        angles = [0.0] + [sign * step * tilt_step for step in range(1, tilts) for sign in (1, -1)][:tilts - 1]
+        x, y = rng.uniform(-400, 400), rng.uniform(-400, 400)
+        with open(path, "w") as f:
+            f.write(MDOC_HEADER.format(name=name))
+            for z, tilt in enumerate(angles):
+                clock += datetime.timedelta(seconds=rng.uniform(8, 12))
+                f.write(MDOC_SECTION.format(z=z, tilt=tilt, x=x, y=y, defocus=-rng.uniform(2, 4), name=name,
+                                            date=clock.strftime("%d-%b-%y  %H:%M:%S")))
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic EPU/Tomo sessions from the repository templates.")
+    parser.add_argument("-o", "--output_dir", required=True, help="Directory to create the sessions in")
+    parser.add_argument("-n", "--grid_squares", type=int, default=2, help="GridSquares (N)")
+    parser.add_argument("-m", "--foil_holes", type=int, default=4, help="FoilHoles per GridSquare (M)")
+    parser.add_argument("-k", "--acquisitions", type=int, default=2, help="Acquisitions per FoilHole (K)")
+    parser.add_argument("--discs", type=int, default=1, help="Number of Images-Disc folders")
+    parser.add_argument("--jpg", action="store_true", help="Also link the template JPGs")
+    parser.add_argument("-s", "--samples", type=int, default=1, help="Atlas samples (S)")
+    parser.add_argument("-t", "--tilts", type=int, default=0, help="Tilts per tomography mdoc (T), 0 for none")
+    parser.add_argument("--tilt_series", type=int, default=1, help="Number of tomography mdoc files")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    session = generate_epu_session(os.path.join(args.output_dir, "epu"), args.grid_squares, args.foil_holes,
+                                   args.acquisitions, discs=args.discs, jpg=args.jpg, seed=args.seed)
+    atlas = generate_atlas(os.path.join(args.output_dir, "atlas"), samples=args.samples)
+    print(f"EPU session: {session['epu']} {session['files']}")
+    print(f"Atlas: {atlas['atlas']}")
+    if args.tilts:
+        mdocs = generate_tomo_mdocs(os.path.join(args.output_dir, "tomo"), args.tilt_series, args.tilts, seed=args.seed)
+        print(f"Tomography mdocs: {len(mdocs)} in {os.path.dirname(mdocs[0])}")
+
+
+if __name__ == "__main__":
+    main()
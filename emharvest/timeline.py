@@ -0,0 +1,212 @@
+import os
+import re
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+from emharvest.prefetch import DEFAULT_DEPTH, Prefetcher
+from emharvest.session_state import incremental_file_results
+from emharvest.sources import DATA_FOLDERS, glob_inputs, open_input
+
+# A gap between two images longer than this is a pause (grid exchange, autoloader, refilling, ...)
+PAUSE_S = 300
+# Longest pauses listed in the timeline
+TOP_PAUSES = 10
+
+# Only the timestamp is needed, so it is matched in the raw xml rather than parsing every file
+_EPU_DATE_TIME = re.compile(rb"<acquisitionDateTime>([^<]+)</acquisitionDateTime>")
+# 2023-09-19T15:41:00.6497848+01:00, the fraction and offset are optional
+_EPU_TIMESTAMP = re.compile(r"^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?(Z|[+-]\d{2}:?\d{2})?$")
+_MDOC_DATE_TIME = re.compile(r"^\s*DateTime\s*=\s*(.+?)\s*$", re.MULTILINE)
+EPU_FORMAT = "%Y-%m-%dT%H:%M:%S.%f%z"
+MDOC_FORMAT = "%d-%b-%y %H:%M:%S"
+
+logger = logging.getLogger(__name__)
+
+
+def _grid_square(path):
+    """The GridSquare folder of an acquisition image, <session>/*/GridSquare*/Data/<image>.xml."""
+    return os.path.basename(os.path.dirname(os.path.dirname(path)))
+
+
+def read_epu_timestamps(paths, depth=DEFAULT_DEPTH):
+    """
+        Reads the acquisitionDateTime of acquisition image xmls.
+
+        The xmls are read ahead with a Prefetcher and the timestamp is matched in the raw bytes, so no xml is
+        parsed.
+
+        Returns:
+            list: The timestamp string of each path, None where an xml has none.
+    """
+    timestamps = []
+    prefetcher = Prefetcher(paths, depth, isolate=True)
+    for _, data in prefetcher:
+        match = _EPU_DATE_TIME.search(data)
+        timestamps.append(match.group(1).decode("ascii", "replace") if match else None)
+    prefetcher.log_stats("acquisition xmls")
+    return timestamps
+
+
+def epu_timestamps(session_dir, depth=DEFAULT_DEPTH, cache=None):
+    """
+        Reads the acquisitionDateTime of every acquisition image xml of an EPU session.
+
+        Args:
+            session_dir (str): The EPU session directory.
+            depth (int, optional): Files read ahead of the one being matched.
+            cache (dict, optional): The timestamps of the last incremental harvest (session_state.file_cache),
+                only the xmls added since are read.
+
+        Returns:
+            tuple: (GridSquare of each image, timestamp strings), images without a timestamp are left out.
+    """
+    if cache is None:
+        paths = glob_inputs(session_dir + DATA_FOLDERS + "/*.xml")
+        results = list(zip(paths, read_epu_timestamps(paths, depth)))
+    else:
+        results, read = incremental_file_results(session_dir, cache, lambda name: name.endswith(".xml"),
+                                                 lambda paths: read_epu_timestamps(paths, depth),
+                                                 reread=lambda timestamp: timestamp is None)
+        logger.info("Read the timestamps of %d new acquisition xmls, %d kept from the last harvest", read,
+                    len(results) - read)
+    groups = [_grid_square(path) for path, timestamp in results if timestamp is not None]
+    timestamps = [timestamp for _, timestamp in results if timestamp is not None]
+    if len(timestamps) < len(results):
+        logger.warning("%d acquisition xmls have no acquisitionDateTime", len(results) - len(timestamps))
+    return groups, timestamps
+
+
+def mdoc_timestamps(mdoc_path):
+    """
+        Reads the DateTime of every section of a SerialEM mdoc file.
+
+        Returns:
+            tuple: (the mdoc name for each section, timestamp strings).
+    """
+    with open_input(mdoc_path) as f:
+        timestamps = _MDOC_DATE_TIME.findall(f.read())
+    return [os.path.basename(mdoc_path)] * len(timestamps), timestamps
+
+
+def normalize_epu_timestamps(timestamps):
+    """
+        Rewrites EPU timestamps to exactly EPU_FORMAT: 7 digit fractions cut to microseconds, missing
+        fractions and offsets (taken as UTC) filled in.
+
+        Returns:
+            list: The rewritten timestamps, None where a timestamp does not match.
+    """
+    normalized = []
+    for timestamp in timestamps:
+        match = _EPU_TIMESTAMP.match(timestamp.strip())
+        if not match:
+            normalized.append(None)
+            continue
+        seconds, fraction, offset = match.groups()
+        offset = "+00:00" if not offset or offset == "Z" else offset
+        normalized.append(seconds + (fraction or ".0")[:7] + offset)
+    return normalized
+
+
+def parse_timestamps(timestamps, kind="epu"):
+    """
+        Parses many timestamps at once with a fixed format, instead of guessing the format of each one.
+
+        Args:
+            timestamps (list): EPU acquisitionDateTime or mdoc DateTime strings.
+            kind (str, optional): "epu" or "mdoc".
+
+        Returns:
+            numpy.ndarray: datetime64[ns] values, UTC for EPU and the microscope clock for mdoc, NaT where a
+                timestamp could not be parsed.
+    """
+    if kind == "epu":
+        return pd.to_datetime(pd.Series(normalize_epu_timestamps(timestamps), dtype=object), format=EPU_FORMAT,
+                              utc=True, errors="coerce").dt.tz_localize(None).to_numpy()
+    # mdoc pads single digit days and times with extra spaces
+    collapsed = pd.Series(timestamps, dtype=object).str.split().str.join(" ")
+    return pd.to_datetime(collapsed, format=MDOC_FORMAT, errors="coerce").to_numpy()
+
+
+def _iso(value):
+    return str(np.datetime_as_string(value, unit="s"))
+
+
+def acquisition_timeline(groups, times, pause_s=PAUSE_S, clock="UTC"):
+    """
+        Computes the throughput of a session from the acquisition time of each image.
+
+        Args:
+            groups (list): The GridSquare (EPU) or tilt series (mdoc) of each image.
+            times (numpy.ndarray): The datetime64 acquisition time of each image.
+            pause_s (float, optional): Gaps longer than this are pauses, excluded from the active time.
+            clock (str, optional): The clock of the times, reported with them.
+
+        Returns:
+            dict: The span and rates of the session, the gaps between images, the longest pauses, the images per
+                clock hour and the dwell time of each GridSquare, None when fewer than two images have a time.
+    """
+    frame = pd.DataFrame({"group": groups, "time": times}).dropna(subset=["time"]).sort_values("time",
+                                                                                              kind="stable")
+    if len(frame) < 2:
+        logger.info("Fewer than two images have an acquisition time, no timeline to compute")
+        return None
+    seconds = frame["time"].to_numpy().astype("datetime64[ns]").astype(np.int64) / 1e9
+    gaps = np.diff(seconds)
+    paused = gaps > pause_s
+    span_s = float(seconds[-1] - seconds[0])
+    active_s = float(gaps[~paused].sum())
+
+    pause_order = np.argsort(gaps[paused])[::-1][:TOP_PAUSES]
+    pause_starts = frame["time"].to_numpy()[:-1][paused]
+    pause_lengths = gaps[paused]
+    pauses = [{"start": _iso(pause_starts[index]), "duration_s": round(float(pause_lengths[index]), 1)}
+              for index in pause_order]
+
+    hourly = frame["time"].dt.floor("h").value_counts().sort_index()
+    dwell = frame.groupby("group", sort=False)["time"].agg(["count", "min", "max"]).sort_values("min")
+    dwell_s = (dwell["max"] - dwell["min"]).dt.total_seconds()
+    squares = {group: {"images": int(row["count"]), "first": _iso(row["min"].to_datetime64()),
+                       "dwell_s": round(float(dwell_s[group]), 1)}
+               for group, row in dwell.iterrows()}
+
+    return {
+        "images": len(frame),
+        "clock": clock,
+        "first": _iso(frame["time"].iloc[0].to_datetime64()),
+        "last": _iso(frame["time"].iloc[-1].to_datetime64()),
+        "span_h": round(span_s / 3600, 3),
+        "images_per_hour": round(len(gaps) / span_s * 3600, 1) if span_s else None,
+        "active_images_per_hour": round(int((~paused).sum()) / active_s * 3600, 1) if active_s else None,
+        "gap_s": {"median": round(float(np.median(gaps)), 2), "p95": round(float(np.percentile(gaps, 95)), 2),
+                  "max": round(float(gaps.max()), 1)},
+        "pause_threshold_s": pause_s,
+        "pauses": int(paused.sum()),
+        "paused_h": round(float(pause_lengths.sum()) / 3600, 3),
+        "longest_pauses": pauses,
+        "images_per_clock_hour": {_iso(hour.to_datetime64()): int(count) for hour, count in hourly.items()},
+        "dwell": squares,
+    }
+
+
+def epu_timeline(session_dir, depth=DEFAULT_DEPTH, pause_s=PAUSE_S, cache=None):
+    """The acquisition_timeline of an EPU session, per GridSquare, reading only new xmls with a cache."""
+    groups, timestamps = epu_timestamps(session_dir, depth, cache)
+    return acquisition_timeline(groups, parse_timestamps(timestamps, "epu"), pause_s)
+
+
+def mdoc_timeline(mdoc_path, pause_s=PAUSE_S):
+    """The acquisition_timeline of a SerialEM tilt series or montage, from its mdoc sections."""
+    groups, timestamps = mdoc_timestamps(mdoc_path)
+    return acquisition_timeline(groups, parse_timestamps(timestamps, "mdoc"), pause_s, clock="microscope")
+
+
+def write_timeline(timeline, output_dir, session):
+    """Writes the timeline of a session to <session>_timeline.json, returning its path."""
+    path = output_dir + '/' + session + '_timeline.json'
+    with open(path, "w") as f:
+        json.dump(timeline, f, indent=4)
+    return path
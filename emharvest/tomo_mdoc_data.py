@@ -1,7 +1,12 @@
 import re
 import math
+import logging
 import datetime
 
+from emharvest.sources import open_input
+
+logger = logging.getLogger(__name__)
+
 def unique_values(existing_list, new_values):
     """Add unique values to the list, handling NaN separately."""
     for value in new_values:
@@ -20,7 +25,7 @@ def TomoMdocData(mdocpath):
     mdoc_data = {}
     data_dict = {}
 
-    with open(mdocpath, "r") as file:
+    with open_input(mdocpath) as file:
         first_line = file.readline().strip()
 
         if args.mode == "SPA" or args.mode == "TOMO":
@@ -40,7 +45,7 @@ def TomoMdocData(mdocpath):
                                 formatted_date = datetime.datetime.strptime(date_str, "%d-%b-%y").strftime("%Y-%m-%d")
                             except ValueError:
                                 formatted_date = None
-                                print(f"Invalid date format: {date_str}")
+                                logger.warning("Invalid date format: %s", date_str)
                     else:
                         formatted_date = None
                     data_dict = {
@@ -51,7 +56,7 @@ def TomoMdocData(mdocpath):
                         "time": match.group(5).strip(),
                     }
                 else:
-                    print("Line format does not match the expected pattern.")
+                    logger.warning("Line format does not match the expected pattern.")
 
 
         for line in file:
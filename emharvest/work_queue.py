@@ -0,0 +1,505 @@
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import signal
+import socket
+import sqlite3
+import builtins
+import logging
+import argparse
+import threading
+import subprocess
+
+from rich.console import Console
+from rich.table import Table
+
+from emharvest.failures import failure_reason
+from emharvest.logs import configure_logging
+
+STATUSES = ["pending", "running", "done", "failed"]
+JOURNAL_MODES = ["DELETE", "WAL"]
+DEFAULT_LEASE_S = 600
+DEFAULT_HEARTBEAT_S = 30
+DEFAULT_MAX_ATTEMPTS = 3
+# Wait before a failed session is tried again, doubled for every further attempt
+DEFAULT_RETRY_BACKOFF_S = 60
+# Failures that may not happen again, the sessions failing otherwise (e.g. with a missing key) fail for good
+RETRY_REASONS = ["timeout", "signal", "io_error", "lease expired"]
+TRACEBACK_ERROR = re.compile(r"^([A-Za-z_][\w.]*(?:Error|Exception|Exit|Interrupt)): ?")
+# Workers on other nodes hold the database lock for a few milliseconds per claim, heartbeat or result
+BUSY_TIMEOUT_MS = 60000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE NOT NULL,
+    argv TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    node TEXT,
+    worker TEXT,
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat_at REAL,
+    lease_expires REAL,
+    finished_at REAL,
+    wall_s REAL,
+    returncode INTEGER,
+    result TEXT,
+    error TEXT,
+    reason TEXT,
+    retry_at REAL
+);
+CREATE INDEX IF NOT EXISTS sessions_status ON sessions (status, lease_expires);
+"""
+
+# Named explicitly, run with python -m the module is __main__ and would log outside the emharvest logger
+logger = logging.getLogger("emharvest.work_queue")
+
+
+def connect(queue_path, journal_mode="DELETE"):
+    """
+        Opens the queue database, creating it on first use.
+
+        The rollback journal (DELETE) only relies on file locks, so it works for workers on several nodes of a
+        shared filesystem that supports POSIX locks. WAL needs shared memory between the processes and is only
+        safe when every worker runs on the same host.
+
+        Args:
+            queue_path (str): The SQLite database on the shared filesystem.
+            journal_mode (str, optional): One of JOURNAL_MODES.
+
+        Returns:
+            sqlite3.Connection: A connection in autocommit mode, transactions are started explicitly.
+    """
+    connection = sqlite3.connect(queue_path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    connection.execute(f"PRAGMA journal_mode = {journal_mode}")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def session_key(argv):
+    """A session is identified by its harvest arguments, so enqueuing it again is a no-op."""
+    return shlex.join(argv)
+
+
+def enqueue(connection, sessions):
+    """
+        Adds sessions to the queue, skipping sessions already in it.
+
+        Args:
+            connection (sqlite3.Connection): The queue database.
+            sessions (list): The emharvest_main arguments of each session, as lists.
+
+        Returns:
+            int: The number of sessions added.
+    """
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        added = 0
+        for argv in sessions:
+            cursor = connection.execute("INSERT OR IGNORE INTO sessions (key, argv, enqueued_at) VALUES (?, ?, ?)",
+                                        (session_key(argv), json.dumps(argv), now))
+            added += cursor.rowcount
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    return added
+
+
+def read_session_file(path):
+    """Reads one session per line as emharvest_main arguments, ignoring blank lines and # comments."""
+    sessions = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                sessions.append(shlex.split(line))
+    return sessions
+
+
+def claim(connection, node, worker, lease_s=DEFAULT_LEASE_S, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+        Leases the next pending session to a worker.
+
+        Sessions whose lease expired (their worker stopped sending heartbeats) are claimed again, until they
+        were attempted max_attempts times, after which they are marked as failed. Sessions waiting to be
+        retried are only claimed once their retry time has come.
+
+        Returns:
+            sqlite3.Row: The claimed session, or None when nothing is left to claim.
+    """
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute("UPDATE sessions SET status = 'failed', error = 'lease expired', "
+                           "reason = 'lease expired', finished_at = ? "
+                           "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                           (now, now, max_attempts))
+        row = connection.execute("SELECT * FROM sessions WHERE (status = 'pending' AND "
+                                 "(retry_at IS NULL OR retry_at <= ?)) "
+                                 "OR (status = 'running' AND lease_expires < ?) ORDER BY id LIMIT 1",
+                                 (now, now)).fetchone()
+        if row is not None:
+            if row["status"] == "running":
+                logger.warning("Re-queuing session %d, the lease of %s expired", row["id"], row["worker"])
+            connection.execute("UPDATE sessions SET status = 'running', attempts = attempts + 1, node = ?, "
+                               "worker = ?, started_at = ?, heartbeat_at = ?, lease_expires = ? WHERE id = ?",
+                               (node, worker, now, now, now + lease_s, row["id"]))
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    return row
+
+
+def heartbeat(connection, session_id, worker, lease_s=DEFAULT_LEASE_S):
+    """
+        Extends the lease of a running session.
+
+        Returns:
+            bool: False when the session was re-queued to another worker in the meantime.
+    """
+    now = time.time()
+    cursor = connection.execute("UPDATE sessions SET heartbeat_at = ?, lease_expires = ? "
+                                "WHERE id = ? AND worker = ? AND status = 'running'",
+                                (now, now + lease_s, session_id, worker))
+    return cursor.rowcount == 1
+
+
+def next_retry(connection):
+    """The earliest time a session waiting to be retried can be claimed, None when no session waits."""
+    return connection.execute("SELECT MIN(retry_at) FROM sessions WHERE status = 'pending' AND retry_at IS NOT NULL"
+                              ).fetchone()[0]
+
+
+def complete(connection, session_id, worker, returncode, wall_s, result=None, error=None, reason=None,
+             max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_s=DEFAULT_RETRY_BACKOFF_S):
+    """
+        Records the outcome of a session, unless its lease was taken over by another worker.
+
+        A session failing for one of the RETRY_REASONS is queued again after backoff_s, doubled for every
+        earlier attempt, until it was attempted max_attempts times.
+
+        Returns:
+            bool: True when the result was recorded.
+    """
+    now = time.time()
+    status = "done" if returncode == 0 else "failed"
+    retry_at = None
+    if status == "failed" and reason in RETRY_REASONS:
+        attempts = connection.execute("SELECT attempts FROM sessions WHERE id = ?", (session_id,)).fetchone()[0]
+        if attempts < max_attempts:
+            status = "pending"
+            retry_at = now + backoff_s * 2 ** (attempts - 1)
+    cursor = connection.execute("UPDATE sessions SET status = ?, finished_at = ?, wall_s = ?, returncode = ?, "
+                                "result = ?, error = ?, reason = ?, retry_at = ? "
+                                "WHERE id = ? AND worker = ? AND status = 'running'",
+                                (status, now, wall_s, returncode,
+                                 json.dumps(result, default=str) if result is not None else None, error, reason,
+                                 retry_at, session_id, worker))
+    if cursor.rowcount == 1 and retry_at is not None:
+        logger.warning("Session %d failed (%s), retrying in %.0f s", session_id, reason, retry_at - now)
+    return cursor.rowcount == 1
+
+
+def parse_summary(stderr):
+    """Returns the session summary fields of a harvest run with --log_json, None when there is none."""
+    for line in reversed(stderr.splitlines()):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(entry, dict) and entry.get("logger") == "emharvest.summary":
+            return {key: value for key, value in entry.items() if key not in ("time", "level", "logger", "message")}
+    return None
+
+
+def _exception_reason(name):
+    """The failure_reason of an exception logged by its class name, e.g. KeyError."""
+    error_class = getattr(builtins, name, None)
+    if isinstance(error_class, type) and issubclass(error_class, Exception):
+        try:
+            return failure_reason(error_class())
+        except TypeError:
+            return "error"
+    return "invalid_xml" if name == "ExpatError" else "error"
+
+
+def session_failure(returncode, stderr, timed_out=False, timeout_s=None):
+    """
+        Explains why a harvest failed, from its return code and the JSON log lines of its stderr.
+
+        Returns:
+            tuple: (reason, message). The reason is timeout, signal, or the failure_reason of the exception the
+                harvest logged or died of (error when there is none). The message is the last error logged, with
+                the exception raised.
+    """
+    if timed_out:
+        return "timeout", f"no result after {timeout_s} s"
+    if returncode is not None and returncode < 0:
+        try:
+            name = signal.Signals(-returncode).name
+        except ValueError:
+            name = str(-returncode)
+        return "signal", f"killed by {name}"
+    reason, message = "error", None
+    for line in stderr.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # The last line of a traceback printed by an uncaught exception, not logged as JSON
+            match = TRACEBACK_ERROR.match(line)
+            if match:
+                reason, message = _exception_reason(match.group(1).rsplit(".", 1)[-1]), line
+            continue
+        if isinstance(entry, dict) and entry.get("level") == "ERROR":
+            message = entry.get("message")
+            exception = (entry.get("exception") or "").strip().splitlines()
+            if exception:
+                name = exception[-1].split(":", 1)[0].rsplit(".", 1)[-1]
+                reason = _exception_reason(name)
+                message = f"{message} ({exception[-1]})"
+    return reason, message or stderr.strip()[-500:] or f"return code {returncode}"
+
+
+def harvest(argv, timeout_s=None):
+    """
+        Harvests one session in a separate process, so a crash, exit() or hung read only ends that session.
+
+        Args:
+            argv (list): The emharvest_main arguments of the session.
+            timeout_s (float, optional): Kill the harvest after this many seconds.
+
+        Returns:
+            tuple: (return code, session summary fields or None, the end of stderr, (reason, message) of a failed
+                harvest or None).
+    """
+    command = [sys.executable, "-m", "emharvest.emharvest_main", *argv, "--log_json"]
+    try:
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                                 timeout=timeout_s)
+    except subprocess.TimeoutExpired as e:
+        stderr = e.stderr.decode(errors="replace") if isinstance(e.stderr, bytes) else e.stderr or ""
+        return -signal.SIGKILL, None, stderr[-2000:], session_failure(None, stderr, True, timeout_s)
+    failure = session_failure(process.returncode, process.stderr) if process.returncode else None
+    return process.returncode, parse_summary(process.stderr), process.stderr[-2000:], failure
+
+
+def run_worker(queue_path, node=None, lease_s=DEFAULT_LEASE_S, heartbeat_s=DEFAULT_HEARTBEAT_S,
+               max_attempts=DEFAULT_MAX_ATTEMPTS, max_sessions=None, journal_mode="DELETE", timeout_s=None,
+               backoff_s=DEFAULT_RETRY_BACKOFF_S):
+    """
+        Claims and harvests sessions until the queue is empty.
+
+        A failed session does not stop the worker: its reason and message are recorded, and sessions that
+        timed out or were killed are retried with backoff. The worker waits for sessions queued for a retry
+        before it stops.
+
+        Args:
+            queue_path (str): The queue database on the shared filesystem.
+            node (str, optional): The node name reported by status. Defaults to the host name.
+            lease_s (float, optional): How long a claim stays valid without a heartbeat.
+            heartbeat_s (float, optional): How often the lease of the running session is extended.
+            max_attempts (int, optional): Attempts of a session whose worker disappeared, or that failed for
+                one of the RETRY_REASONS, before it is failed.
+            max_sessions (int, optional): Stop after this many sessions.
+            journal_mode (str, optional): One of JOURNAL_MODES.
+            timeout_s (float, optional): Kill a harvest running longer than this, and retry it.
+            backoff_s (float, optional): Wait before the first retry of a failed session.
+
+        Returns:
+            int: The number of sessions harvested by this worker.
+    """
+    node = node or socket.gethostname()
+    worker = f"{node}:{os.getpid()}"
+    connection = connect(queue_path, journal_mode)
+    harvested = 0
+    while max_sessions is None or harvested < max_sessions:
+        row = claim(connection, node, worker, lease_s, max_attempts)
+        if row is None:
+            retry_at = next_retry(connection)
+            if retry_at is None:
+                break
+            # Sessions are waiting for their retry, or for another worker's lease to expire
+            time.sleep(min(max(retry_at - time.time(), 0.1), heartbeat_s))
+            continue
+        argv = json.loads(row["argv"])
+        logger.info("%s harvesting session %d: %s", worker, row["id"], row["key"])
+
+        # Heartbeats use their own connection, the main thread is busy waiting for the harvest
+        stop = threading.Event()
+
+        def beat():
+            beat_connection = connect(queue_path, journal_mode)
+            try:
+                while not stop.wait(heartbeat_s):
+                    if not heartbeat(beat_connection, row["id"], worker, lease_s):
+                        logger.warning("Lost the lease of session %d", row["id"])
+                        return
+            finally:
+                beat_connection.close()
+
+        beat_thread = threading.Thread(target=beat, daemon=True)
+        beat_thread.start()
+        start = time.perf_counter()
+        try:
+            returncode, result, stderr, failure = harvest(argv, timeout_s)
+        except OSError as e:
+            returncode, result, stderr, failure = -1, None, str(e), (failure_reason(e), str(e))
+        finally:
+            stop.set()
+            beat_thread.join()
+        wall_s = time.perf_counter() - start
+
+        reason, error = failure or (None, None)
+        if not complete(connection, row["id"], worker, returncode, wall_s, result, error, reason, max_attempts,
+                        backoff_s):
+            logger.warning("Session %d was re-queued while it ran, its result was not recorded", row["id"])
+        logger.info("%s finished session %d in %.1f s (return code %d)", worker, row["id"], wall_s, returncode)
+        harvested += 1
+    connection.close()
+    return harvested
+
+
+def queue_status(connection):
+    """
+        Summarises the progress of the queue.
+
+        Returns:
+            dict: Session counts per status and per failure reason, the sessions waiting for a retry, and per
+            node the sessions done, failed and running, the mean harvest time and the throughput in sessions
+            per hour since the node started its first session.
+    """
+    now = time.time()
+    counts = {status: 0 for status in STATUSES}
+    for row in connection.execute("SELECT status, COUNT(*) AS n FROM sessions GROUP BY status"):
+        counts[row["status"]] = row["n"]
+    expired = connection.execute("SELECT COUNT(*) FROM sessions WHERE status = 'running' AND lease_expires < ?",
+                                 (now,)).fetchone()[0]
+    retrying = connection.execute("SELECT COUNT(*) FROM sessions WHERE status = 'pending' AND retry_at IS NOT NULL"
+                                  ).fetchone()[0]
+    reasons = {row["reason"] or "error": row["n"] for row in connection.execute(
+        "SELECT reason, COUNT(*) AS n FROM sessions WHERE status = 'failed' GROUP BY reason ORDER BY n DESC")}
+
+    nodes = []
+    for row in connection.execute(
+            "SELECT node, SUM(status = 'done') AS done, SUM(status = 'failed') AS failed, "
+            "SUM(status = 'running') AS running, COUNT(DISTINCT worker) AS workers, "
+            "AVG(CASE WHEN status = 'done' THEN wall_s END) AS mean_wall_s, "
+            "MIN(started_at) AS first_started, MAX(finished_at) AS last_finished "
+            "FROM sessions WHERE node IS NOT NULL GROUP BY node ORDER BY node"):
+        node = dict(row)
+        elapsed = (node["last_finished"] or now) - node["first_started"]
+        node["sessions_per_hour"] = round(node["done"] * 3600 / elapsed, 1) if node["done"] and elapsed > 0 else 0.0
+        nodes.append(node)
+    return {"total": sum(counts.values()), "counts": counts, "expired_leases": expired, "retrying": retrying,
+            "failure_reasons": reasons, "nodes": nodes}
+
+
+def failure_report(connection):
+    """
+        Returns:
+            list: The failed sessions with their arguments, attempts, node, failure reason and error message.
+    """
+    return [{**dict(row), "argv": json.loads(row["argv"])} for row in connection.execute(
+        "SELECT id, argv, attempts, node, finished_at, returncode, reason, error FROM sessions "
+        "WHERE status = 'failed' ORDER BY id")]
+
+
+def print_status(status):
+    counts = status["counts"]
+    console = Console()
+    console.print(f"{status['total']} sessions: " + ", ".join(f"{counts[s]} {s}" for s in STATUSES)
+                  + (f" ({status['expired_leases']} expired leases)" if status["expired_leases"] else "")
+                  + (f", {status['retrying']} waiting for a retry" if status["retrying"] else ""))
+    if status["failure_reasons"]:
+        console.print("Failed: " + ", ".join(f"{n} {reason}" for reason, n in status["failure_reasons"].items()))
+    table = Table(title="Harvest workers per node")
+    for column in ["Node", "Workers", "Done", "Failed", "Running", "Mean (s)", "Sessions/h"]:
+        table.add_column(column, justify="left" if column == "Node" else "right")
+    for node in status["nodes"]:
+        table.add_row(node["node"], str(node["workers"]), str(node["done"]), str(node["failed"]),
+                      str(node["running"]),
+                      f"{node['mean_wall_s']:.1f}" if node["mean_wall_s"] is not None else "-",
+                      f"{node['sessions_per_hour']:.1f}")
+    console.print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Harvest sessions from a work queue shared by workers on many nodes.")
+    parser.add_argument("--journal_mode", default="DELETE", type=str.upper, choices=JOURNAL_MODES,
+                        help="SQLite journal mode, WAL only when every worker runs on the same host (default: DELETE)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = commands.add_parser("enqueue", help="Add sessions to the queue",
+                                         usage="%(prog)s queue [-f SESSIONS_FILE] [-- EMH_ARGS ...]",
+                                         description="Add sessions to the queue, from a file with the emh.py "
+                                                     "arguments of one session per line, or the emh.py arguments "
+                                                     "of a single session after --")
+    enqueue_parser.add_argument("queue", help="Queue database on the shared filesystem")
+    enqueue_parser.add_argument("-f", "--sessions_file",
+                                help="File with the emh.py arguments of one session per line")
+
+    work_parser = commands.add_parser("work", help="Claim and harvest sessions until the queue is empty")
+    work_parser.add_argument("queue", help="Queue database on the shared filesystem")
+    work_parser.add_argument("--node", help="Node name reported by status (default: host name)")
+    work_parser.add_argument("--lease", type=float, default=DEFAULT_LEASE_S,
+                             help=f"Seconds a claim stays valid without a heartbeat (default: {DEFAULT_LEASE_S})")
+    work_parser.add_argument("--heartbeat", type=float, default=DEFAULT_HEARTBEAT_S,
+                             help=f"Seconds between heartbeats (default: {DEFAULT_HEARTBEAT_S})")
+    work_parser.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                             help=f"Attempts before a session is failed (default: {DEFAULT_MAX_ATTEMPTS})")
+    work_parser.add_argument("--max_sessions", type=int, help="Stop after this many sessions")
+    work_parser.add_argument("--timeout", type=float,
+                             help="Seconds after which a harvest is killed and retried (default: no limit)")
+    work_parser.add_argument("--backoff", type=float, default=DEFAULT_RETRY_BACKOFF_S,
+                             help=f"Seconds before the first retry of a session that timed out or was killed, "
+                                  f"doubled for every further retry (default: {DEFAULT_RETRY_BACKOFF_S})")
+
+    status_parser = commands.add_parser("status", help="Report progress and throughput per node")
+    status_parser.add_argument("queue", help="Queue database on the shared filesystem")
+    status_parser.add_argument("--json", action="store_true", help="Print the status as JSON")
+
+    report_parser = commands.add_parser("report", help="Print the failed sessions and why they failed, as JSON")
+    report_parser.add_argument("queue", help="Queue database on the shared filesystem")
+
+    # Everything after -- is the harvest command line of a session, not options of the queue
+    argv = sys.argv[1:]
+    harvest_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+    configure_logging(level="INFO")
+
+    if args.command == "enqueue":
+        sessions = read_session_file(args.sessions_file) if args.sessions_file else []
+        if harvest_args:
+            sessions.append(harvest_args)
+        if not sessions:
+            parser.error("enqueue needs --sessions_file or the arguments of a session after --")
+        connection = connect(args.queue, args.journal_mode)
+        added = enqueue(connection, sessions)
+        logger.info("Enqueued %d sessions, %d were already queued", added, len(sessions) - added)
+    elif args.command == "work":
+        harvested = run_worker(args.queue, node=args.node, lease_s=args.lease, heartbeat_s=args.heartbeat,
+                               max_attempts=args.max_attempts, max_sessions=args.max_sessions,
+                               journal_mode=args.journal_mode, timeout_s=args.timeout, backoff_s=args.backoff)
+        logger.info("Harvested %d sessions", harvested)
+    elif args.command == "status":
+        status = queue_status(connect(args.queue, args.journal_mode))
+        if args.json:
+            print(json.dumps(status, indent=4))
+        else:
+            print_status(status)
+    elif args.command == "report":
+        print(json.dumps(failure_report(connect(args.queue, args.journal_mode)), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@ import xmltodict
 import re
 import math
 
+from emharvest.failures import xml_value
+from emharvest.sources import open_input
+
 def roundup(n, decimals=0):
     """
         https://realpython.com/python-rounding/
@@ -25,47 +28,53 @@ def AnyXMLDataFile(xmlpath):
             xmlpath (str): The path to the XML file to read.
 
         Returns:
-            dict: A dictionary containing the extracted data.
+            dict: A dictionary containing the extracted data. Values missing from the XML are recorded in the
+                failure log and left unknown ('?').
     """
-    with open(xmlpath, "r") as xml:
+    with open_input(xmlpath) as xml:
         for_parsing = xml.read()
         data = xmltodict.parse(for_parsing)
     data = data["MicroscopeImage"]
 
-    acqusition_date = data["microscopeData"]["acquisition"]["acquisitionDateTime"]
+    acqusition_date = xml_value(data, "microscopeData", "acquisition", "acquisitionDateTime", source=xmlpath)
     date = acqusition_date.split("T", 1)[0]
-    model_serial = data["microscopeData"]["instrument"]["InstrumentModel"]
+    model_serial = xml_value(data, "microscopeData", "instrument", "InstrumentModel", source=xmlpath)
     model_serial_split = re.split(r'(\d+)', model_serial, maxsplit=1)
     model = model_serial_split[0]
     if model == "TITAN":
         model = "TFS KRIOS"
-    microscope_serial_number = model_serial_split[1]
-    microscope_mode = data["microscopeData"]["optics"]["ColumnOperatingTemSubMode"]
-    eV = data["microscopeData"]["gun"]["AccelerationVoltage"]
-    xmlMag = data["microscopeData"]["optics"]["TemMagnification"]["NominalMagnification"]
-    xmlMetrePix = data["SpatialScale"]["pixelSize"]["x"]["numericValue"]
-    xmlAPix = float(xmlMetrePix) * 1e10
-    xmlAPix = roundup(xmlAPix, 1)
-    soft_name = data["microscopeData"]["core"]["ApplicationSoftware"]
+    microscope_serial_number = model_serial_split[1] if len(model_serial_split) > 1 else "?"
+    microscope_mode = xml_value(data, "microscopeData", "optics", "ColumnOperatingTemSubMode", source=xmlpath)
+    eV = xml_value(data, "microscopeData", "gun", "AccelerationVoltage", source=xmlpath)
+    xmlMag = xml_value(data, "microscopeData", "optics", "TemMagnification", "NominalMagnification", source=xmlpath)
+    xmlMetrePix = xml_value(data, "SpatialScale", "pixelSize", "x", "numericValue", source=xmlpath)
+    try:
+        xmlAPix = roundup(float(xmlMetrePix) * 1e10, 1)
+    except (TypeError, ValueError):
+        xmlAPix = "?"
+    soft_name = xml_value(data, "microscopeData", "core", "ApplicationSoftware", source=xmlpath)
     if soft_name == "Tomography":
         software_name = "TFS tomography"
     elif soft_name == "TemAppCommon":
         software_name = "TFS tomography"
     else:
         software_name = soft_name
-    software_version = data["microscopeData"]["core"]["ApplicationSoftwareVersion"]
-    illumination = data["microscopeData"]["optics"]["IlluminationMode"]
+    software_version = xml_value(data, "microscopeData", "core", "ApplicationSoftwareVersion", source=xmlpath)
+    illumination = xml_value(data, "microscopeData", "optics", "IlluminationMode", source=xmlpath)
 
     objectiveAperture, C2_micron = "", ""
-    keyValueList = data["CustomData"]["a:KeyValueOfstringanyType"]
+    keyValueList = xml_value(data, "CustomData", "a:KeyValueOfstringanyType", default=[], source=xmlpath)
+    # xmltodict gives a single entry as a dict rather than a list of one
+    if isinstance(keyValueList, dict):
+        keyValueList = [keyValueList]
     for i, value in enumerate(keyValueList):
-        key = data["CustomData"]["a:KeyValueOfstringanyType"][i]["a:Key"]
+        key = value.get("a:Key")
         if key == "Aperture[OBJ].Name":
-            objectiveAperture = data["CustomData"]["a:KeyValueOfstringanyType"][i]["a:Value"]["#text"]
+            objectiveAperture = xml_value(value, "a:Value", "#text", source=xmlpath)
             if objectiveAperture == "None":
                 objectiveAperture = '?'
         if key == "Aperture[C2].Name":
-            C2_micron = data["CustomData"]["a:KeyValueOfstringanyType"][i]["a:Value"]["#text"]
+            C2_micron = xml_value(value, "a:Value", "#text", source=xmlpath)
 
     OverViewDataDict = dict(date=date, model=model, microscope_serial_number=microscope_serial_number, microscope_mode=microscope_mode, eV=eV, xmlMag=xmlMag,
                             xmlMetrePix=xmlMetrePix, xmlAPix=xmlAPix, objectiveAperture=objectiveAperture,
@@ -0,0 +1,36 @@
+from argparse import Namespace
+
+from emharvest.catalogue import build_query, query, upsert_session
+
+ARGS = Namespace(mode="TOMO", category="serialEM", output_dir="/out")
+
+
+def tables(session_path, detector="K3", date="2023-09-19 14:01:41"):
+    values = {"Microscope": "TFS KRIOS", "detector_name": detector, "eV": "300", "date": date,
+              "number_of_images": "10", "apix": "?"}
+    return {"session": "SerialEM_microscopy_data", "session_path": session_path, "values": values,
+            "nested_dict": {}}
+
+
+def test_filters_use_ranges_and_parameters():
+    sql, parameters = build_query({"detector": "K3", "year": "2023", "defocus_from": -3, "mode": None})
+    assert "WHERE detector = ? AND date BETWEEN ? AND ? AND defocus_max >= ?" in sql
+    assert parameters == ["K3", "2023-01-01", "2023-12-31", -3]
+
+
+def test_group_by_year():
+    sql, parameters = build_query({}, group_by=["microscope", "year"])
+    assert "substr(date, 1, 4) AS year" in sql and sql.endswith("GROUP BY microscope, year ORDER BY microscope, year")
+    assert parameters == []
+
+
+def test_sessions_sharing_a_name_keep_a_row_each(tmp_path):
+    catalogue = str(tmp_path / "catalogue.db")
+    upsert_session(catalogue, tables("/data/a/tomo"), {}, ARGS)
+    upsert_session(catalogue, tables("/data/b/tomo"), {}, ARGS)
+    upsert_session(catalogue, tables("/data/a/tomo", detector="Falcon"), {}, ARGS)
+
+    rows = query(catalogue, {})
+    assert [(row["session_path"], row["detector"]) for row in rows] == [("/data/a/tomo", "Falcon"),
+                                                                        ("/data/b/tomo", "K3")]
+    assert rows[0]["voltage_kv"] == 300 and rows[0]["date"] == "2023-09-19" and rows[0]["pixel_size"] is None
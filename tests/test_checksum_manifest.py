@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from emharvest import checksum_manifest
+from emharvest.checksum_manifest import build_checksum_manifest, read_manifest, sha256_file
+from emharvest.failures import failures
+
+
+@pytest.fixture(autouse=True)
+def clear_failures():
+    failures.configure()
+    failures.clear()
+    yield
+    failures.clear()
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_manifest_reuses_unchanged_entries(tmp_path):
+    session = tmp_path / "session"
+    write(str(session / "a.xml"), b"a")
+    write(str(session / "Data" / "b.mrc"), b"b" * 100)
+    manifest = str(tmp_path / "manifest.checksum")
+
+    assert build_checksum_manifest(str(session), manifest) == {"total": 2, "hashed": 2, "reused": 0, "skipped": 0}
+    write(str(session / "a.xml"), b"changed")
+    stats = build_checksum_manifest(str(session), manifest)
+
+    assert (stats["hashed"], stats["reused"]) == (1, 1)
+    assert read_manifest(manifest)["a.xml"][0] == sha256_file(str(session / "a.xml"))
+
+
+def test_paths_with_tabs_and_newlines_round_trip(tmp_path):
+    session = tmp_path / "session"
+    names = ["tab\tname.xml", "new\nline.xml", "back\\slash.xml"]
+    for name in names:
+        write(str(session / name), name.encode())
+    manifest = str(tmp_path / "manifest.checksum")
+
+    build_checksum_manifest(str(session), manifest)
+
+    with open(manifest) as f:
+        assert len(f.read().splitlines()) == len(names) + 1
+    entries = read_manifest(manifest)
+    assert sorted(entries) == sorted(names)
+    for name in names:
+        assert entries[name][0] == sha256_file(str(session / name))
+
+
+def test_escape_path_leaves_plain_paths_alone():
+    assert checksum_manifest.escape_path("Images-Disc1\\GridSquare_1\\a.xml") == ("", "Images-Disc1\\GridSquare_1\\a.xml")
+    prefix, escaped = checksum_manifest.escape_path("a\\b\tc")
+    assert prefix == "\\" and escaped == "a\\\\b\\tc"
+    assert checksum_manifest.unescape_path(escaped) == "a\\b\tc"
+
+
+def test_vanished_file_is_recorded_and_skipped(tmp_path, monkeypatch):
+    session = tmp_path / "session"
+    write(str(session / "kept.xml"), b"kept")
+    write(str(session / "gone.xml"), b"gone")
+    listed = checksum_manifest.list_session_files(str(session))
+    os.remove(str(session / "gone.xml"))
+    monkeypatch.setattr(checksum_manifest, "list_session_files", lambda path, exclude=None: listed)
+    manifest = str(tmp_path / "manifest.checksum")
+
+    stats = build_checksum_manifest(str(session), manifest)
+
+    assert stats["skipped"] == 1
+    assert list(read_manifest(manifest)) == ["kept.xml"]
+    assert failures.count(scopes=("file",), reasons=("missing_file",)) == 1
+
+
+def test_vanished_file_raises_with_fail_fast(tmp_path, monkeypatch):
+    session = tmp_path / "session"
+    write(str(session / "gone.xml"), b"gone")
+    listed = checksum_manifest.list_session_files(str(session))
+    os.remove(str(session / "gone.xml"))
+    monkeypatch.setattr(checksum_manifest, "list_session_files", lambda path, exclude=None: listed)
+    failures.configure(fail_fast=True)
+
+    with pytest.raises(FileNotFoundError):
+        build_checksum_manifest(str(session), str(tmp_path / "manifest.checksum"))
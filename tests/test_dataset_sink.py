@@ -0,0 +1,96 @@
+import glob
+import json
+import os
+
+import pytest
+
+from emharvest.dataset_sink import append_deposition_record, dataset_columns
+
+ITEMS = {"Microscope": "em_imaging.microscope_model", "date": "em_imaging.date", "eV": "em_imaging.accelerating_voltage",
+         "spot_size": "?"}
+COLUMNS = dataset_columns(ITEMS)
+
+
+def record(voltage=300, date="2023-09-19 14:01:41"):
+    return {"em_imaging": {"microscope_model": "TFS KRIOS", "date": date, "accelerating_voltage": voltage}}
+
+
+def rows(dataset_dir, suffix="ndjson"):
+    result = []
+    for path in glob.glob(os.path.join(dataset_dir, "*", "*", "*." + suffix)):
+        with open(path) as f:
+            result.extend(json.loads(line) for line in f)
+    return result
+
+
+def test_columns_are_stable():
+    assert COLUMNS == ["session_name", "session_path", "harvested_at", "em_imaging.microscope_model",
+                       "em_imaging.date", "em_imaging.accelerating_voltage"]
+
+
+def test_partitioned_by_date_and_microscope(tmp_path):
+    path = append_deposition_record(record(), "session", str(tmp_path), COLUMNS, session_path="/data/session")
+    assert os.path.relpath(path, str(tmp_path)).split(os.sep)[:2] == ["date=2023-09-19", "microscope=TFS_KRIOS"]
+    assert rows(str(tmp_path))[0]["em_imaging.accelerating_voltage"] == "300"
+
+
+def test_ndjson_reharvest_replaces_the_row(tmp_path):
+    append_deposition_record(record(300), "session", str(tmp_path), COLUMNS, session_path="/data/session")
+    append_deposition_record(record(200), "session", str(tmp_path), COLUMNS, session_path="/data/session")
+
+    result = rows(str(tmp_path))
+    assert len(result) == 1
+    assert result[0]["em_imaging.accelerating_voltage"] == "200"
+    assert not glob.glob(os.path.join(str(tmp_path), "*", "*", "*.tmp*"))
+
+
+def test_sessions_sharing_a_name_keep_their_rows(tmp_path):
+    for directory in ["/data/a/SerialEM", "/data/b/SerialEM"]:
+        append_deposition_record(record(), "SerialEM_microscopy_data", str(tmp_path), COLUMNS, session_path=directory)
+
+    assert sorted(row["session_path"] for row in rows(str(tmp_path))) == ["/data/a/SerialEM", "/data/b/SerialEM"]
+
+
+def test_one_part_file_per_partition(tmp_path):
+    for n in range(20):
+        append_deposition_record(record(), f"session_{n}", str(tmp_path), COLUMNS, session_path=f"/data/{n}")
+    append_deposition_record(record(), "session_0", str(tmp_path), COLUMNS, session_path="/data/0")
+
+    assert len(glob.glob(os.path.join(str(tmp_path), "*", "*", "*.ndjson"))) == 1
+    assert sorted(row["session_name"] for row in rows(str(tmp_path))) == sorted(f"session_{n}" for n in range(20))
+
+
+def test_changed_partition_moves_the_row(tmp_path):
+    append_deposition_record(record(), "other", str(tmp_path), COLUMNS, session_path="/data/other")
+    append_deposition_record(record(), "session", str(tmp_path), COLUMNS, session_path="/data/session")
+    path = append_deposition_record(record(date="2023-09-20 09:00:00"), "session", str(tmp_path), COLUMNS,
+                                    session_path="/data/session")
+
+    result = rows(str(tmp_path))
+    assert sorted((row["session_name"], row["em_imaging.date"][:10]) for row in result) == \
+        [("other", "2023-09-19"), ("session", "2023-09-20")]
+    assert os.path.relpath(path, str(tmp_path)).startswith("date=2023-09-20")
+
+
+def test_partition_left_empty_is_removed(tmp_path):
+    append_deposition_record(record(), "session", str(tmp_path), COLUMNS, session_path="/data/session")
+    append_deposition_record(record(date="2023-09-20 09:00:00"), "session", str(tmp_path), COLUMNS,
+                             session_path="/data/session")
+    assert len(glob.glob(os.path.join(str(tmp_path), "*", "*", "*.ndjson"))) == 1
+
+
+def test_parquet_reharvest_replaces_the_row(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    append_deposition_record(record(300), "session", str(tmp_path), COLUMNS, "parquet", session_path="/data/session")
+    append_deposition_record(record(300), "other", str(tmp_path), COLUMNS, "parquet", session_path="/data/other")
+    path = append_deposition_record(record(200), "session", str(tmp_path), COLUMNS, "parquet",
+                                    session_path="/data/session")
+
+    assert len(glob.glob(os.path.join(str(tmp_path), "*", "*", "*.parquet"))) == 1
+    table = {row["session_name"]: row for row in pq.read_table(path).to_pylist()}
+    assert table["session"]["em_imaging.accelerating_voltage"] == "200" and len(table) == 2
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        append_deposition_record(record(), "session", str(tmp_path), COLUMNS, "csv")
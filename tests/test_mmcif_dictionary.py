@@ -0,0 +1,142 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from emharvest.mmcif_dictionary import (_in_ranges, compile_dictionary, download_dictionary, ensure_dictionary_index,
+                                        validate_with_index)
+
+DICTIONARY = """data_mmcif_pdbx.dic
+_dictionary.title mmcif_pdbx.dic
+_dictionary.version 5.399
+
+loop_
+_item_type_list.code
+_item_type_list.primitive_code
+_item_type_list.construct
+code char '[][_,.;:"&<>()/\\{}'`~!@#$%A-Za-z0-9*|+-]*'
+int numb '[+-]?[0-9]+'
+line char '[][ \\t_(),.;:"&<>/\\{}'`~!@#$%?+=*A-Za-z0-9|^-]*'
+
+save_em_imaging
+_category.id em_imaging
+_category.mandatory_code no
+_category_key.name '_em_imaging.id'
+save_
+
+save__em_imaging.id
+_item.name '_em_imaging.id'
+_item.category_id em_imaging
+_item.mandatory_code yes
+_item_type.code code
+save_
+
+save__em_imaging.accelerating_voltage
+_item.name '_em_imaging.accelerating_voltage'
+_item.category_id em_imaging
+_item.mandatory_code no
+_item_type.code int
+loop_
+_item_range.maximum
+_item_range.minimum
+400 0
+400 400
+save_
+
+save__em_imaging.mode
+_item.name '_em_imaging.mode'
+_item.category_id em_imaging
+_item.mandatory_code no
+_item_type.code line
+loop_
+_item_enumeration.value
+'BRIGHT FIELD'
+'DARK FIELD'
+save_
+"""
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = tmp_path / "mmcif_pdbx_v50.dic"
+    path.write_text(DICTIONARY)
+    return compile_dictionary(str(path))
+
+
+def validate(tmp_path, index, text):
+    path = tmp_path / "test.cif"
+    path.write_text(text)
+    return validate_with_index(str(path), index)
+
+
+@pytest.mark.parametrize("value, expected", [("200", True), ("400", True), ("0", False), ("400.5", False),
+                                             ("-1", False), ("abc", False)])
+def test_ranges_exclude_bounds_unless_equal(value, expected):
+    assert _in_ranges(value, [["0", "400"], ["400", "400"]]) is expected
+
+
+def test_unbounded_ranges():
+    assert _in_ranges("-5", [[".", "0"]])
+    assert not _in_ranges("0", [[".", "0"]])
+    assert _in_ranges("1e9", [["0", "."]])
+
+
+def test_index_keeps_mandatory_items_and_keys(index):
+    category = index["categories"]["em_imaging"]
+    assert category["keys"] == ["_em_imaging.id"]
+    assert category["items"]["_em_imaging.id"]["mandatory"]
+    assert not category["items"]["_em_imaging.mode"]["mandatory"]
+
+
+def test_valid_block(tmp_path, index):
+    result = validate(tmp_path, index, "data_a\n_em_imaging.id 1\n_em_imaging.accelerating_voltage 300\n")
+    assert result["valid"] and not result["errors"]
+
+
+def test_missing_mandatory_item(tmp_path, index):
+    result = validate(tmp_path, index, "data_a\n_em_imaging.accelerating_voltage 300\n")
+    assert not result["valid"]
+    assert [e["message"] for e in result["errors"]] == ["[a] missing mandatory tag: _em_imaging.id"]
+
+
+def test_loop_columns_are_validated(tmp_path, index):
+    result = validate(tmp_path, index, "data_a\nloop_\n_em_imaging.id\n_em_imaging.mode\n"
+                                       "1 'BRIGHT FIELD'\n2 'GREY FIELD'\n")
+    assert not result["valid"]
+    assert len(result["errors"]) == 1
+    assert "GREY FIELD is not one of the allowed values" in result["errors"][0]["message"]
+
+
+def test_loop_without_mandatory_item(tmp_path, index):
+    result = validate(tmp_path, index, "data_a\nloop_\n_em_imaging.mode\n'BRIGHT FIELD'\n'DARK FIELD'\n")
+    assert [e["item"] for e in result["errors"]] == ["_em_imaging.id"]
+
+
+def test_duplicated_loop_keys(tmp_path, index):
+    result = validate(tmp_path, index, "data_a\nloop_\n_em_imaging.id\n_em_imaging.accelerating_voltage\n"
+                                       "1 300\n1 200\n")
+    assert [e["message"] for e in result["errors"]] == ["[a] duplicated key in em_imaging: 1"]
+
+
+def test_unknown_loop_tag_is_warned_once(tmp_path, index):
+    result = validate(tmp_path, index, "data_a\nloop_\n_em_imaging.id\n_em_imaging.other\n1 a\n2 b\n")
+    assert result["valid"]
+    assert [w["item"] for w in result["warnings"]] == ["_em_imaging.other"]
+
+
+def test_offline_download_keeps_the_local_dictionary(tmp_path, monkeypatch):
+    def offline(url, path):
+        with open(path, "w") as f:
+            f.write("partial")
+        raise urllib.error.URLError("offline")
+
+    monkeypatch.setattr(urllib.request, "urlretrieve", offline)
+    dic_path = tmp_path / "mmcif_pdbx_v50.dic"
+    dic_path.write_text(DICTIONARY)
+
+    index = ensure_dictionary_index(str(dic_path), str(tmp_path / "index.json"), download=True)
+
+    assert index["categories"]["em_imaging"]["keys"] == ["_em_imaging.id"]
+    assert dic_path.read_text() == DICTIONARY
+    assert not download_dictionary(str(dic_path))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["index.json", "mmcif_pdbx_v50.dic"]
@@ -0,0 +1,28 @@
+import json
+import logging
+
+from emharvest.failures import failures
+from emharvest.mmcif_writer import write_cif_batch
+
+
+def test_batch_counts_only_the_records_left_out(tmp_path, caplog):
+    paths = []
+    for name, text in [("a", json.dumps({"em_imaging": {"microscope_model": "TFS KRIOS"}})), ("b", "{not json"),
+                       ("c", ""), ("d", json.dumps({"em_imaging": {"microscope_model": "TFS GLACIOS"}}))]:
+        path = tmp_path / f"{name}_dep.json"
+        path.write_text(text)
+        paths.append(str(path))
+    paths.insert(2, str(tmp_path / "missing_dep.json"))
+    failures.configure()
+    failures.clear()
+    # Failures from earlier in the run are not records of this batch
+    failures.record("stage", "timeline", RuntimeError("earlier"))
+
+    with caplog.at_level(logging.INFO, logger="emharvest.mmcif_writer"):
+        written = write_cif_batch(paths, str(tmp_path / "batch.cif"), prefetch_depth=2)
+
+    cif = open(written[0]).read()
+    assert "data_a" in cif and "data_d" in cif and "data_b" not in cif
+    assert "Left out 3 records that could not be read" in caplog.text
+    assert len(failures) == 4
+    failures.clear()
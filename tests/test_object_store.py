@@ -0,0 +1,124 @@
+import os
+import glob
+
+import pytest
+
+from emharvest import object_store
+from emharvest.object_store import MemoryObjectStore, ObjectStoreFileSystem, register_store
+from emharvest.sources import glob_inputs, read_input
+
+
+def session_tree(directory):
+    files = {}
+    for square in range(3):
+        for image in range(4):
+            path = os.path.join(directory, "Images-Disc1", f"GridSquare_{square}", "Data", f"FoilHole_{image}.xml")
+            files[path] = f"<image square={square} n={image}/>".encode() * (image + 1)
+    files[os.path.join(directory, "EpuSession.dm")] = bytes(range(256)) * 40
+    for path, data in files.items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+    return files
+
+
+@pytest.fixture
+def store():
+    store = MemoryObjectStore()
+    store.put("bucket/session/a/1.xml", b"one")
+    store.put("bucket/session/a/2.xml", b"two")
+    store.put("bucket/session/b/3.xml", b"three")
+    store.put("bucket/other/4.xml", b"four")
+    store.put("bucket/session/big.bin", bytes(range(256)) * 4)
+    return store
+
+
+def test_prefix_is_listed_once(store):
+    fs = ObjectStoreFileSystem(store, "memory")
+
+    assert sorted(fs.find("bucket/session")) == ["bucket/session/a/1.xml", "bucket/session/a/2.xml",
+                                                 "bucket/session/b/3.xml", "bucket/session/big.bin"]
+    assert sorted(fs.find("bucket/session/a/")) == ["bucket/session/a/1.xml", "bucket/session/a/2.xml"]
+    assert fs.info("bucket/session/b/3.xml")["size"] == 5
+    assert store.requests["list"] == 1 and fs.stats["lists"] == 1
+
+
+def test_parent_listing_replaces_child_listings(store):
+    fs = ObjectStoreFileSystem(store, "memory")
+    fs.find("bucket/session/a")
+    fs.find("bucket")
+    fs.find("bucket/other")
+
+    assert store.requests["list"] == 2
+    assert list(fs._listings) == ["bucket/"]
+
+
+def test_block_reads(store):
+    fs = ObjectStoreFileSystem(store, "memory", block_size=100)
+    data = bytes(range(256)) * 4
+
+    assert fs.read_range("bucket/session/big.bin", 150, 120) == data[150:270]
+    assert store.requests["get"] == 2
+    assert fs.read_range("bucket/session/big.bin", 180, 10) == data[180:190]
+    assert store.requests["get"] == 2 and fs.stats["block_hits"] == 1
+    assert fs.read_range("bucket/session/big.bin", 1020, 100) == data[1020:]
+    assert fs.read_range("bucket/session/big.bin", 2000, 10) == b""
+
+    assert fs.cat("bucket/session/big.bin") == data
+    assert store.requests["get"] == 11
+    with fs.open("bucket/session/big.bin") as f:
+        f.seek(510)
+        assert f.read(4) == data[510:514]
+
+
+def test_least_recently_used_blocks_are_evicted(store):
+    fs = ObjectStoreFileSystem(store, "memory", block_size=100, cache_bytes=250)
+    for block in (0, 1, 0, 2):
+        fs.read_range("bucket/session/big.bin", block * 100, 1)
+    assert store.requests["get"] == 3
+    assert sorted(block for _, block in fs._blocks) == [0, 2]
+
+    # Block 1 was least recently used
+    fs.read_range("bucket/session/big.bin", 100, 1)
+    fs.read_range("bucket/session/big.bin", 200, 1)
+    assert store.requests["get"] == 4
+
+
+def test_disk_cache_is_reused_by_later_harvests(store, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    ObjectStoreFileSystem(store, "memory", cache_dir=cache_dir).cat("bucket/session/a/1.xml")
+    gets = store.requests["get"]
+
+    fs = ObjectStoreFileSystem(store, "memory", cache_dir=cache_dir)
+    assert fs.cat("bucket/session/a/1.xml") == b"one"
+    assert store.requests["get"] == gets and fs.stats["disk_hits"] == 1
+
+    # A new version of the object is fetched again
+    store.put("bucket/session/a/1.xml", b"uno")
+    fs = ObjectStoreFileSystem(store, "memory", cache_dir=cache_dir)
+    assert fs.cat("bucket/session/a/1.xml") == b"uno"
+
+
+def test_missing_object(store):
+    fs = ObjectStoreFileSystem(store, "memory")
+    with pytest.raises(FileNotFoundError):
+        fs.cat("bucket/session/a/missing.xml")
+    with pytest.raises(FileNotFoundError):
+        store.get("bucket/session/a/missing.xml")
+
+
+def test_store_reads_like_the_local_tree(tmp_path, monkeypatch):
+    directory = str(tmp_path / "session")
+    files = session_tree(directory)
+    store = MemoryObjectStore.from_directory(directory, "bucket/session")
+    monkeypatch.setattr(object_store, "_filesystems", {})
+    register_store("memory", store)
+
+    local = sorted(glob.glob(directory + "/**/GridSquare*/Data/*.xml"))
+    remote = glob_inputs("memory://bucket/session/**/GridSquare*/Data/*.xml")
+
+    assert [os.path.relpath(path, directory) for path in local] == \
+        [path[len("memory://bucket/session/"):] for path in remote]
+    assert [read_input(path) for path in remote] == [files[path] for path in local]
+    assert read_input("memory://bucket/session/EpuSession.dm") == files[os.path.join(directory, "EpuSession.dm")]
+    assert store.requests["list"] == 1
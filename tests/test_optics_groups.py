@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import starfile
+
+from emharvest import optics_groups
+from emharvest.optics_groups import cluster_beam_shifts, holes_per_stage_position, session_optics_groups
+
+TARGETS = [(-1.0, -1.0), (1.0, -1.0), (-1.0, 1.0), (1.0, 1.0)]
+
+
+def afis_shifts(per_target=25):
+    rng = np.random.default_rng(0)
+    rows = []
+    for position in range(per_target):
+        for hole, (x, y) in enumerate(TARGETS):
+            rows.append({"micrograph": f"FoilHole_{position}{hole}_Data.mrc", "hole": f"{position}{hole}",
+                         "beam_x": x + rng.normal(0, 0.01), "beam_y": y + rng.normal(0, 0.01),
+                         "stage_x": position * 10.0, "stage_y": 0.0})
+    return pd.DataFrame(rows)
+
+
+def test_clusters_follow_beam_shift_targets():
+    shifts = afis_shifts()
+    labels, centres = cluster_beam_shifts(shifts[["beam_x", "beam_y"]].to_numpy(), 4)
+
+    # One group per target, numbered in order of the centre's y
+    assert np.allclose(sorted(map(tuple, centres.round(1))), sorted(TARGETS))
+    assert (np.diff(centres[:, 1]) >= 0).all()
+    assert all(len(set(labels[target::4])) == 1 for target in range(4))
+    assert np.array_equal(labels, cluster_beam_shifts(shifts[["beam_x", "beam_y"]].to_numpy(), 4)[0])
+
+
+def test_fewer_distinct_shifts_than_groups():
+    labels, centres = cluster_beam_shifts(np.zeros((5, 2)), 4)
+    assert labels.tolist() == [1] * 5 and centres.shape == (1, 2)
+
+
+def test_holes_per_stage_position():
+    assert holes_per_stage_position(afis_shifts()) == 4
+
+
+def test_star_file_of_an_afis_session(tmp_path, monkeypatch):
+    monkeypatch.setattr(optics_groups, "read_beam_shifts", lambda session_dir, depth: afis_shifts())
+
+    path = session_optics_groups("session", str(tmp_path), "session",
+                                 record={"collection": "AFIS", "eV": "300000", "xmlAPix": "0.8"})
+
+    star = starfile.read(path)
+    assert star["optics"]["rlnMicrographOriginalPixelSize"].tolist() == [0.8] * 4
+    assert star["optics"]["rlnVoltage"].tolist() == [300] * 4
+    assert star["optics"]["rlnSphericalAberration"].tolist() == [2.7] * 4
+    assert star["optics"]["rlnAmplitudeContrast"].tolist() == [0.1] * 4
+    assert len(star["micrographs"]) == 100
+
+
+def test_explicit_optics_values(tmp_path, monkeypatch):
+    monkeypatch.setattr(optics_groups, "read_beam_shifts", lambda session_dir, depth: afis_shifts())
+
+    path = session_optics_groups("session", str(tmp_path), "session", record={"collection": "AFIS"}, cs_mm=1.4,
+                                 amplitude_contrast=0.07)
+
+    optics = starfile.read(path)["optics"]
+    assert optics["rlnSphericalAberration"].tolist() == [1.4] * 4
+    assert optics["rlnAmplitudeContrast"].tolist() == [0.07] * 4
+
+
+def test_accurate_sessions_are_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(optics_groups, "read_beam_shifts", lambda session_dir, depth: afis_shifts())
+    assert session_optics_groups("session", str(tmp_path), "session", record={"collection": "Accrt"}) is None
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,32 @@
+import os
+import threading
+
+from emharvest.profiling import StageProfiler, profiler
+from emharvest.stage_graph import StageGraph
+
+
+def test_one_stage_is_recorded_with_cprofile_at_a_time(tmp_path):
+    stages = StageProfiler()
+    stages.enable(dump_dir=str(tmp_path))
+
+    def worker():
+        with stages.stage("worker"):
+            pass
+
+    with stages.stage("outer"):
+        with stages.stage("inner"):
+            pass
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+    with stages.stage("next"):
+        pass
+
+    assert sorted(os.listdir(str(tmp_path))) == ["next.pstats", "outer.pstats"]
+    assert [row["stage"] for row in stages.summary()] == ["outer", "inner", "worker", "next"]
+
+
+def test_stages_run_serially_while_profiling(monkeypatch):
+    assert StageGraph(workers=4).workers == 4
+    monkeypatch.setattr(profiler, "enabled", True)
+    assert StageGraph(workers=4).workers == 1
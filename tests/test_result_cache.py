@@ -0,0 +1,112 @@
+import os
+from argparse import Namespace
+
+from emharvest.atlas_files import representative_xmls
+from emharvest.result_cache import (ENTRY_FILENAME, RESTORED_FILENAME, detach_outputs, harvest_fingerprint,
+                                    load_cached_result, restore_cached_result, store_result)
+
+
+def write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def cached_entry(tmp_path, names):
+    harvest_dir = tmp_path / "harvest"
+    harvest_dir.mkdir()
+    paths = []
+    for name in names:
+        write(str(harvest_dir / name), "cached " + name)
+        paths.append(str(harvest_dir / name))
+    store_result(str(tmp_path / "cache"), "ab" * 32, {}, paths, "session", {"validation": None, "micrographs": 1})
+    return load_cached_result(str(tmp_path / "cache"), "ab" * 32)
+
+
+def test_store_and_restore(tmp_path):
+    entry = cached_entry(tmp_path, ["session_dep.json", "session_timeline.json"])
+    assert sorted(entry["files"]) == ["session_dep.json", "session_timeline.json"]
+
+    restored = restore_cached_result(entry, str(tmp_path / "out"))
+
+    assert [read(path) for path in restored] == ["cached " + os.path.basename(path) for path in restored]
+
+
+def test_incomplete_entry_is_not_used(tmp_path):
+    entry = cached_entry(tmp_path, ["session_dep.json"])
+    os.remove(os.path.join(entry["directory"], "session_dep.json"))
+    assert load_cached_result(str(tmp_path / "cache"), "ab" * 32) is None
+
+
+def test_detach_protects_every_restored_output(tmp_path):
+    names = ["session_dep.json", "session_timeline.json", "session_optics.star", "session_statistics.json"]
+    entry = cached_entry(tmp_path, names)
+    out = tmp_path / "out"
+    restore_cached_result(entry, str(out))
+
+    detach_outputs(str(out))
+    for name in names:
+        # The next harvest writes its outputs in place
+        write(str(out / name), "new " + name)
+
+    for name in names:
+        assert read(os.path.join(entry["directory"], name)) == "cached " + name
+    assert not (out / RESTORED_FILENAME).exists()
+
+
+def test_detach_keeps_files_it_did_not_restore(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    write(str(out / "notes.txt"), "mine")
+    os.link(str(out / "notes.txt"), str(tmp_path / "elsewhere.txt"))
+
+    detach_outputs(str(out))
+
+    assert read(str(out / "notes.txt")) == "mine"
+
+
+def test_damaged_entry_is_replaced(tmp_path):
+    entry = cached_entry(tmp_path, ["session_dep.json"])
+    os.remove(os.path.join(entry["directory"], ENTRY_FILENAME))
+    write(str(tmp_path / "harvest" / "session_dep.json"), "new")
+
+    store_result(str(tmp_path / "cache"), "ab" * 32, {}, [str(tmp_path / "harvest" / "session_dep.json")],
+                 "session", {"validation": None, "micrographs": 1})
+
+    entry = load_cached_result(str(tmp_path / "cache"), "ab" * 32)
+    assert read(os.path.join(entry["directory"], "session_dep.json")) == "new"
+
+
+def test_valid_entry_is_kept(tmp_path):
+    entry = cached_entry(tmp_path, ["session_dep.json"])
+    write(str(tmp_path / "harvest" / "session_dep.json"), "new")
+
+    store_result(str(tmp_path / "cache"), "ab" * 32, {}, [str(tmp_path / "harvest" / "session_dep.json")],
+                 "session", {"validation": None, "micrographs": 1})
+
+    assert read(os.path.join(entry["directory"], "session_dep.json")) == "cached session_dep.json"
+    assert os.listdir(str(tmp_path / "cache" / "ab")) == ["ab" * 32]
+
+
+def test_representative_xml_edits_change_the_fingerprint(tmp_path):
+    session = tmp_path / "session"
+    data = session / "Images-Disc1" / "GridSquare_1" / "Data"
+    data.mkdir(parents=True)
+    write(str(session / "Images-Disc1" / "GridSquare_1" / "GridSquare_1.xml"), "<square/>")
+    write(str(data / "FoilHole_1_Data_2.xml"), "<data/>")
+    args = Namespace(mode="SPA", category="epu")
+
+    def fingerprint():
+        return harvest_fingerprint(args, str(session), [], representatives=representative_xmls(str(session)))[0]
+
+    before = fingerprint()
+    st = os.stat(str(data))
+    write(str(data / "FoilHole_1_Data_2.xml"), "<data>edited</data>")
+    # The edit leaves the folder's mtime as it was
+    os.utime(str(data), ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    assert fingerprint() != before
@@ -0,0 +1,104 @@
+import os
+
+from emharvest.session_state import file_cache, incremental_file_results, load_session_state, save_session_state, \
+    scan_images
+from emharvest.sources import DATA_FOLDERS, glob_inputs
+from emharvest.timeline import epu_timestamps
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("x")
+
+
+def bump(path):
+    # Folder mtimes can be equal within a test, so a change is made visible explicitly
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def data_dir(session, square):
+    return os.path.join(session, "Images-Disc1", square, "Data")
+
+
+def test_scan_images_lists_only_changed_folders(tmp_path):
+    session = str(tmp_path)
+    for square in ("GridSquare_1", "GridSquare_2"):
+        touch(os.path.join(data_dir(session, square), "FoilHole_1_Data_1.xml"))
+        touch(os.path.join(data_dir(session, square), "FoilHole_1_Data_1.jpg"))
+    total, images, new = scan_images(session, {})
+    assert (total, new) == (2, 2)
+
+    touch(os.path.join(data_dir(session, "GridSquare_2"), "FoilHole_2_Data_2.xml"))
+    bump(data_dir(session, "GridSquare_2"))
+    total, images, new = scan_images(session, images)
+
+    assert (total, new) == (3, 1)
+    assert images[os.path.join("Images-Disc1", "GridSquare_2", "Data")]["names"] == ["FoilHole_1_Data_1.xml",
+                                                                                    "FoilHole_2_Data_2.xml"]
+
+
+def test_only_new_files_are_read(tmp_path):
+    session = str(tmp_path)
+    touch(os.path.join(data_dir(session, "GridSquare_1"), "a.mrc"))
+    touch(os.path.join(data_dir(session, "GridSquare_2"), "b.mrc"))
+    reads = []
+
+    def read(paths):
+        reads.append([os.path.basename(path) for path in paths])
+        return [{"name": os.path.basename(path)} for path in paths]
+
+    cache = {}
+    results, n_read = incremental_file_results(session, cache, lambda name: name.endswith(".mrc"), read)
+    assert n_read == 2 and [result["name"] for _, result in results] == ["a.mrc", "b.mrc"]
+
+    touch(os.path.join(data_dir(session, "GridSquare_2"), "c.mrc"))
+    bump(data_dir(session, "GridSquare_2"))
+    results, n_read = incremental_file_results(session, cache, lambda name: name.endswith(".mrc"), read)
+
+    assert n_read == 1 and reads[-1] == ["c.mrc"]
+    assert [result["name"] for _, result in results] == ["a.mrc", "b.mrc", "c.mrc"]
+
+
+def test_flagged_results_are_read_again(tmp_path):
+    session = str(tmp_path)
+    touch(os.path.join(data_dir(session, "GridSquare_1"), "a.tiff"))
+    cache = {}
+    incremental_file_results(session, cache, lambda name: True, lambda paths: [{"truncated": True}] * len(paths))
+
+    results, n_read = incremental_file_results(session, cache, lambda name: True,
+                                               lambda paths: [{"truncated": False}] * len(paths),
+                                               reread=lambda result: result["truncated"])
+
+    assert n_read == 1 and results[0][1] == {"truncated": False}
+
+
+def test_file_caches_are_kept_in_the_state(tmp_path):
+    output = str(tmp_path / "out")
+    os.makedirs(output)
+    state = load_session_state(output, str(tmp_path))
+    assert file_cache(None, "movies") is None
+    file_cache(state, "movies")["Images-Disc1/GridSquare_1/Data"] = {"mtime_ns": 1, "results": {"a.tiff": None}}
+    save_session_state(output, state)
+
+    assert load_session_state(output, str(tmp_path))["files"]["movies"] == state["files"]["movies"]
+
+
+def test_incremental_and_full_searches_find_the_same_images(tmp_path):
+    session = str(tmp_path)
+    xml = b"<acquisitionDateTime>2023-09-19T14:20:%02d</acquisitionDateTime>"
+    # GridSquares one level below the session are acquisitions, the others are not searched by either path
+    for n, folder in enumerate(["Images-Disc1/GridSquare_1/Data", "Images-Disc2/GridSquare_2/Data",
+                                "GridSquare_3/Data", "Images-Disc1/nested/GridSquare_4/Data"]):
+        path = os.path.join(session, folder, f"FoilHole_{n}_Data_{n}.xml")
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(xml % n)
+
+    full = glob_inputs(session + DATA_FOLDERS + "/*xml*")
+    total, _, _ = scan_images(session, {})
+    assert total == len(full) == 2
+    assert epu_timestamps(session) == epu_timestamps(session, cache={})
+    assert [path for path, _ in incremental_file_results(session, {}, lambda name: True, lambda paths: paths)[0]] \
+        == full
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+from emharvest.spatial import TargetIndex, spatial_summary
+
+SPACING_UM = 2.0
+RADIUS_UM = 6.0
+
+
+def afis_square(clusters_x=4, clusters_y=3):
+    """A regular foil grid at 2 um spacing, acquired in 3x3 AFIS clusters from the centre hole's stage position."""
+    rows = []
+    hole = 0
+    for cx in range(clusters_x):
+        for cy in range(clusters_y):
+            stage_x, stage_y = (cx * 3 + 1) * SPACING_UM, (cy * 3 + 1) * SPACING_UM
+            for dx in range(3):
+                for dy in range(3):
+                    hole += 1
+                    x, y = (cx * 3 + dx) * SPACING_UM, (cy * 3 + dy) * SPACING_UM
+                    rows.append({"kind": "hole", "square": "GridSquare_1", "hole": str(hole), "x": x, "y": y})
+                    rows.append({"kind": "acquisition", "square": "GridSquare_1", "hole": str(hole),
+                                 "x": stage_x, "y": stage_y})
+    targets = pd.DataFrame(rows)
+    targets["kind"] = pd.Categorical(targets["kind"], categories=["square", "hole", "acquisition"])
+    return targets
+
+
+def test_clusters_are_stage_positions_not_neighbour_chains():
+    summary = spatial_summary(afis_square(), RADIUS_UM)
+
+    # Neighbouring holes are closer than the radius, yet each cluster is one stage position
+    assert summary["hole_spacing_um"]["median"] == SPACING_UM
+    assert summary["clusters"]["count"] == 12
+    assert summary["clusters"]["holes_per_cluster"]["distribution"] == {"9": 12}
+    assert summary["clusters"]["extent_um"]["p95"] == round(np.hypot(SPACING_UM, SPACING_UM), 3)
+    assert summary["clusters"]["over_radius"] == 0
+
+
+def test_clusters_wider_than_the_radius():
+    summary = spatial_summary(afis_square(), 2.0)
+    assert summary["clusters"]["over_radius"] == 12
+
+
+def test_accurate_positioning_has_no_clusters():
+    summary = spatial_summary(afis_square(), float("nan"))
+    assert "clusters" not in summary
+    assert summary["stage_positions"] == 12 and summary["images_per_stage_position"]["max"] == 9
+
+
+def test_target_index_neighbours():
+    index = TargetIndex(np.array([[0.0, 0.0], [1.0, 0.0], [5.0, 0.0]]))
+    assert index.nearest_spacing().tolist() == [1.0, 1.0, 4.0]
+    assert sorted(index.within(0.5, 0.0, 1.0)) == [0, 1]